@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+# asyncio front end for DtkFile, requires Python 3.5+ (async/await and concurrent.futures) with dtkFileTools' compression
+# modules installed for Python 3. dtkAsyncTests skips itself on older interpreters.
+
+import asyncio
+import concurrent.futures
+import functools
+
+import dtkFileTools
+import dtkInstrumentation
+import dtkJson
+from dtkInstrumentation import DECOMPRESS, PARSE
+
+
+class AsyncDtkFile:
+
+    def __init__(self, dtk_file, max_reads=4, max_decodes=4, executor=None):
+        """
+        Wrap an open DtkFile, see AsyncDtkFile.open().
+        :param dtk_file: DtkFile
+        :param max_reads: maximum concurrent chunk reads, each runs on a reader thread so the event loop never blocks on I/O
+        :param max_decodes: maximum concurrent decompress/parse operations
+        :param executor: concurrent.futures executor for decompression and parsing, defaults to a pool of max_decodes
+                         threads, a ProcessPoolExecutor parses outside the GIL (chunks are copied to the workers)
+        """
+        self.dtk_file = dtk_file
+        self._readers = concurrent.futures.ThreadPoolExecutor(max_reads)
+        self._read_limit = asyncio.Semaphore(max_reads)
+        self._own_executor = executor is None
+        self._executor = executor if executor is not None else concurrent.futures.ThreadPoolExecutor(max_decodes)
+        self._decode_limit = asyncio.Semaphore(max_decodes)
+
+        return
+
+    @classmethod
+    async def open(cls, filename, max_reads=4, max_decodes=4, executor=None, **kwargs):
+        """
+        :param filename: DTK serialized population filename
+        :param max_reads: see AsyncDtkFile()
+        :param max_decodes: see AsyncDtkFile()
+        :param executor: see AsyncDtkFile()
+        :param kwargs: passed to DtkFile, e.g. mapped=True, cache_entries=16, cache_dir='cache', compact=True
+        :return: AsyncDtkFile, the header is read without blocking the event loop
+        """
+        loop = asyncio.get_event_loop()
+        dtk_file = await loop.run_in_executor(None, functools.partial(dtkFileTools.DtkFile, filename, **kwargs))
+
+        return cls(dtk_file, max_reads, max_decodes, executor)
+
+    async def __aenter__(self):
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+        return
+
+    def close(self):
+        self._readers.shutdown(wait=False)
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+        self.dtk_file.close()
+
+        return
+
+    @property
+    def header(self):
+
+        return self.dtk_file.header
+
+    @property
+    def chunk_count(self):
+
+        return self.dtk_file.chunk_count
+
+    @property
+    def node_count(self):
+
+        return self.dtk_file.node_count
+
+    async def get_chunk(self, index):
+        """
+        :param index: chunk index
+        :return: chunk as stored, copied out of the mapping for mapped files (see _read_chunk())
+        """
+        async with self._read_limit:
+            chunk = await asyncio.get_event_loop().run_in_executor(self._readers, self._read_chunk, index, False)
+
+        return chunk
+
+    async def get_contents(self, index):
+        chunk = await self._read(index)
+        contents = await self._decode(_decode_contents, index, chunk)
+
+        return contents
+
+    async def get_object(self, index):
+        """
+        :param index: chunk index
+        :return: decoded chunk, from and added to the DtkFile's caches (cache_entries/cache_bytes and cache_dir)
+        """
+        cache = self.dtk_file._cache
+        if cache is not None:
+            obj = cache.get(index)
+            if obj is not None:
+                return obj
+
+        # The disk cache is read and written on the reader threads, like the file
+        disk_cache = self.dtk_file._disk_cache
+        entry = None
+        if disk_cache is not None:
+            key = self.dtk_file._disk_key(index)
+            async with self._read_limit:
+                entry = await asyncio.get_event_loop().run_in_executor(self._readers, disk_cache.get, key)
+
+        if entry is not None:
+            obj, size = entry
+        else:
+            chunk = await self._read(index)
+            obj, size = await self._decode(_decode_object, index, chunk, self.dtk_file.compact, self.dtk_file.json_backend.name)
+            if disk_cache is not None:
+                async with self._read_limit:
+                    await asyncio.get_event_loop().run_in_executor(self._readers, disk_cache.put, key, obj, size)
+
+        if cache is not None:
+            cache.put(index, obj, size)
+
+        return obj
+
+    async def get_node(self, index):
+        """
+        :param index: node index (as for DtkFile.nodes[])
+        :return: node
+        """
+        if index < 0:
+            index += self.node_count
+        if index < 0 or index >= self.node_count:
+            raise IndexError("Node index out of range")
+        obj = await self.get_object(index + 1)
+
+        return obj.node
+
+    async def get_node_by_id(self, external_id):
+        """
+        :param external_id: node externalId
+        :return: node, found with the version 3 index (other files are searched in order, decoding each node)
+        """
+        if self.dtk_file.node_ids is not None:
+            if external_id not in self.dtk_file.node_ids:
+                raise KeyError(external_id)
+            obj = await self.get_object(self.dtk_file.node_ids[external_id])
+            return obj.node
+
+        for index in range(self.node_count):
+            node = await self.get_node(index)
+            if node.externalId == external_id:
+                return node
+
+        raise KeyError(external_id)
+
+    async def get_sim(self):
+        obj = await self.get_object(0)
+
+        return obj.simulation
+
+    async def _read(self, index):
+        # Delta chunks are rebuilt from the base file on a reader thread, _decode() only parses them
+        async with self._read_limit:
+            chunk = await asyncio.get_event_loop().run_in_executor(self._readers, self._read_chunk, index,
+                                                                   index in self.dtk_file.chunk_deltas)
+
+        return chunk
+
+    def _read_chunk(self, index, rebuild):
+        # Runs on a reader thread. Views of a mapped file are copied and released here: futures and pending event loop
+        # callbacks keep their results alive for a while, and a live view stops DtkFile.close() unmapping the file.
+        # Copies can also be sent to a process executor.
+        chunk = self.dtk_file.get_contents(index) if rebuild else self.dtk_file.get_chunk(index)
+        if isinstance(chunk, memoryview):
+            view, chunk = chunk, chunk.tobytes()
+            view.release()
+
+        return chunk
+
+    async def _decode(self, function, index, chunk, *args):
+        scheme, frames = self.dtk_file.chunk_schemes[index], self.dtk_file.chunk_frames.get(index)
+        if index in self.dtk_file.chunk_deltas:
+            scheme, frames = 'NONE', None
+        task = functools.partial(function, chunk, scheme, self.dtk_file.dictionary, frames, index, *args)
+        async with self._decode_limit:
+            result = await asyncio.get_event_loop().run_in_executor(self._executor, task)
+
+        return result
+
+
+def _decode_contents(chunk, scheme, dictionary, frames, index):
+    # Runs on the decode executor, possibly in another process, so it is given names rather than engine modules.
+    _, engine = dtkFileTools._resolve_engine(scheme, dictionary)
+    if not engine:
+        return chunk
+
+    with dtkInstrumentation.span(DECOMPRESS, index) as span:
+        contents = dtkFileTools._decompress_frames(engine, chunk, frames)
+        span.bytes = len(contents)
+
+    return contents
+
+
+def _decode_object(chunk, scheme, dictionary, frames, index, compact, backend):
+    contents = _decode_contents(chunk, scheme, dictionary, frames, index)
+    with dtkInstrumentation.span(PARSE, index) as span:
+        obj = dtkFileTools._parse(contents, compact, dtkJson.get_backend(backend))
+        span.bytes = len(contents)
+
+    return obj, len(contents)
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# dtkAsync is Python 3.5+ only, these tests avoid async/await syntax so the module still imports (and skips) on
+# Python 2 when the suite is discovered.
+
+import dtkFileTools
+import dtkInstrumentation
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    import concurrent.futures
+    import dtkAsync
+else:
+    asyncio = None
+
+
+@unittest.skipIf(asyncio is None, 'dtkAsync requires Python 3.5+')
+class TestAsyncDtkFile(unittest.TestCase):
+
+    filename = 'test-data/two-node/state-00010.dtk.snappy'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        return
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        return
+
+    def _run(self, *coroutines):
+        if len(coroutines) == 1:
+            return self.loop.run_until_complete(coroutines[0])
+        return self.loop.run_until_complete(asyncio.gather(*coroutines))
+
+    def _open(self, **kwargs):
+        return self._run(dtkAsync.AsyncDtkFile.open(self.filename, **kwargs))
+
+    def test_get_chunk_contents_and_object(self):
+        dtk_file = dtkFileTools.DtkFile(self.filename)
+        async_file = self._open()
+        try:
+            chunk = self._run(async_file.get_chunk(1))
+            contents = self._run(async_file.get_contents(1))
+            sim = self._run(async_file.get_sim())
+            nodes = self._run(*[async_file.get_node(index) for index in range(async_file.node_count)])
+        finally:
+            async_file.close()
+        self.assertEqual(dtk_file.get_chunk(1), chunk)
+        self.assertEqual(dtk_file.get_contents(1), contents)
+        self.assertEqual(dtk_file.sim, sim)
+        self.assertEqual([1, 2], [node.externalId for node in nodes])
+        return
+
+    def test_node_by_id_and_cache(self):
+        async_file = self._open(max_reads=1, max_decodes=1, cache_entries=2)
+        try:
+            first = self._run(async_file.get_node_by_id(2))
+            second = self._run(async_file.get_node(1))
+            with self.assertRaises(KeyError):
+                self._run(async_file.get_node_by_id(3))
+            with self.assertRaises(IndexError):
+                self._run(async_file.get_node(2))
+        finally:
+            async_file.close()
+        self.assertIs(first, second)
+        return
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            async_file = self._open(cache_dir=directory)
+            nodes = self._run(*[async_file.get_node(index) for index in range(async_file.node_count)])
+            async_file.close()
+            self.assertEqual(2, len(os.listdir(directory)))
+            self.assertEqual(nodes, list(dtkFileTools.DtkFile(self.filename, cache_dir=directory).nodes))
+            async_file = self._open(cache_dir=directory)
+            recorder = dtkInstrumentation.enable()
+            try:
+                node = self._run(async_file.get_node(1))
+            finally:
+                dtkInstrumentation.disable()
+                async_file.close()
+            self.assertEqual(nodes[1], node)
+            self.assertEqual([], [span for span in recorder.spans if span.stage == dtkInstrumentation.PARSE])
+            self.assertEqual(2, len(os.listdir(directory)))
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    def test_thread_executor_with_mapped_file(self):
+        async_file = self._open(mapped=True)
+        chunk = self._run(async_file.get_chunk(1))
+        nodes = self._run(*[async_file.get_node(index) for index in range(async_file.node_count)])
+        async_file.close()  # raised BufferError while views of the mapping were still referenced
+        self.assertEqual([1, 2], [node.externalId for node in nodes])
+        self.assertEqual(dtkFileTools.DtkFile(self.filename).get_chunk(1), chunk)
+        return
+
+    def test_process_executor_with_mapped_file(self):
+        executor = concurrent.futures.ProcessPoolExecutor(2)
+        try:
+            async_file = self._open(executor=executor, mapped=True, compact=True)
+            nodes = self._run(*[async_file.get_node(index) for index in range(async_file.node_count)])
+            async_file.close()
+        finally:
+            executor.shutdown()
+        self.assertEqual([1, 2], [node.externalId for node in nodes])
+        self.assertIsInstance(nodes[0], dtkFileTools.CompactObject)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
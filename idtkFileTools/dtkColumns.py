@@ -0,0 +1,488 @@
+#!/usr/bin/python
+
+# Columnar sidecar files for the individualHumans of .dtk node chunks.
+#
+# A sidecar holds each node's individuals as fixed-width arrays, one per numeric field (nested objects are flattened to
+# dotted paths, e.g. 'susceptibility.mod_acquire'), so analysis can map the arrays rather than re-parse node JSON.
+# Lists (infections, waypoints, ...) are stored as an array of per-individual element offsets over their elements'
+# JSON, anything else (strings, nulls, fields some individuals lack) as per-individual JSON.
+#
+# Layout: 'IDTC', 12 character header size, JSON header, then 8 byte aligned data blocks at header-given offsets
+# relative to the first block.
+
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import dtkFileTools
+import dtkJson
+from dtkFileTools import SerialObject
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MAGIC = b'IDTC'
+_VERSION = 1
+_ALIGNMENT = 8
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+try:
+    _INTEGER_TYPES = (int, long)
+except NameError:
+    _INTEGER_TYPES = (int,)     # Python 3
+
+_DTYPES = {'bool': '|b1', 'int': '<i8', 'float': '<f8'}
+_OFFSETS = '<i8'
+
+
+class ColumnFile:
+
+    def __init__(self, filename, source=None, json_backend=None):
+        """
+        Read a columnar sidecar written by write_column_file(), the file is mapped into memory and numeric columns are
+        returned as arrays viewing the mapping (copy them to keep them after close()).
+        :param filename: sidecar filename
+        :param source: .dtk filename the sidecar was written from, if given the sidecar must match its current contents
+        :param json_backend: name of the dtkJson backend used to decode node, list and JSON columns
+        """
+        if numpy is None:
+            raise UserWarning("ColumnFile requires NumPy.")
+        self.filename = filename
+        self.json_backend = dtkJson.get_backend(json_backend)
+        self._handle = open(filename, 'rb')
+        try:
+            magic = self._handle.read(4)
+            if magic != _MAGIC:
+                raise UserWarning("File has incorrect magic 'number': '{0}'".format(magic))
+            header_size = int(self._handle.read(12))
+            dtkFileTools._check_header_size(header_size)
+            self.header = dtkFileTools._try_parse_header_text(self._handle.read(header_size))
+            if self.header.metadata.version != _VERSION:
+                raise UserWarning("Unknown version: {0}".format(self.header.metadata.version))
+            self._mapping = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._handle.close()
+            raise
+        self._data = _aligned(4 + 12 + header_size)
+        self._columns = [OrderedDict(('.'.join(column.path), column) for column in node.columns) for node in self.header.nodes]
+
+        self.nodes = dtkFileTools.DtkNodes(self)
+
+        if source is not None and self.header.metadata.source != _fingerprint(dtkFileTools.DtkFile(source)):
+            self.close()
+            raise UserWarning("Column file '{0}' doesn't match '{1}', rewrite it with write_column_file().".format(filename, source))
+
+        return
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+        return
+
+    def close(self):
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+        return
+
+    @property
+    def node_count(self):
+
+        return len(self.header.nodes)
+
+    def fields(self, node_index):
+        """
+        :param node_index: node index (as for nodes[])
+        :return: list of (field, kind) for the node's columns, kind is one of bool, int, float, list, json or object
+        """
+
+        return [(field, column.kind) for field, column in self._columns[node_index].items()]
+
+    def get_column(self, node_index, field):
+        """
+        :param node_index: node index (as for nodes[])
+        :param field: column name, dotted paths reach into nested objects, e.g. 'susceptibility.mod_acquire'
+        :return: array (a view of the mapped file) for numeric columns, otherwise a list with one value per individual
+        """
+        column = self._column(node_index, field)
+        if column.kind in _DTYPES:
+            return self._array(column.offset, _DTYPES[column.kind], self.header.nodes[node_index].count)
+
+        return self._values(node_index, field.split('.'))
+
+    def get_offsets(self, node_index, field):
+        """
+        :param node_index: node index (as for nodes[])
+        :param field: list column name, e.g. 'infections'
+        :return: array of count + 1 element offsets, individual i has elements offsets[i]:offsets[i+1] (numpy.diff() for lengths)
+        """
+        column = self._column(node_index, field)
+        if column.kind != 'list':
+            raise UserWarning("'{0}' is a {1} column, not a list".format(field, column.kind))
+
+        return self._array(column.offsets, _OFFSETS, self.header.nodes[node_index].count + 1)
+
+    def iter_individuals(self, node_index):
+        """
+        :param node_index: node index (as for nodes[])
+        :return: generator of IndividualHuman objects rebuilt from the columns
+        """
+        for individual in self._build(node_index, []):
+            yield individual
+
+        return
+
+    def individuals_to_arrays(self, fields, nodes=None, structured=False):
+        """
+        Gather individual-level attributes into NumPy arrays, as DtkFile.individuals_to_arrays() but read from columns.
+        :param fields: attribute names, dotted paths reach into nested objects, e.g. 'susceptibility.mod_acquire'
+        :param nodes: node indices (as for nodes[]) to include, defaults to all nodes
+        :param structured: return a structured array rather than a dictionary of columns
+        :return: OrderedDict of field -> array, or structured array with one named field per path
+        """
+        if nodes is None:
+            nodes = range(self.node_count)
+
+        columns = OrderedDict()
+        for field in fields:
+            parts = []
+            for node_index in nodes:
+                column = self._columns[node_index].get(field)
+                if column is not None and column.kind in _DTYPES:
+                    parts.append(self.get_column(node_index, field))
+                else:
+                    parts.append(numpy.array(self._values(node_index, field.split('.'))))
+            columns[field] = numpy.concatenate(parts) if parts else numpy.array([])
+        if not structured:
+            return columns
+
+        array = numpy.empty(len(columns[fields[0]]) if fields else 0, dtype=[(str(field), column.dtype) for field, column in columns.items()])
+        for field, column in columns.items():
+            array[str(field)] = column
+
+        return array
+
+    def get_object(self, index):
+        # Chunk-indexed like DtkFile.get_object() so DtkNodes works, sidecars only hold nodes
+        if index == 0:
+            raise UserWarning("Column files don't contain the simulation, read it from the .dtk file.")
+
+        return SerialObject({'node': self.get_node(index - 1)})
+
+    def get_node(self, node_index):
+        """
+        :param node_index: node index (as for nodes[])
+        :return: node with its individualHumans rebuilt from the columns
+        """
+        block = self.header.nodes[node_index].node
+        node = self._loads(self._bytes(block.offset, block.size))
+        node.individualHumans = list(self.iter_individuals(node_index))
+
+        return node
+
+    def _column(self, node_index, field):
+        column = self._columns[node_index].get(field)
+        if column is None:
+            raise UserWarning("Couldn't find column '{0}' in node {1}".format(field, node_index))
+
+        return column
+
+    def _values(self, node_index, path):
+        # Python values of the attribute at path for each individual of a node
+        columns = self._columns[node_index]
+        field = '.'.join(path)
+        column = columns.get(field)
+        if column is not None and column.kind in _DTYPES:
+            return self.get_column(node_index, field).tolist()
+        if column is not None and column.kind == 'list':
+            return self._decode_list(node_index, column)
+        if column is not None and column.kind == 'json':
+            return self._decode_json(column, self.header.nodes[node_index].count)
+        if column is not None:   # flattened object
+            return list(self._build(node_index, path))
+
+        # Inside a list or JSON column, e.g. 'interventions.interventions.0'
+        for length in range(len(path) - 1, 0, -1):
+            column = columns.get('.'.join(path[:length]))
+            if column is not None and column.kind in ('list', 'json'):
+                return [dtkFileTools._lookup(value, path[length:]) for value in self._values(node_index, path[:length])]
+        raise UserWarning("Couldn't find '{0}' in node {1}".format(field, node_index))
+
+    def _build(self, node_index, prefix):
+        # Rebuild the objects at prefix (the individuals themselves for []) from their columns
+        count = self.header.nodes[node_index].count
+        objects = [SerialObject({}) for _ in range(count)]
+        parents = {(): objects}
+        for field, column in self._columns[node_index].items():
+            path = tuple(column.path)
+            if len(path) <= len(prefix) or list(path[:len(prefix)]) != prefix:
+                continue
+            relative = path[len(prefix):]
+            if column.kind == 'object':
+                children = [SerialObject({}) for _ in range(count)]
+                for parent, child in zip(parents[relative[:-1]], children):
+                    parent[relative[-1]] = child
+                parents[relative] = children
+                continue
+            if column.kind == 'json':
+                values = self._decode_json(column, count)
+                present = self._array(column.present, '|b1', count) if 'present' in column else None
+            else:
+                values = self._values(node_index, list(path))
+                present = None
+            key = relative[-1]
+            for index, (parent, value) in enumerate(zip(parents[relative[:-1]], values)):
+                if present is None or present[index]:
+                    parent[key] = value
+
+        return objects
+
+    def _decode_list(self, node_index, column):
+        count = self.header.nodes[node_index].count
+        offsets = self._array(column.offsets, _OFFSETS, count + 1).tolist()
+        elements = self._loads(b'[' + self._bytes(column.data, column.size) + b']')
+
+        return [elements[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def _decode_json(self, column, count):
+        # Values are stored comma separated, so they decode as one array
+        values = self._loads(b'[' + self._bytes(column.data, column.size) + b']')
+        if len(values) != count:
+            raise UserWarning("Column '{0}' has {1} values for {2} individuals".format('.'.join(column.path), len(values), count))
+
+        return values
+
+    def _array(self, offset, dtype, count):
+
+        return numpy.frombuffer(self._mapping, dtype=dtype, count=count, offset=self._data + offset)
+
+    def _bytes(self, offset, size):
+        start = self._data + offset
+
+        return self._mapping[start:start + size]
+
+    def _loads(self, text):
+
+        return self.json_backend.loads(text, object_hook=SerialObject)
+
+
+def write_column_file(source, filename=None):
+    """
+    Write the individualHumans of every node in a .dtk file to a columnar sidecar, see ColumnFile.
+    :param source: .dtk filename
+    :param filename: sidecar filename, defaults to source + '.columns'
+    :return: sidecar filename
+    """
+    if numpy is None:
+        raise UserWarning("write_column_file() requires NumPy.")
+    if filename is None:
+        filename = source + '.columns'
+
+    dtk_file = dtkFileTools.DtkFile(source)
+    nodes = []
+    data_handle = tempfile.TemporaryFile()
+    try:
+        for node_index in range(dtk_file.node_count):
+            nodes.append(_write_node(dtk_file.nodes[node_index], data_handle))
+
+        header = OrderedDict()
+        header['metadata'] = OrderedDict([('version', _VERSION), ('source', _fingerprint(dtk_file))])
+        header['nodes'] = nodes
+        header_text = dtkFileTools._encode(json.dumps(header, separators=(',', ':')))
+
+        with open(filename, 'wb') as handle:
+            handle.write(_MAGIC)
+            handle.write(dtkFileTools._encode('{:>12}'.format(len(header_text))))
+            handle.write(header_text)
+            handle.write(b'\0' * (_aligned(handle.tell()) - handle.tell()))
+            data_handle.seek(0)
+            shutil.copyfileobj(data_handle, handle)
+    finally:
+        data_handle.close()
+
+    return filename
+
+
+def _write_node(node, handle):
+    individuals = node.individualHumans
+    entry = OrderedDict()
+    entry['externalId'] = node.get('externalId')
+    entry['count'] = len(individuals)
+    entry['node'] = _write_block(handle, _text(OrderedDict((key, value) for key, value in node.items() if key != 'individualHumans')))
+
+    columns = []
+    for path, kind in _layout(individuals):
+        column = OrderedDict([('path', list(path)), ('kind', kind)])
+        if kind == 'object':
+            columns.append(column)
+            continue
+        values = [_find(individual, path) for individual in individuals]
+        if kind in _DTYPES:
+            column['offset'] = _write_block(handle, numpy.array(values, dtype=_DTYPES[kind]).tobytes())['offset']
+        elif kind == 'list':
+            offsets = numpy.cumsum([0] + [len(value) for value in values], dtype=_OFFSETS)
+            column['offsets'] = _write_block(handle, offsets.tobytes())['offset']
+            column.update(_write_block(handle, b','.join(_text(element) for value in values for element in value), 'data'))
+        else:
+            present = [value is not _MISSING for value in values]
+            if not all(present):
+                column['present'] = _write_block(handle, numpy.array(present, dtype='|b1').tobytes())['offset']
+            column.update(_write_block(handle, b','.join(_text(value) if value is not _MISSING else b'null' for value in values), 'data'))
+        columns.append(column)
+    entry['columns'] = columns
+
+    return entry
+
+
+_MISSING = object()
+
+
+def _find(obj, path):
+    for key in path:
+        if not isinstance(obj, dict) or key not in obj:
+            return _MISSING
+        obj = obj[key]
+
+    return obj
+
+
+def _layout(individuals):
+    # Choose a column kind for every attribute path, in order of first appearance. Objects every individual has are
+    # flattened into their attributes, other paths become one column each.
+    kinds = OrderedDict()
+    for individual in individuals:
+        _collect(individual, (), kinds)
+
+    layout = []
+    leaves = set()
+    for path, seen in kinds.items():
+        if any(path[:length] in leaves for length in range(1, len(path))):
+            continue
+        complete = seen['count'] == len(individuals)
+        seen = seen['kinds']
+        if complete and seen == {'object'}:
+            kind = 'object'
+        elif complete and seen == {'bool'}:
+            kind = 'bool'
+        elif complete and seen == {'int'}:
+            kind = 'int'
+        elif complete and seen <= {'int', 'float'}:
+            kind = 'float'  # integral values come back as floats
+        elif complete and seen == {'list'}:
+            kind = 'list'
+        else:
+            kind = 'json'
+        if kind != 'object':
+            leaves.add(path)
+        layout.append((path, kind))
+
+    return layout
+
+
+def _collect(obj, prefix, kinds):
+    for key, value in obj.items():
+        path = prefix + (key,)
+        seen = kinds.get(path)
+        if seen is None:
+            seen = kinds[path] = {'count': 0, 'kinds': set()}
+        seen['count'] += 1
+        kind = _kind(value)
+        seen['kinds'].add(kind)
+        if kind == 'object':
+            _collect(value, path, kinds)
+
+    return
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, _INTEGER_TYPES):
+        return 'int' if _INT64_MIN <= value <= _INT64_MAX else 'other'
+    if isinstance(value, float):
+        return 'float'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'list'
+
+    return 'other'
+
+
+def _text(value):
+
+    return dtkFileTools._encode(json.dumps(value, separators=(',', ':')))
+
+
+def _write_block(handle, data, name='offset'):
+    offset = handle.tell()
+    handle.write(data)
+    handle.write(b'\0' * (_aligned(handle.tell()) - handle.tell()))
+
+    return OrderedDict([(name, offset), ('size', len(data))])
+
+
+def _aligned(offset):
+
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _fingerprint(dtk_file):
+    # Identifies the .dtk contents a sidecar was written from, the header records the write date and chunk sizes
+    source = OrderedDict()
+    source['filename'] = os.path.basename(dtk_file.filename)
+    source['bytecount'] = os.path.getsize(dtk_file.filename)
+    source['header'] = hashlib.sha1(dtkFileTools._encode(dtk_file.header_text)).hexdigest()
+
+    return source
+
+
+def __do_write__(args):
+    filename = write_column_file(args.filename, args.output)
+    print("Wrote '{0}'".format(filename))
+
+    return
+
+
+def __do_fields__(args):
+    with ColumnFile(args.filename) as column_file:
+        for node_index, node in enumerate(column_file.header.nodes):
+            print('Node {0} (externalId {1}, {2} individuals):'.format(node_index, node.externalId, node.count))
+            for field, kind in column_file.fields(node_index):
+                print('  {0:<48}{1}'.format(field, kind))
+
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Columnar sidecar files for .dtk individualHumans.')
+    subparsers = parser.add_subparsers(help='add_subparsers help')
+
+    write_parser = subparsers.add_parser('write', help='Write a column file from a .dtk file')
+    write_parser.add_argument('filename', help='.dtk filename')
+    write_parser.add_argument('-o', '--output', default=None, help='Column filename, defaults to the .dtk filename with .columns appended')
+    write_parser.set_defaults(func=__do_write__)
+
+    fields_parser = subparsers.add_parser('fields', help='List the columns of a column file')
+    fields_parser.add_argument('filename', help='Column filename')
+    fields_parser.set_defaults(func=__do_fields__)
+
+    args = parser.parse_args()
+    args.func(args)
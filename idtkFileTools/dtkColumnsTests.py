@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+import dtkColumns
+import dtkFileTools
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestColumnFiles(unittest.TestCase):
+
+    source = 'test-data/two-node/state-00010.dtk.lz4'
+
+    def setUp(self):
+        temp_handle, self.filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkColumns.write_column_file(self.source, self.filename)
+        return
+
+    def tearDown(self):
+        os.remove(self.filename)
+        return
+
+    def test_nodes_match_source(self):
+        dtk_file = dtkFileTools.DtkFile(self.source)
+        with dtkColumns.ColumnFile(self.filename, source=self.source) as column_file:
+            self.assertEqual(dtk_file.node_count, column_file.node_count)
+            for expected, actual in zip(dtk_file.nodes, column_file.nodes):
+                self.assertEqual(expected, actual)
+            self.assertEqual(list(dtk_file.iter_individuals(1)), list(column_file.iter_individuals(1)))
+            with self.assertRaises(UserWarning):
+                column_file.get_object(0)
+        return
+
+    def test_columns(self):
+        dtk_file = dtkFileTools.DtkFile(self.source)
+        individuals = dtk_file.nodes[0].individualHumans
+        with dtkColumns.ColumnFile(self.filename) as column_file:
+            fields = dict(column_file.fields(0))
+            self.assertEqual('float', fields['m_age'])
+            self.assertEqual('bool', fields['m_is_infected'])
+            self.assertEqual('object', fields['susceptibility'])
+            self.assertEqual('list', fields['infections'])
+            self.assertEqual('json', fields['__class__'])
+            self.assertEqual([individual.m_age for individual in individuals], list(column_file.get_column(0, 'm_age')))
+            self.assertEqual([individual.susceptibility for individual in individuals], column_file.get_column(0, 'susceptibility'))
+            offsets = column_file.get_offsets(0, 'infections')
+            self.assertEqual([len(individual.infections) for individual in individuals], list(offsets[1:] - offsets[:-1]))
+            with self.assertRaises(UserWarning):
+                column_file.get_offsets(0, 'm_age')
+            with self.assertRaises(UserWarning):
+                column_file.get_column(0, 'no_such_field')
+        return
+
+    def test_individuals_to_arrays_matches_dtk_file(self):
+        dtk_file = dtkFileTools.DtkFile(self.source)
+        fields = ['m_age', 'm_gender', 'm_is_infected', 'susceptibility.mod_acquire', 'interventions.__class__']
+        expected = dtk_file.individuals_to_arrays(fields)
+        with dtkColumns.ColumnFile(self.filename) as column_file:
+            actual = column_file.individuals_to_arrays(fields)
+            self.assertEqual(fields, list(actual.keys()))
+            for field in fields:
+                self.assertEqual(list(expected[field]), list(actual[field]))
+            array = column_file.individuals_to_arrays(['m_age', 'suid.id'], nodes=[1], structured=True)
+            self.assertEqual(dtk_file.nodes[1].individualHumans[-1].suid.id, array['suid.id'][-1])
+            with self.assertRaises(UserWarning):
+                column_file.individuals_to_arrays(['susceptibility.no_such_field'])
+        return
+
+    def test_mixed_and_missing_values(self):
+        temp_handle, source = tempfile.mkstemp()
+        os.close(temp_handle)
+        individuals = [{'a': 1, 'b': 2.5, 'c': [], 'd': {'e': 1}, 'f': 'x'},
+                       {'a': 2, 'b': 3, 'c': [{'g': 1}, 2], 'd': None},
+                       {'a': 1 << 70, 'b': True, 'c': [None], 'd': {'e': 2}, 'f': None}]
+        with dtkFileTools.DtkWriter(source) as writer:
+            writer.add_simulation(json.dumps({'simulation': {}}))
+            writer.add_node(json.dumps({'node': {'externalId': 7, 'individualHumans': individuals}}))
+        filename = dtkColumns.write_column_file(source)
+        try:
+            with dtkColumns.ColumnFile(filename, source=source) as column_file:
+                self.assertEqual([('a', 'json'), ('b', 'json'), ('c', 'list'), ('d', 'json'), ('f', 'json')], sorted(column_file.fields(0)))
+                self.assertEqual(individuals, column_file.nodes[0].individualHumans)
+                self.assertEqual(['x', None], column_file.get_column(0, 'f')[::2])
+                with self.assertRaises(UserWarning):
+                    column_file.individuals_to_arrays(['d.e'])
+                self.assertEqual(7, column_file.header.nodes[0].externalId)
+            shutil.copyfile(self.source, source)
+            with self.assertRaises(UserWarning):
+                dtkColumns.ColumnFile(filename, source=source)
+        finally:
+            os.remove(filename)
+            os.remove(source)
+        return
+
+    def test_bad_magic(self):
+        with self.assertRaises(UserWarning):
+            dtkColumns.ColumnFile(self.source)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,179 @@
 
 from __future__ import print_function
 import argparse
+import codecs
+import errno
+import glob
+import hashlib
 import json
 import lz4
+import mmap
 import os
+import re
+import shutil
 import snappy
-import time
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import dtkInstrumentation
+import dtkJson
+from dtkInstrumentation import READ, DECOMPRESS, PARSE, SERIALIZE, COMPRESS, WRITE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# ZstdCompressor/ZstdDecompressor instances aren't thread-safe, each thread keeps its own (see _ZstdEngine._codec())
+_zstd_codecs = threading.local()
+_ZSTD_CODECS = 16   # per thread, a long-running process may meet many files with their own dictionaries
+
+
+class _ZstdEngine:
+
+    scheme = 'ZSTD'
+
+    def __init__(self, level=3, dictionary=None):
+        """
+        :param level: compression level (1-22)
+        :param dictionary: raw zstd dictionary bytes shared by compressor and decompressor, or None
+        """
+        self.level = level
+        self.dictionary = dictionary
+
+        return
+
+    def with_level(self, level):
+
+        return _ZstdEngine(level, self.dictionary)
+
+    def with_dictionary(self, dictionary):
+
+        return _ZstdEngine(self.level, dictionary)
+
+    def compress(self, data):
+
+        return self._codec(True).compress(data)
+
+    def decompress(self, data):
+        try:
+            data = self._codec(False).decompress(data)
+        except zstandard.ZstdError as err:
+            raise ValueError(str(err))
+
+        return data
+
+    def _codec(self, compressor):
+        # Building a compressor (and loading its dictionary) costs as much as compressing a small chunk, and engines
+        # are created per file and per chunk, so codecs are reused for each (level, dictionary).
+        codecs = getattr(_zstd_codecs, 'cache', None)
+        if codecs is None:
+            codecs = _zstd_codecs.cache = {}
+        key = (compressor, self.level if compressor else None, self.dictionary)
+        codec = codecs.get(key)
+        if codec is None:
+            if len(codecs) >= _ZSTD_CODECS:
+                codecs.clear()
+            # older zstandard releases reject dict_data=None
+            kwargs = {'dict_data': zstandard.ZstdCompressionDict(self.dictionary)} if self.dictionary is not None else {}
+            codec = zstandard.ZstdCompressor(level=self.level, **kwargs) if compressor else zstandard.ZstdDecompressor(**kwargs)
+            codecs[key] = codec
+
+        return codec
+
+
+class _Lz4HighCompression:
+
+    scheme = 'LZ4'  # same block format as LZ4, so files stay readable by anything that reads LZ4
+
+    def __init__(self, level=9):
+        """
+        :param level: compression level (lz4 >= 1.0 only, older lz4 has a single high compression mode)
+        """
+        self.level = level
+
+        return
 
+    def with_level(self, level):
 
-__engines__ = {'LZ4': lz4, 'SNAPPY': snappy, 'NONE': None}
+        return _Lz4HighCompression(level)
+
+    def compress(self, data):
+        if hasattr(lz4, 'block'):
+            return lz4.block.compress(data, mode='high_compression', compression=self.level)
+
+        return lz4.compressHC(data)
+
+    def decompress(self, data):
+
+        return lz4.decompress(data)
+
+
+__engines__ = {'LZ4': lz4, 'LZ4HC': _Lz4HighCompression(), 'SNAPPY': snappy, 'NONE': None}
+if zstandard is not None:
+    __engines__['ZSTD'] = _ZstdEngine()
+
+try:
+    # Python 2 mmap objects don't support memoryview, buffer() is the zero-copy equivalent
+    _view = buffer
+except NameError:
+    def _view(mapping, offset, size):
+        return memoryview(mapping)[offset:offset + size]
+
+
+class _Crc32:
+
+    def __init__(self):
+        self.value = 0
+
+        return
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+        return
+
+    def hexdigest(self):
+
+        return '{0:08x}'.format(self.value & 0xffffffff)
+
+
+# Per-chunk checksum algorithms, name -> hash object factory (update()/hexdigest())
+__checksums__ = {'CRC32': _Crc32}
+if xxhash is not None:
+    __checksums__['XXH64'] = xxhash.xxh64
+
+_VERIFY_BLOCK_SIZE = 1 << 20
+
+# Version 3 index footer: (offset, size) per chunk, (externalId, chunk) per node, then the trailer
+_INDEX_CHUNK = struct.Struct('<QQ')
+_INDEX_NODE = struct.Struct('<qI')
+_INDEX_TRAILER = struct.Struct('<QII4s')    # index offset, chunk count, node count, 'IDTX'
+_INDEX_MAGIC = b'IDTX'
+
+# Compression dictionaries are trained on fixed-size pieces of (a sample of) the node JSON
+_DICTIONARY_SIZE = 112640    # zstd's default
+_DICTIONARY_SAMPLE_FILES = 8
+_DICTIONARY_SAMPLE_SIZE = 4096
+_DICTIONARY_SAMPLE_BYTES = 8 << 20  # per sampled file
+
+# Chunks larger than this are split into independently compressed frames (python-snappy can't handle 2 GB at once)
+_FRAME_SIZE = 1 << 30
 
 
 class _Class:
@@ -26,45 +190,489 @@ class SerialObject(dict):
         self.__dict__ = self
         pass
 
+    def __getstate__(self):
+        # Items are pickled as for any dict, __setstate__() restores attribute/item aliasing. Default pickling
+        # would restore __dict__ as a separate copy, and calling __init__ per object is much slower to unpickle.
+        return True
+
+    def __setstate__(self, state):
+        self.__dict__ = self
+        return
+
     pass
 
 
+class _Schema(object):
+    __slots__ = ('keys', 'indices')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.indices = dict((key, index) for index, key in enumerate(keys))
+
+        return
+
+
+_schemas = {}   # tuple of keys -> _Schema, shared by every CompactObject with those keys
+
+
+def _schema_for(keys):
+    schema = _schemas.get(keys)
+    if schema is None:
+        schema = _schemas[keys] = _Schema(keys)
+
+    return schema
+
+
+class CompactObject(object):
+    """
+    Memory-lean alternative to SerialObject. Objects with the same keys (e.g. every IndividualHuman) share
+    one _Schema, each object only stores a list of values. Supports attribute and item access.
+    """
+
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, pairs=()):
+        pairs = list(pairs)
+        object.__setattr__(self, '_schema', _schema_for(tuple(key for key, _ in pairs)))
+        object.__setattr__(self, '_values', [value for _, value in pairs])
+
+        return
+
+    def __getattr__(self, name):
+        index = self._schema.indices.get(name)
+        if index is None:
+            raise AttributeError(name)
+
+        return self._values[index]
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+        return
+
+    def __getitem__(self, key):
+        index = self._schema.indices.get(key)
+        if index is None:
+            raise KeyError(key)
+
+        return self._values[index]
+
+    def __setitem__(self, key, value):
+        index = self._schema.indices.get(key)
+        if index is None:
+            object.__setattr__(self, '_schema', _schema_for(self._schema.keys + (key,)))
+            self._values.append(value)
+        else:
+            self._values[index] = value
+
+        return
+
+    def __contains__(self, key):
+
+        return key in self._schema.indices
+
+    def __len__(self):
+
+        return len(self._values)
+
+    def __iter__(self):
+
+        return iter(self._schema.keys)
+
+    def keys(self):
+
+        return list(self._schema.keys)
+
+    def values(self):
+
+        return list(self._values)
+
+    def items(self):
+
+        return list(zip(self._schema.keys, self._values))
+
+    def get(self, key, default=None):
+        index = self._schema.indices.get(key)
+
+        return default if index is None else self._values[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (CompactObject, dict)):
+            return dict(self.items()) == dict(other.items())
+
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+        # Objects sharing a schema share its keys tuple, so the pickler writes it once and memoizes it
+
+        return self._schema.keys, self._values
+
+    def __setstate__(self, state):
+        keys, values = state
+        object.__setattr__(self, '_schema', _schema_for(keys))
+        object.__setattr__(self, '_values', values)
+
+        return
+
+
 class DtkNodes:
 
-    def __init__(self, dtk_file):
+    def __init__(self, dtk_file, fields=None):
+        """
+        :param dtk_file: DtkFile
+        :param fields: node attributes to keep, see project()
+        """
         self._dtk_file = dtk_file
+        self._fields = ['node.' + field for field in fields] if fields is not None else None
+
+        return
+
+    def project(self, fields):
+        """
+        :param fields: node attributes to keep, e.g. ['externalId', 'individualHumans.m_age'], see DtkFile.get_object()
+        :return: DtkNodes whose nodes only have the given attributes
+        """
+
+        return DtkNodes(self._dtk_file, fields)
+
+    def __len__(self):
+
+        return self._dtk_file.node_count
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
         return
 
     def __getitem__(self, index):
-        node = self._dtk_file.get_object(index + 1).node
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Node index out of range")
+        if self._fields is None:
+            node = self._dtk_file.get_object(index + 1).node
+        else:
+            node = self._dtk_file.get_object(index + 1, fields=self._fields).node
 
         return node
 
 
+class _ObjectCache:
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()   # chunk index -> (object, size), least recently used first
+
+        return
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def get(self, index):
+        entry = self._entries.pop(index, None)
+        if entry is None:
+            return None
+        self._entries[index] = entry
+
+        return entry[0]
+
+    def put(self, index, obj, size):
+        if index in self._entries:
+            self.bytes -= self._entries.pop(index)[1]
+        self._entries[index] = (obj, size)
+        self.bytes += size
+        while self._entries and self._over_budget():
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+        return
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+        return
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            return True
+
+        return False
+
+
+class _DiskCache:
+    """
+    Decoded chunks pickled to a directory shared by every process opening the same files. Entries are written to a
+    temporary file and renamed into place, so readers never see a partial entry, and are touched when read so eviction
+    (oldest first, once the directory exceeds max_bytes) approximates least recently used.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        # Unpickling an entry can run arbitrary code, only trust a directory no one else can write to
+        status = os.stat(directory)
+        if hasattr(os, 'getuid') and (status.st_uid != os.getuid() or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            raise UserWarning("Cache directory '{0}' must belong to the current user and not be writable by others".format(directory))
+
+        return
+
+    def get(self, key):
+        """
+        :param key: entry name
+        :return: (object, decoded size) or None if there is no entry
+        """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as handle:
+                entry = pickle.load(handle)
+        except (IOError, OSError):
+            return None     # not cached, or evicted by another process
+        except Exception:
+            self._remove(filename)  # unreadable, e.g. written by an incompatible version
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def put(self, key, obj, size):
+        temp_handle, temp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(temp_handle, 'wb') as handle:
+                pickle.dump((obj, size), handle, pickle.HIGHEST_PROTOCOL)
+            if os.name == 'nt' and os.path.exists(self._filename(key)):
+                os.remove(temp_filename)    # rename won't replace on Windows, another process cached it first
+            else:
+                os.rename(temp_filename, self._filename(key))
+        except Exception:
+            self._remove(temp_filename)
+            raise
+        if self.max_bytes is not None:
+            self._evict()
+
+        return
+
+    def clear(self):
+        for filename, _, _ in self._entries():
+            self._remove(filename)
+
+        return
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for filename, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(filename)
+            total -= size
+
+        return
+
+    def _entries(self):
+        # (filename, size, last used) for each entry, skipping any removed while listing
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pickle'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                status = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((filename, status.st_size, status.st_mtime))
+
+        return entries
+
+    def _filename(self, key):
+
+        return os.path.join(self.directory, key + '.pickle')
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+        return
+
+
 class DtkFile:
 
-    def __init__(self, filename):
+    def __init__(self, filename, mapped=False, cache_entries=None, cache_bytes=None, compact=False, json_backend=None, cache_dir=None,
+                 cache_dir_bytes=None):
+        """
+        :param filename: DTK serialized population filename
+        :param mapped: map the file into memory once and return zero-copy views of chunks from get_chunk(), see close()
+        :param cache_entries: cache up to this many decoded objects from get_object() (LRU eviction)
+        :param cache_bytes: cache decoded objects up to this many bytes of decompressed JSON (LRU eviction)
+        :param compact: decode chunks into CompactObjects rather than SerialObjects
+        :param json_backend: name of the dtkJson backend used to parse chunks, defaults to dtkJson's configured default
+        :param cache_dir: keep decoded objects from get_object() in this directory, shared between processes and later
+                          opens of the file. Entries are unpickled, so the directory must belong to the current user
+                          and not be writable by others.
+        :param cache_dir_bytes: evict the least recently used objects from cache_dir beyond this many bytes
+        """
         self.filename = filename
+        self.compact = compact
+        self.json_backend = dtkJson.get_backend(json_backend)
+        self.node_ids = None
         with open(self.filename, 'rb') as handle:
             _check_magic(handle)
             self.header_text, self.header = _read_header(handle)
+            if self.header.metadata.version >= 3:
+                self.chunk_info, self.node_ids = _read_index(handle)
 
-        self.scheme = self.header.metadata.engine.upper()
-        if self.scheme not in __engines__:
-            raise UserWarning("File's compression engine ('{0}') is unknown.".format(self.header.metadata.engine))
+        self.scheme = _check_engine(self.header.metadata.engine)
         self.engine = __engines__[self.scheme]
 
-        self.chunk_info = []
-        offset = 4 + 12 + len(self.header_text)  # 'IDTK' + size + header
-        for size in self.header.metadata.chunksizes:
-            self.chunk_info.append(_Class({'offset': offset, 'size': size}))
-            offset += size
+        if self.node_ids is None:
+            self.chunk_info = []
+            offset = 4 + 12 + len(self.header_text)  # 'IDTK' + size + header
+            for size in self.header.metadata.chunksizes:
+                self.chunk_info.append(_Class({'offset': offset, 'size': size}))
+                offset += size
+
+        # Optional per-chunk engines, e.g. a small simulation chunk compressed differently from the nodes
+        if 'chunkengines' in self.header.metadata:
+            if len(self.header.metadata.chunkengines) != self.chunk_count:
+                raise UserWarning("Header lists {0} chunk engines for {1} chunks".format(len(self.header.metadata.chunkengines), self.chunk_count))
+            self.chunk_schemes = [_check_engine(scheme) for scheme in self.header.metadata.chunkengines]
+        else:
+            self.chunk_schemes = [self.scheme] * self.chunk_count
+
+        # Optional compressed frame sizes of block-split chunks, chunk index -> [size, ...]
+        self.chunk_frames = dict((int(index), frames) for index, frames in self.header.metadata.get('chunkframes', {}).items())
+        for index, frames in self.chunk_frames.items():
+            if index >= self.chunk_count or sum(frames) != self.chunk_info[index].size:
+                raise UserWarning("Frame sizes for chunk {0} don't match the chunk size".format(index))
+
+        # Optional per-chunk checksums of the stored (compressed) bytes, see verify()
+        self.checksum = self.header.metadata.get('checksum')
+        self.chunk_checksums = self.header.metadata.get('chunkchecksums')
+        if self.chunk_checksums is not None and len(self.chunk_checksums) != self.chunk_count:
+            raise UserWarning("Header lists {0} checksums for {1} chunks".format(len(self.chunk_checksums), self.chunk_count))
+
+        # Optional delta chunks, chunk index -> base file chunk index, see _delta_contents()
+        self.chunk_deltas = dict((int(index), base_index) for index, base_index in self.header.metadata.get('chunkdeltas', {}).items())
+        if self.chunk_deltas and 'base' not in self.header.metadata:
+            raise UserWarning("Header lists delta chunks but no base file")
+        self._base = None
 
         self.nodes = DtkNodes(self)
 
+        self._handle = None
+        self._mapping = None
+        if mapped:
+            self._handle = open(self.filename, 'rb')
+            self._mapping = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Optional trained compression dictionary, stored uncompressed as the last chunk
+        self.dictionary_chunk = self.header.metadata.get('dictionary')
+        self.dictionary = None
+        if self.dictionary_chunk is not None:
+            if self.dictionary_chunk != self.chunk_count - 1:
+                raise UserWarning("Dictionary chunk {0} is not the last chunk".format(self.dictionary_chunk))
+            self.dictionary = bytes(self.get_chunk(self.dictionary_chunk))
+        self._chunk_engines = [_resolve_engine(scheme, self.dictionary)[1] for scheme in self.chunk_schemes]
+
+        # Cached objects are shared between callers, changes to one are seen by the next get_object().
+        self._cache = None
+        if cache_entries is not None or cache_bytes is not None:
+            self._cache = _ObjectCache(cache_entries, cache_bytes)
+
+        # Persistent cache of decoded objects, keyed by file identity, chunk location and checksum, see _disk_key()
+        self._disk_cache = None
+        if cache_dir:
+            self._disk_cache = _DiskCache(cache_dir, cache_dir_bytes)
+            status = os.stat(self.filename)
+            self._identity = [os.path.realpath(self.filename), status.st_size, status.st_mtime, status.st_ino]
+
+        return
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
         return
 
+    @property
+    def mapped(self):
+
+        return self._mapping is not None
+
+    def close(self):
+        """
+        Close the file. Chunks from a mapped file are views of the mapping. On Python 3 a view still referenced when
+        the file is closed stays valid, the mapping is unmapped once the last of them is released. Python 2 buffers
+        of a closed mapping can't be read.
+        :return: None
+        """
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                pass    # exported views keep the mmap object alive, it unmaps itself when they are gone
+            self._mapping = None
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._base is not None:
+            self._base.close()
+            self._base = None
+
+        return
+
+    @property
+    def base(self):
+        """
+        :return: DtkFile this (delta) file's delta chunks refer to, opened on first use, None for self-contained files
+        """
+        if self._base is None and 'base' in self.header.metadata:
+            reference = self.header.metadata.base
+            filename = os.path.join(os.path.dirname(self.filename), reference.filename)
+            if not os.path.exists(filename):
+                raise UserWarning("Base file '{0}' of delta file '{1}' not found".format(filename, self.filename))
+            base = DtkFile(filename, mapped=self.mapped)
+            if _base_reference(base, self.filename)['header'] != reference.header:
+                base.close()
+                raise UserWarning("Base file '{0}' has changed since delta file '{1}' was written".format(filename, self.filename))
+            self._base = base
+
+        return self._base
+
     @property
     def chunk_count(self):
 
@@ -73,31 +681,321 @@ class DtkFile:
     @property
     def node_count(self):
 
-        return self.chunk_count - 1
+        return self.chunk_count - (2 if self.dictionary_chunk is not None else 1)
 
     def get_chunk(self, index):
-        with open(self.filename, 'rb') as handle:
-            handle.seek(self.chunk_info[index].offset)
-            chunk = handle.read(self.chunk_info[index].size)
+        with dtkInstrumentation.span(READ, index) as span:
+            chunk = self._read(index, self.chunk_info[index].offset, self.chunk_info[index].size)
+            span.bytes = len(chunk)
+
+        return chunk
+
+    def _read(self, index, offset, size):
+        if self._mapping is None:
+            with open(self.filename, 'rb') as handle:
+                handle.seek(offset)
+                return handle.read(size)
+
+        if offset + size > len(self._mapping):
+            raise UserWarning("Chunk {0} extends past end of file (truncated?)".format(index))
+        chunk = _view(self._mapping, offset, size)
 
         return chunk
 
-    def get_contents(self, index):
+    def get_engine(self, index):
+        """
+        :param index: chunk index
+        :return: compression engine for the chunk, None if the chunk is not compressed
+        """
+
+        return self._chunk_engines[index]
+
+    def get_contents(self, index, workers=None):
+        """
+        :param index: chunk index
+        :param workers: decompress the frames of a block-split chunk on this many threads
+        :return: decompressed chunk
+        """
         contents = self.get_chunk(index)
-        if self.engine:
-            try:
-                contents = self.engine.decompress(contents)
-            except ValueError as err:
-                raise UserWarning("Couldn't decompress chunk - '{0}'".format(err))
+        engine = self.get_engine(index)
+        if engine:
+            with dtkInstrumentation.span(DECOMPRESS, index) as span:
+                contents = _decompress_frames(engine, contents, self.chunk_frames.get(index), workers)
+                span.bytes = len(contents)
+
+        if index in self.chunk_deltas:
+            base_contents = self.base.get_contents(self.chunk_deltas[index], workers)
+            with dtkInstrumentation.span(DECOMPRESS, index, label='apply delta') as span:
+                contents = _apply_delta(contents, base_contents)
+                span.bytes = len(contents)
 
         return contents
 
-    def get_object(self, index):
-        contents = self.get_contents(index)
-        obj = json.loads(contents, object_hook=SerialObject)
+    def iter_contents(self, index):
+        """
+        Decompress a chunk one frame at a time, reading each frame from the file as it is needed, so peak memory
+        is one frame rather than the whole chunk. A chunk which isn't block-split is a single frame.
+        :param index: chunk index
+        :return: generator of decompressed frames
+        """
+        if index in self.chunk_deltas:
+            yield self.get_contents(index)     # delta chunks are rebuilt whole from the base chunk
+            return
+
+        engine = self.get_engine(index)
+        offset = self.chunk_info[index].offset
+        for size in self.chunk_frames.get(index, [self.chunk_info[index].size]):
+            with dtkInstrumentation.span(READ, index) as span:
+                frame = self._read(index, offset, size)
+                span.bytes = len(frame)
+            if engine:
+                with dtkInstrumentation.span(DECOMPRESS, index) as span:
+                    frame = _decompress(engine, frame)
+                    span.bytes = len(frame)
+            yield frame
+            offset += size
+
+        return
+
+    def get_object(self, index, fields=None):
+        """
+        :param index: chunk index
+        :param fields: keep only these attributes, dotted paths from the chunk's top level which apply to every
+                       element of the arrays they pass through, e.g. ['node.externalId', 'node.individualHumans.m_age'].
+                       The whole chunk is still decoded, but only the wanted attributes are kept as objects.
+                       Projected objects are not cached.
+        :return: decoded chunk
+        """
+        if fields is not None:
+            contents = self.get_contents(index)
+            with dtkInstrumentation.span(PARSE, index, label='parse fields') as span:
+                obj = _parse_fields(contents, fields, self.compact)
+                span.bytes = len(contents)
+            return obj
+
+        if self._cache is not None:
+            obj = self._cache.get(index)
+            if obj is not None:
+                return obj
+
+        entry = None
+        if self._disk_cache is not None:
+            key = self._disk_key(index)
+            with dtkInstrumentation.span(READ, index, label='read cache'):
+                entry = self._disk_cache.get(key)
+
+        if entry is not None:
+            obj, size = entry
+        else:
+            contents = self.get_contents(index)
+            with dtkInstrumentation.span(PARSE, index) as span:
+                obj = _parse(contents, self.compact, self.json_backend)
+                span.bytes = len(contents)
+            size = len(contents)
+            if self._disk_cache is not None:
+                with dtkInstrumentation.span(WRITE, index, label='write cache'):
+                    self._disk_cache.put(key, obj, size)
+
+        if self._cache is not None:
+            self._cache.put(index, obj, size)
 
         return obj
 
+    def _disk_key(self, index):
+        # The recorded checksum distinguishes rewrites the file's size and modification time might not
+        checksum = self.chunk_checksums[index] if self.chunk_checksums is not None else None
+        parts = self._identity + [self.chunk_info[index].offset, self.chunk_info[index].size, self.checksum, checksum,
+                                  self.compact, sys.version_info[0]]
+
+        return hashlib.sha1(_encode(json.dumps(parts))).hexdigest()
+
+    def verify(self, workers=None):
+        """
+        Check that every chunk lies within the file and matches its checksum, if the header records checksums.
+        Chunks are neither decompressed nor parsed.
+        :param workers: number of processes checking chunks concurrently, defaults to checking in this process
+        :return: list of (chunk index, problem) tuples, empty if the file is intact
+        """
+        if self.checksum is not None and self.checksum not in __checksums__:
+            raise UserWarning("Checksum algorithm '{0}' is unknown or not installed.".format(self.checksum))
+        file_size = os.path.getsize(self.filename)
+        checksums = self.chunk_checksums if self.chunk_checksums is not None else [None] * self.chunk_count
+        tasks = [(index, self.filename, file_size, info.offset, info.size, self.checksum, checksum)
+                 for index, (info, checksum) in enumerate(zip(self.chunk_info, checksums))]
+        if workers is not None and workers > 1:
+            pool = _process_pool(workers)
+            try:
+                results = list(dtkInstrumentation.from_workers(pool.map(dtkInstrumentation.in_workers(_verify_chunk), tasks)))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [_verify_chunk(task) for task in tasks]
+
+        return [result for result in results if result is not None]
+
+    def extract(self, filename, indices=None, external_ids=None, version=None):
+        """
+        Write a new file containing the simulation and a subset of the nodes. Chunks are copied as stored (compressed),
+        only the header is rebuilt.
+        :param filename: output .dtk filename
+        :param indices: node indices (as for nodes[]) to copy, each at most once
+        :param external_ids: node externalIds to copy, instead of indices, each at most once
+        :param version: file format version {2|3}, defaults to this file's version
+        :return: None
+        """
+        if external_ids is not None:
+            indices = [self._node_index(external_id) for external_id in external_ids]
+        if indices is None:
+            raise UserWarning("Specify node indices or external ids to extract.")
+        indices = [index + self.node_count if index < 0 else index for index in indices]
+        for index in indices:
+            if index < 0 or index >= self.node_count:
+                raise IndexError("Node index out of range")
+        if len(set(indices)) != len(indices):
+            raise UserWarning("Each node can only be extracted once.")
+
+        with _copy_writer(filename, [self], version) as writer:
+            _copy_chunk(self, 0, writer)
+            chunk_ids = _chunk_ids(self)
+            for index in indices:
+                _copy_chunk(self, index + 1, writer, chunk_ids)
+
+        return
+
+    def _node_index(self, external_id):
+        if self.node_ids is not None:
+            if external_id not in self.node_ids:
+                raise KeyError(external_id)
+            return self.node_ids[external_id] - 1
+
+        for index in range(self.node_count):
+            if _find_external_id(self.get_contents(index + 1)) == external_id:
+                return index
+
+        raise KeyError(external_id)
+
+    def get_node_by_id(self, external_id):
+        """
+        :param external_id: node externalId
+        :return: node, found with the version 3 index if present, otherwise by decoding nodes in order
+        """
+        if self.node_ids is not None:
+            if external_id not in self.node_ids:
+                raise KeyError(external_id)
+            return self.get_object(self.node_ids[external_id]).node
+
+        for node in self.nodes:
+            if node.externalId == external_id:
+                return node
+
+        raise KeyError(external_id)
+
+    def iter_individuals(self, node_index):
+        """
+        Decode the individualHumans of a node one at a time rather than building the whole node. The chunk is
+        decompressed a frame at a time (see iter_contents()), so only about one frame of text is held at once, the
+        whole chunk if it isn't block-split.
+        :param node_index: node index (as for nodes[])
+        :return: generator of IndividualHuman objects
+        """
+        for individual in _iter_array_frames(self.iter_contents(node_index + 1), 'individualHumans', self.compact):
+            yield individual
+
+        return
+
+    def individuals_to_arrays(self, fields, nodes=None, structured=False):
+        """
+        Gather individual-level attributes into NumPy arrays, one pass over each node's individualHumans.
+        :param fields: attribute names, dotted paths reach into nested objects, e.g. 'susceptibility.mod_acquire'
+        :param nodes: node indices (as for nodes[]) to include, defaults to all nodes
+        :param structured: return a structured array rather than a dictionary of columns
+        :return: OrderedDict of field -> array, or structured array with one named field per path
+        """
+        try:
+            import numpy    # imported here, it takes longer to import than the rest of this module
+        except ImportError:
+            raise UserWarning("individuals_to_arrays() requires NumPy.")
+        if nodes is None:
+            nodes = range(self.node_count)
+
+        paths = [field.split('.') for field in fields]
+        values = [[] for _ in fields]
+        for node_index in nodes:
+            for individual in self.iter_individuals(node_index):
+                for path, column in zip(paths, values):
+                    column.append(_lookup(individual, path))
+
+        columns = OrderedDict((field, numpy.array(column)) for field, column in zip(fields, values))
+        if not structured:
+            return columns
+
+        array = numpy.empty(len(values[0]) if values else 0, dtype=[(str(field), column.dtype) for field, column in columns.items()])
+        for field, column in columns.items():
+            array[str(field)] = column
+
+        return array
+
+    def clear_cache(self, disk=False):
+        """
+        :param disk: also remove every object from the cache_dir, including those of other files
+        :return: None
+        """
+        if self._cache is not None:
+            self._cache.clear()
+        if disk and self._disk_cache is not None:
+            self._disk_cache.clear()
+
+        return
+
+    def load_nodes(self, indices=None, workers=None, executor='process', ordered=True):
+        """
+        Decompress and parse node chunks on a pool of workers.
+        :param indices: node indices (as for nodes[]) to load, defaults to all nodes
+        :param workers: pool size, defaults to the number of CPUs
+        :param executor: 'process' decompresses and parses in worker processes,
+                         'thread' decompresses in worker threads and parses on the calling thread
+        :param ordered: yield nodes in the order of indices (True) or as they complete (False)
+        :return: generator of (index, node) tuples
+        """
+        if indices is None:
+            indices = range(self.node_count)
+        if executor == 'process' and self.chunk_deltas:
+            # Workers open the file themselves, so they can rebuild delta chunks from the base file
+            pool = _process_pool(workers)
+            tasks = [(index, self.filename, self.compact, self.json_backend.name) for index in indices]
+            function = _load_delta_node
+        elif executor == 'process':
+            pool = _process_pool(workers)
+            tasks = [(index, self.filename, self.chunk_info[index + 1].offset, self.chunk_info[index + 1].size, self.chunk_schemes[index + 1], self.dictionary, self.chunk_frames.get(index + 1), self.compact, self.json_backend.name) for index in indices]
+            function = _load_node
+        elif executor == 'thread':
+            pool = _thread_pool(workers)
+            tasks = indices
+            function = self._load_node_contents
+        else:
+            raise UserWarning("Unknown executor '{0}', expected 'process' or 'thread'".format(executor))
+
+        try:
+            if executor == 'process':
+                function = dtkInstrumentation.in_workers(function)
+            results = pool.imap(function, tasks) if ordered else pool.imap_unordered(function, tasks)
+            for index, result in dtkInstrumentation.from_workers(results):
+                if executor == 'thread':
+                    result = _parse(result, self.compact, self.json_backend).node
+                yield index, result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return
+
+    def _load_node_contents(self, index):
+
+        return index, self.get_contents(index + 1)
+
     @property
     def sim(self):
         sim = self.get_object(0).simulation
@@ -105,9 +1003,636 @@ class DtkFile:
         return sim
 
 
+class DtkWriter:
+
+    def __init__(self, filename, author=None, tool=None, engine='LZ4', compress=True, version=2, dictionary=None, frame_size=_FRAME_SIZE,
+                 checksum='CRC32', base=None):
+        """
+        Streams chunks to a temporary spool next to the output file, so only one chunk is held in memory.
+        The header (which precedes the payload) and the spooled chunks are written to filename on close().
+        :param filename: output .dtk filename
+        :param author: author name for metadata
+        :param tool: tool name for metadata
+        :param engine: compression engine {NONE|LZ4|LZ4HC|SNAPPY|ZSTD}, optionally with a level, e.g. 'ZSTD:19'
+        :param compress: compress (or don't) chunks in resulting file
+        :param version: file format version, 3 adds an index of chunk offsets and node ids after the chunks
+        :param dictionary: compression dictionary (see train_dictionary()) used for ZSTD chunks and stored in the file
+        :param frame_size: chunks larger than this are split into independently compressed frames of this size
+        :param checksum: per-chunk checksum algorithm {CRC32|XXH64}, None to omit checksums
+        :param base: .dtk filename of an earlier checkpoint, nodes are written as deltas against its nodes where smaller
+        """
+        _check_version(version)
+        if version < 2:
+            raise UserWarning("DtkWriter can't write version {0} files".format(version))
+        if base is not None and os.path.abspath(base) == os.path.abspath(filename):
+            raise UserWarning("A delta file can't be its own base file")
+        self.filename = filename
+        self.version = version
+        self.author = author
+        self.tool = tool
+        self.compress = compress
+        self.frame_size = frame_size
+        self.checksum = checksum.upper() if checksum is not None else None
+        if self.checksum is not None and self.checksum not in __checksums__:
+            raise UserWarning("Unknown checksum algorithm '{0}'".format(checksum))
+        self.dictionary = dictionary if compress else None
+        self.scheme, self.engine = _resolve_engine(engine if compress else 'NONE', self.dictionary)
+        if self.dictionary is not None and not hasattr(self.engine, 'with_dictionary'):
+            raise UserWarning("Compression engine '{0}' doesn't support dictionaries".format(engine))
+
+        self._simulation = None     # the simulation chunk is small, keep it until close() so it can be chunk 0
+        self._simulation_scheme = None
+        self._chunk_sizes = []
+        self._chunk_schemes = []
+        self._chunk_frames = {}
+        self._chunk_checksums = []
+        self._node_ids = []
+        self._added_ids = set()     # node externalIds given or found so far, a node can only be added once
+        self._chunk_deltas = {}
+        self.base = DtkFile(base) if base is not None else None
+        self._base_chunks = None
+        self._spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+
+        return
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+        return
+
+    def add_simulation(self, data, compressed=False, engine=None, frames=None):
+        """
+        :param data: simulation JSON
+        :param compressed: data has already been compressed with this writer's engine (or engine, if given)
+        :param engine: compression engine for this chunk, defaults to the writer's engine (ignored if compress=False)
+        :param frames: compressed frame sizes, if compressed data was block-split (see _compress_frames())
+        """
+        self._check_open()
+        if self._simulation is not None:
+            raise UserWarning("Simulation data has already been added.")
+        scheme, engine = self._chunk_engine(engine)
+        if not compressed:
+            data, frames = self._compress(data, 0, engine)
+        self._simulation = data
+        self._simulation_scheme = scheme
+        if frames is not None:
+            self._chunk_frames[0] = list(frames)
+
+        return
+
+    def add_node(self, data, compressed=False, node_id=None, engine=None, frames=None, base_chunk=None):
+        """
+        :param data: node JSON
+        :param compressed: data has already been compressed with this writer's engine (or engine, if given)
+        :param node_id: node externalId for the version 3 index, found in (uncompressed) data if not given.
+                        Raises ValueError if a node with this externalId has already been added.
+        :param engine: compression engine for this chunk, defaults to the writer's engine (ignored if compress=False)
+        :param frames: compressed frame sizes, if compressed data was block-split (see _compress_frames())
+        :param base_chunk: compressed data is a delta (see _delta_contents()) against this chunk of the base file,
+                           uncompressed data is made a delta here if the writer has a base file
+        """
+        self._check_open()
+        if base_chunk is not None and self.base is None:
+            raise UserWarning("Delta chunks need a writer with a base file")
+        if self.version >= 3:
+            if node_id is None and not compressed:
+                node_id = _find_external_id(data)
+            if node_id is None:
+                raise UserWarning("Node externalId required for version {0} files".format(self.version))
+        if node_id is not None:
+            if node_id in self._added_ids:
+                raise ValueError("Node {0} has already been added to '{1}'".format(node_id, self.filename))
+            self._added_ids.add(node_id)
+        if self.version >= 3:
+            self._node_ids.append(node_id)
+        if self.base is not None and not compressed:
+            if self._base_chunks is None:
+                self._base_chunks = _node_chunks(self.base)
+            data, base_chunk = _delta_contents(data, self.base, self._base_chunks)
+        index = len(self._chunk_sizes) + 1
+        scheme, engine = self._chunk_engine(engine)
+        chunk = data
+        if not compressed:
+            chunk, frames = self._compress(data, index, engine)
+        with dtkInstrumentation.span(WRITE, index) as span:
+            self._spool.write(chunk)
+            span.bytes = len(chunk)
+        self._chunk_sizes.append(len(chunk))
+        self._chunk_checksums.append(self._checksum(chunk))
+        self._chunk_schemes.append(scheme)
+        if frames is not None:
+            self._chunk_frames[index] = list(frames)
+        if base_chunk is not None:
+            self._chunk_deltas[index] = base_chunk
+
+        return
+
+    def close(self):
+        if self._spool is None:
+            return
+        if self._simulation is None:
+            self.abort()
+            raise UserWarning("No simulation data added to '{0}'.".format(self.filename))
+
+        # ConstructHeader(scheme, scheme_name, total, chunk_sizes, header);
+        chunk_sizes = [len(self._simulation)] + self._chunk_sizes
+        chunk_schemes = [self._simulation_scheme] + self._chunk_schemes
+        chunk_checksums = [self._checksum(self._simulation)] + self._chunk_checksums
+        dictionary_chunk = None
+        if self.dictionary is not None:
+            dictionary_chunk = len(chunk_sizes)
+            chunk_sizes.append(len(self.dictionary))
+            chunk_schemes.append('NONE')
+            chunk_checksums.append(self._checksum(self.dictionary))
+        base = _base_reference(self.base, self.filename) if self.base is not None else None
+        header = _construct_header(self.author, self.tool, self.scheme, chunk_sizes, self.version, chunk_schemes, dictionary_chunk,
+                                   self._chunk_frames, self.checksum, chunk_checksums, base, self._chunk_deltas)
+        header_string = json.dumps(header, indent=None, separators=(',', ':'))
+
+        with open(self.filename, 'wb') as handle, dtkInstrumentation.span(WRITE, label='write file') as span:
+            _write_magic_number(handle)
+            _write_header_size(len(header_string), handle)
+            _write_header(header_string, handle)
+            handle.write(self._simulation)
+            self._spool.seek(0)
+            shutil.copyfileobj(self._spool, handle)
+            if self.dictionary is not None:
+                handle.write(self.dictionary)
+            if self.version >= 3:
+                _write_index(4 + 12 + len(header_string), chunk_sizes, self._node_ids, handle)
+            span.bytes = handle.tell()
+
+        self.abort()
+
+        return
+
+    def abort(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self.base is not None:
+            self.base.close()
+        self._simulation = None
+
+        return
+
+    def _check_open(self):
+        if self._spool is None:
+            raise UserWarning("Writer for '{0}' is closed.".format(self.filename))
+
+        return
+
+    def _checksum(self, chunk):
+        if self.checksum is None:
+            return None
+
+        return _checksum(self.checksum, chunk)
+
+    def _chunk_engine(self, engine):
+        if engine is None or not self.compress:
+            return self.scheme, self.engine
+
+        return _resolve_engine(engine, self.dictionary)
+
+    def _compress(self, data, index, engine):
+        frames = None
+        if engine is not None:
+            with dtkInstrumentation.span(COMPRESS, index) as span:
+                span.bytes = len(data)
+                data, frames = _compress_frames(engine, data, self.frame_size)
+
+        return data, frames
+
+
+def _resolve_engine(spec, dictionary=None):
+    """
+    :param spec: engine name, optionally followed by a compression level, e.g. 'LZ4', 'ZSTD:19' or 'LZ4HC:12'
+    :param dictionary: compression dictionary, applied to engines which support one
+    :return: (scheme, engine), scheme is the engine name recorded in the header
+    """
+    name, _, level = spec.upper().partition(':')
+    if name not in __engines__:
+        raise UserWarning("Unknown compression engine '{0}'".format(spec))
+    engine = __engines__[name]
+    if level:
+        if not hasattr(engine, 'with_level'):
+            raise UserWarning("Compression engine '{0}' doesn't support levels".format(name))
+        try:
+            engine = engine.with_level(int(level))
+        except ValueError:
+            raise UserWarning("Invalid compression level '{0}'".format(level))
+    if dictionary is not None and hasattr(engine, 'with_dictionary'):
+        engine = engine.with_dictionary(dictionary)
+
+    return getattr(engine, 'scheme', name), engine
+
+
+def train_dictionary(samples, size=_DICTIONARY_SIZE):
+    """
+    Train a zstd compression dictionary, e.g. over node JSON which repeats the same IndividualHuman keys.
+    :param samples: JSON texts to train on, each is cut into small pieces
+    :param size: maximum dictionary size in bytes
+    :return: raw dictionary bytes for DtkWriter(dictionary=...)
+    """
+    if zstandard is None:
+        raise UserWarning("Training a compression dictionary requires zstandard.")
+    pieces = []
+    for sample in samples:
+        sample = bytes(sample)[:_DICTIONARY_SAMPLE_BYTES]
+        pieces.extend(sample[offset:offset + _DICTIONARY_SAMPLE_SIZE] for offset in range(0, len(sample), _DICTIONARY_SAMPLE_SIZE))
+    try:
+        dictionary = zstandard.train_dictionary(size, pieces)
+    except zstandard.ZstdError as err:
+        raise UserWarning("Couldn't train compression dictionary - '{0}'".format(err))
+
+    return dictionary.as_bytes()
+
+
+def _check_engine(scheme):
+    scheme = scheme.upper()
+    if scheme not in __engines__:
+        raise UserWarning("File's compression engine ('{0}') is unknown.".format(scheme))
+
+    return scheme
+
+
+def _compress_frames(engine, data, frame_size=_FRAME_SIZE):
+    """
+    :param engine: compression engine
+    :param data: chunk contents
+    :param frame_size: data larger than this is split into frames of this size, each compressed independently
+    :return: (compressed data, compressed frame sizes or None if data fit in one frame)
+    """
+    if len(data) <= frame_size:
+        return engine.compress(data), None
+
+    frames = [engine.compress(data[offset:offset + frame_size]) for offset in range(0, len(data), frame_size)]
+
+    return b''.join(frames), [len(frame) for frame in frames]
+
+
+def _process_pool(*args):
+    # multiprocessing is imported when a pool is first needed, commands which don't use one don't pay for its import
+    import multiprocessing
+
+    return multiprocessing.Pool(*args)
+
+
+def _thread_pool(workers):
+    import multiprocessing.pool
+
+    return multiprocessing.pool.ThreadPool(workers)
+
+
+def _decompress_frames(engine, chunk, frames, workers=None):
+    if frames is None:
+        return _decompress(engine, chunk)
+
+    views = []
+    offset = 0
+    for size in frames:
+        views.append(_view(chunk, offset, size))
+        offset += size
+    if workers is not None and workers > 1 and len(views) > 1:
+        pool = _thread_pool(min(workers, len(views)))
+        try:
+            parts = pool.map(lambda view: _decompress(engine, view), views)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parts = [_decompress(engine, view) for view in views]
+
+    return b''.join(parts)
+
+
+def _checksum(algorithm, data):
+    digest = __checksums__[algorithm]()
+    digest.update(data)
+
+    return digest.hexdigest()
+
+
+def _verify_chunk(task):
+    # Runs in a worker process for DtkFile.verify(), reads the chunk in blocks so memory use is bounded.
+    index, filename, file_size, offset, size, algorithm, expected = task
+    if offset + size > file_size:
+        return index, "extends past end of file (truncated?)"
+    if expected is None:
+        return None
+
+    digest = __checksums__[algorithm]()
+    with open(filename, 'rb') as handle:
+        handle.seek(offset)
+        remaining = size
+        while remaining > 0:
+            block = handle.read(min(remaining, _VERIFY_BLOCK_SIZE))
+            digest.update(block)
+            remaining -= len(block)
+    if digest.hexdigest() != expected:
+        return index, "{0} mismatch, expected {1}, found {2}".format(algorithm, expected, digest.hexdigest())
+
+    return None
+
+
+def _decompress(engine, contents):
+    if engine:
+        try:
+            contents = engine.decompress(contents)
+        except ValueError as err:
+            raise UserWarning("Couldn't decompress chunk - '{0}'".format(err))
+
+    return contents
+
+
+def _parse(contents, compact=False, backend=None):
+    backend = backend if backend is not None else dtkJson.get_backend()
+    if compact:
+        obj = backend.loads(bytes(contents), object_pairs_hook=CompactObject)
+    else:
+        obj = backend.loads(bytes(contents), object_hook=SerialObject)
+
+    return obj
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_array(contents, key, compact=False):
+    # Find the (first) array named key and decode its elements one at a time.
+
+    return _iter_array_frames([contents], key, compact)
+
+
+def _iter_array_frames(frames, key, compact=False):
+    # As _iter_array() over text arriving in frames. Text before the array and decoded elements are dropped as each
+    # frame arrives, so the window held is the rest of one frame plus any element continued from the one before.
+    if compact:
+        decoder = json.JSONDecoder(object_pairs_hook=CompactObject)
+    else:
+        decoder = json.JSONDecoder(object_hook=SerialObject)
+    opening = re.compile(r'"{0}"\s*:\s*\['.format(re.escape(key)))
+    pending = re.compile(r'"{0}"\s*(?::\s*)?$'.format(re.escape(key)))    # the name, waiting for its '['
+    texts = _iter_text(frames)
+    text = ''
+    position = None     # offset in text of the next element (or ']'), None until the array is found
+    for more in texts:
+        text += more
+        match = opening.search(text)
+        if match is not None:
+            position = match.end()
+            break
+        # Keep only what the next frame might complete into the opening of the array
+        match = pending.search(text)
+        text = text[match.start():] if match is not None else text[-len(key) - 1:]
+    if position is None:
+        raise UserWarning("Couldn't find '{0}' array in chunk".format(key))
+
+    expect_element = None   # None before the first element, then True after ',' and False after an element
+    exhausted = False
+    while True:
+        position = _WHITESPACE.match(text, position).end()
+        # An element (even a number) is only complete once something follows it, fetch text until then
+        if position < len(text):
+            char = text[position]
+            if expect_element is not True and char == ']':
+                return
+            if expect_element is False:
+                if char != ',':
+                    raise UserWarning("Malformed '{0}' array at offset {1}".format(key, position))
+                expect_element = True
+                position += 1
+                continue
+            try:
+                element, end = decoder.raw_decode(text, position)
+            except ValueError as err:
+                if exhausted:
+                    raise UserWarning("Couldn't decode '{0}' element - '{1}'".format(key, err))
+                end = None
+            if end is not None and (end < len(text) or exhausted):
+                yield element
+                position = end
+                expect_element = False
+                continue
+        elif exhausted:
+            raise UserWarning("Malformed '{0}' array, unexpected end of chunk".format(key))
+        more = next(texts, None)
+        if more is None:
+            exhausted = True
+        else:
+            text = text[position:] + more
+            position = 0
+
+
+def _iter_text(frames):
+    # Decode frames of UTF-8 text, a character split between frames is completed by the next one
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for frame in frames:
+        text = bytes(frame)
+        yield text if isinstance(text, str) else decoder.decode(text)
+    if not isinstance(b'', str):
+        decoder.decode(b'', final=True)    # raises on a truncated character
+
+    return
+
+
+_KEY = re.compile(r'[ \t\n\r]*("(?:[^"\\]|\\.)*")[ \t\n\r]*:[ \t\n\r]*')
+_PLAIN_DECODER = json.JSONDecoder()
+
+
+def _parse_fields(contents, fields, compact=False):
+    # Decode the projection of a chunk onto fields. Objects along the projected paths are walked member by member and
+    # unwanted members are decoded by the (C) decoder without object hooks then dropped. Each array element is decoded
+    # in full the same way, then projected; walking elements member by member in Python measured several times slower.
+    # The decode work is not reduced, only the SerialObjects/CompactObjects built and the memory kept afterwards.
+    tree = {}
+    for field in fields:
+        branch = tree
+        path = field.split('.')
+        for key in path[:-1]:
+            if key in branch and branch[key] is None:
+                break   # the whole of an ancestor is wanted
+            branch = branch.setdefault(key, {})
+        else:
+            branch[path[-1]] = None
+    if compact:
+        decoder, factory = json.JSONDecoder(object_pairs_hook=CompactObject), CompactObject
+    else:
+        decoder, factory = json.JSONDecoder(object_hook=SerialObject), lambda pairs: SerialObject(dict(pairs))
+    text = _text(contents)
+    try:
+        obj, _ = _project(text, _WHITESPACE.match(text).end(), tree, decoder, factory)
+    except (ValueError, IndexError) as err:
+        raise UserWarning("Couldn't decode chunk - '{0}'".format(err))
+
+    return obj
+
+
+def _project(text, position, tree, decoder, factory):
+    # Decode the value at position projected onto tree (key -> subtree, or None for the whole value).
+    # Returns the value and the position just past it.
+    char = text[position]
+    if char == '[':
+        values = []
+        position = _WHITESPACE.match(text, position + 1).end()
+        if text[position] == ']':
+            return values, position + 1
+        while True:
+            value, position = _PLAIN_DECODER.raw_decode(text, position)
+            values.append(_select(value, tree, factory))
+            position = _WHITESPACE.match(text, position).end()
+            if text[position] == ']':
+                return values, position + 1
+            position = _WHITESPACE.match(text, position + 1).end()
+    if char != '{':
+        return _PLAIN_DECODER.raw_decode(text, position)
+
+    pairs = []
+    position = _WHITESPACE.match(text, position + 1).end()
+    if text[position] == '}':
+        return factory(pairs), position + 1
+    while True:
+        match = _KEY.match(text, position)
+        if match is None:
+            raise ValueError("Expecting property name at offset {0}".format(position))
+        key = json.loads(match.group(1))
+        position = match.end()
+        if key not in tree:
+            _, position = _PLAIN_DECODER.raw_decode(text, position)
+        elif tree[key] is None:
+            value, position = decoder.raw_decode(text, position)
+            pairs.append((key, value))
+        else:
+            value, position = _project(text, position, tree[key], decoder, factory)
+            pairs.append((key, value))
+        position = _WHITESPACE.match(text, position).end()
+        if text[position] == '}':
+            return factory(pairs), position + 1
+        if text[position] != ',':
+            raise ValueError("Expecting ',' delimiter at offset {0}".format(position))
+        position = _WHITESPACE.match(text, position + 1).end()
+
+
+def _select(value, tree, factory):
+    # Project a value decoded without object hooks, as _project() would have
+    if tree is None:
+        return _wrap(value, factory)
+    if isinstance(value, list):
+        return [_select(element, tree, factory) for element in value]
+    if isinstance(value, dict):
+        return factory([(key, _select(item, tree[key], factory)) for key, item in value.items() if key in tree])
+
+    return value
+
+
+def _wrap(value, factory):
+    if isinstance(value, dict):
+        return factory([(key, _wrap(item, factory)) for key, item in value.items()])
+    if isinstance(value, list):
+        return [_wrap(element, factory) for element in value]
+
+    return value
+
+
+def _text(contents):
+    text = bytes(contents)
+    if not isinstance(text, str):
+        text = text.decode('utf-8')
+
+    return text
+
+
+def _find_array(text, key):
+    # Offset just past the '[' of the (first) array named key
+    match = re.search(r'"{0}"\s*:\s*\['.format(re.escape(key)), text)
+    if match is None:
+        raise UserWarning("Couldn't find '{0}' array in chunk".format(key))
+
+    return match.end()
+
+
+def _iter_elements(text, position, key, decoder):
+    # Decode the elements of the array opened just before position, yielding (element, start, end) offsets.
+    # The array's closing ']' follows the last element's end (or position, for an empty array) and any whitespace.
+    position = _WHITESPACE.match(text, position).end()
+    if text[position:position + 1] == ']':
+        return
+    while True:
+        try:
+            start = position
+            element, position = decoder.raw_decode(text, position)
+        except ValueError as err:
+            raise UserWarning("Couldn't decode '{0}' element - '{1}'".format(key, err))
+        yield element, start, position
+        position = _WHITESPACE.match(text, position).end()
+        delimiter = text[position:position + 1]
+        if delimiter == ']':
+            break
+        if delimiter != ',':
+            raise UserWarning("Malformed '{0}' array at offset {1}".format(key, position))
+        position = _WHITESPACE.match(text, position + 1).end()
+
+    return
+
+
+def _lookup(obj, path):
+    try:
+        for key in path:
+            obj = obj[key]
+    except (KeyError, TypeError):
+        raise UserWarning("Couldn't find '{0}' in object".format('.'.join(path)))
+
+    return obj
+
+
+_EXTERNAL_ID = re.compile(r'"externalId"\s*:\s*(-?\d+)')
+
+
+def _find_external_id(data):
+    # externalId precedes individualHumans in node JSON, so this is a short scan.
+    match = _EXTERNAL_ID.search(bytes(data))
+
+    return int(match.group(1)) if match else None
+
+
+def _load_node(task):
+    # Runs in a worker process, reads the chunk itself so only the node is sent back to the parent.
+    index, filename, offset, size, scheme, dictionary, frames, compact, backend = task
+    with open(filename, 'rb') as handle, dtkInstrumentation.span(READ, index + 1) as span:
+        handle.seek(offset)
+        chunk = handle.read(size)
+        span.bytes = len(chunk)
+    _, engine = _resolve_engine(scheme, dictionary)
+    contents = chunk
+    if engine:
+        with dtkInstrumentation.span(DECOMPRESS, index + 1) as span:
+            contents = _decompress_frames(engine, chunk, frames)
+            span.bytes = len(contents)
+    with dtkInstrumentation.span(PARSE, index + 1) as span:
+        node = _parse(contents, compact, dtkJson.get_backend(backend)).node
+        span.bytes = len(contents)
+
+    return index, node
+
+
+def _load_delta_node(task):
+    index, filename, compact, backend = task
+    with DtkFile(filename, compact=compact, json_backend=backend) as dtk_file:
+        node = dtk_file.get_object(index + 1).node
+
+    return index, node
+
+
 def _check_magic(handle):
     magic = handle.read(4)
-    if magic != 'IDTK':
+    if magic != b'IDTK':
         raise UserWarning("File has incorrect magic 'number': '{0}'".format(magic))
 
     return
@@ -128,13 +1653,46 @@ def _read_header(handle):
         metadata.engine = 'SNAPPY' if metadata.compressed else 'NONE'
         metadata.chunkcount = 1
         metadata.chunksizes = [metadata.bytecount]
+        if 'framesizes' in metadata:    # large payloads written by idtkFileTools
+            metadata.chunkframes = SerialObject({'0': metadata.framesizes})
     _check_version(metadata.version)
 
-    _check_chunk_sizes(metadata.chunksizes)
+    if metadata.version < 3:    # version 3 chunk sizes are in the index, see _read_index()
+        _check_chunk_sizes(metadata.chunksizes)
 
     return header_text, header
 
 
+def _read_index(handle):
+    handle.seek(0, os.SEEK_END)
+    if handle.tell() < _INDEX_TRAILER.size:
+        raise UserWarning("File is too short to contain an index")
+    handle.seek(-_INDEX_TRAILER.size, os.SEEK_END)
+    index_offset, chunk_count, node_count, magic = _INDEX_TRAILER.unpack(handle.read(_INDEX_TRAILER.size))
+    if magic != _INDEX_MAGIC:
+        raise UserWarning("File has incorrect index magic 'number': '{0}'".format(magic))
+
+    handle.seek(index_offset)
+    table_size = chunk_count * _INDEX_CHUNK.size + node_count * _INDEX_NODE.size
+    table = handle.read(table_size)
+    if len(table) != table_size:
+        raise UserWarning("File index is truncated")
+
+    chunk_info = []
+    for index in range(chunk_count):
+        offset, size = _INDEX_CHUNK.unpack_from(table, index * _INDEX_CHUNK.size)
+        chunk_info.append(_Class({'offset': offset, 'size': size}))
+    _check_chunk_sizes([info.size for info in chunk_info])
+
+    node_ids = {}
+    base = chunk_count * _INDEX_CHUNK.size
+    for index in range(node_count):
+        external_id, chunk = _INDEX_NODE.unpack_from(table, base + index * _INDEX_NODE.size)
+        node_ids[external_id] = chunk
+
+    return chunk_info, node_ids
+
+
 def _check_header_size(header_size):
     if header_size <= 0:
         raise UserWarning("Invalid header size: {0}".format(header_size))
@@ -152,7 +1710,7 @@ def _try_parse_header_text(header_text):
 
 
 def _check_version(version):
-    if version <= 0 or version > 2:
+    if version <= 0 or version > 3:
         raise UserWarning("Unknown version: {0}".format(version))
 
     return
@@ -168,45 +1726,352 @@ def _check_chunk_sizes(chunk_sizes):
 
 
 def __do_read__(commandline_arguments):
-    if commandline_arguments.output is not None:
-        prefix = commandline_arguments.output
-    else:
-        root, _ = os.path.splitext(commandline_arguments.filename)
-        prefix = root
 
-    if commandline_arguments.raw:
+    read_dtk_file(commandline_arguments.filename, commandline_arguments.output, commandline_arguments.raw, commandline_arguments.unformatted,
+                  commandline_arguments.header, jobs=commandline_arguments.jobs, reindent=commandline_arguments.reindent)
+
+    return
+
+
+def read_dtk_file(filename, prefix=None, raw=False, unformatted=False, header=None, verbose=True, jobs=1, reindent=False):
+    """
+    Write the chunks of a .dtk file to prefix.sim.json and prefix.node-N.json.
+    :param filename: .dtk filename
+    :param prefix: output filename prefix, defaults to filename without its extension
+    :param raw: write raw (compressed) chunks, with a .bin extension
+    :param unformatted: write decompressed JSON as is rather than parsing and formatting it
+    :param header: filename for the header JSON, if wanted
+    :param verbose: print the file metadata
+    :param jobs: number of worker processes writing chunks concurrently
+    :param reindent: format JSON by re-indenting its text rather than parsing and re-serializing it
+                     (faster, keeps key order and number formatting as written)
+    :return: list of output filenames
+    """
+    if prefix is None:
+        prefix, _ = os.path.splitext(filename)
+
+    if raw:
         extension = 'bin'
+        mode = 'raw'
     else:
         extension = 'json'
+        mode = 'unformatted' if unformatted else 'reindent' if reindent else 'formatted'
 
-    dtk_file = DtkFile(commandline_arguments.filename)
+    dtk_file = DtkFile(filename)
 
-    if commandline_arguments.header:
-        with open(commandline_arguments.header, 'wb') as handle:
+    if header:
+        with open(header, 'wb') as handle:
             json.dump(dtk_file.header, handle, indent=2, separators=(',', ':'))
 
-    print('File metadata: {0}'.format(dtk_file.header.metadata))
-
-    for index in range(dtk_file.chunk_count):
-        if commandline_arguments.raw:
-            # Write raw chunks to disk
-            output = dtk_file.get_chunk(index)
-        else:
-            if commandline_arguments.unformatted:
-                # Expand compressed contents, but don't serialize and format
-                output = dtk_file.get_contents(index)
-            else:
-                # Expand compressed contents, serialize, write out formatted
-                obj = dtk_file.get_object(index)
-                output = json.dumps(obj, indent=2, separators=(',', ':'))
+    if verbose:
+        print('File metadata: {0}'.format(dtk_file.header.metadata))
 
+    tasks = []
+    for index in range(dtk_file.node_count + 1):
         if index == 0:
             output_filename = '.'.join([prefix, 'sim', extension])
         else:
             output_filename = '.'.join([prefix, 'node-{0}'.format(index), extension])
+        tasks.append((index, output_filename, mode))
+
+    if jobs > 1:
+        # Each worker opens the file once, then decompresses, formats and writes whole chunks
+        pool = _process_pool(jobs, _init_chunk_writer, (filename, dtk_file.json_backend.name))
+        try:
+            output_filenames = list(dtkInstrumentation.from_workers(pool.imap(dtkInstrumentation.in_workers(_write_chunk_task), tasks)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        output_filenames = [_write_chunk(dtk_file, index, output_filename, mode) for index, output_filename, mode in tasks]
+
+    return output_filenames
+
+
+_chunk_writer_file = None   # DtkFile opened in each read --jobs worker process
+
+
+def _init_chunk_writer(filename, backend):
+    global _chunk_writer_file
+    _chunk_writer_file = DtkFile(filename, json_backend=backend)
+
+    return
+
+
+def _write_chunk_task(task):
+
+    return _write_chunk(_chunk_writer_file, *task)
+
+
+def _write_chunk(dtk_file, index, output_filename, mode):
+    with open(output_filename, 'wb') as handle:
+        if mode in ('raw', 'unformatted'):
+            # Write raw chunks, or expanded compressed contents without serializing and formatting, to disk
+            output = dtk_file.get_chunk(index) if mode == 'raw' else dtk_file.get_contents(index)
+            with dtkInstrumentation.span(WRITE, index) as span:
+                handle.write(output)
+                span.bytes = len(output)
+        elif mode == 'reindent':
+            # Expand compressed contents, format the JSON text without decoding it
+            contents = dtk_file.get_contents(index)
+            with dtkInstrumentation.span(SERIALIZE, index) as span:
+                _write_indented(_text(contents), handle)
+                span.bytes = handle.tell()
+        else:
+            # Expand compressed contents, serialize and write out formatted, streaming to the file
+            obj = dtk_file.get_object(index)
+            with dtkInstrumentation.span(SERIALIZE, index) as span:
+                dtk_file.json_backend.dump(obj, handle, indent=2, separators=(',', ':'))
+                span.bytes = handle.tell()
+
+    return output_filename
+
+
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\],:]|[^{}\[\],:"\s]+')
+_OPENERS = frozenset(['{', '['])
+_CLOSERS = frozenset(['}', ']'])
+_WRITE_PIECES = 1 << 16
+
+
+def _write_indented(text, handle, indent=2):
+    # Lay out JSON text as json.dump(indent=indent, separators=(',', ':')) would, one token at a time, without
+    # decoding values. Output is written in batches of pieces so memory use doesn't grow with the text.
+    pieces = []
+    depth = 0
+    pending = None  # opening bracket waiting for its first token, so empty containers stay '{}' and '[]'
+    for match in _TOKEN.finditer(text):
+        token = match.group()
+        if pending is not None:
+            if token in _CLOSERS:
+                pieces.append(pending + token)
+                pending = None
+                continue
+            depth += 1
+            pieces.append(pending + '\n' + ' ' * (indent * depth))
+            pending = None
+        if token in _OPENERS:
+            pending = token
+        elif token in _CLOSERS:
+            depth -= 1
+            pieces.append('\n' + ' ' * (indent * depth) + token)
+        elif token == ',':
+            pieces.append(',\n' + ' ' * (indent * depth))
+        else:
+            pieces.append(token)
+        if len(pieces) >= _WRITE_PIECES:
+            handle.write(_encode(''.join(pieces)))
+            del pieces[:]
+    if pending is not None:
+        pieces.append(pending)
+    handle.write(_encode(''.join(pieces)))
+
+    return
+
+
+def __do_batch__(args):
+    filenames = expand_filenames(args.patterns, args.manifest)
+    if not filenames:
+        raise UserWarning("No files matched.")
+    options = {'output_dir': args.output_dir, 'raw': args.raw, 'unformatted': args.unformatted, 'jobs': 1, 'engine': args.engine,
+               'version': args.version}
+
+    def report(result):
+        filename, size, seconds, error = result
+        if error is None:
+            print("{0}: OK ({1} bytes in {2:.3f}s)".format(filename, size, seconds), file=sys.stderr)
+        else:
+            print("{0}: FAILED - {1}".format(filename, error), file=sys.stderr)
+
+        return
+
+    summary = batch_process(args.operation, filenames, args.jobs, options, report)
+    print("{0} file(s), {1} failed, {2} bytes in {3:.3f}s ({4:.1f} MB/s, {5:.1f} files/s)".format(
+        summary['files'], len(summary['failures']), summary['bytes'], summary['seconds'],
+        summary['mb_per_second'] or 0.0, summary['files_per_second'] or 0.0), file=sys.stderr)
+    if args.report is not None:
+        with open(args.report, 'w') as handle:
+            json.dump(summary, handle, indent=2, separators=(',', ': '))
+    if summary['failures']:
+        sys.exit(1)
+
+    return
+
+
+def expand_filenames(patterns, manifest=None):
+    """
+    :param patterns: filenames and/or glob patterns, e.g. 'output/state-*.dtk'
+    :param manifest: filename of a manifest listing one filename or pattern per line ('#' starts a comment)
+    :return: sorted list of unique filenames
+    """
+    patterns = list(patterns)
+    if manifest is not None:
+        with open(manifest, 'r') as handle:
+            for line in handle:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    patterns.append(line)
+
+    filenames = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        filenames.update(matches if matches else [pattern])     # a missing file is reported as a failure
+
+    return sorted(filenames)
+
+
+def batch_process(operation, filenames, jobs=None, options=None, callback=None):
+    """
+    Run an operation over many files on one pool of worker processes, so interpreter start up and imports are paid
+    once per worker rather than once per file. A failing file is recorded and the batch continues.
+    :param operation: name of an operation in __batch_operations__ {read|verify|convert|write}
+    :param filenames: .dtk filenames, or <prefix>.sim.json filenames (with <prefix>.node-<n>.json nodes) to write
+    :param jobs: number of worker processes, defaults to the number of CPUs
+    :param options: dictionary of operation options (output_dir, raw, unformatted, jobs, engine, version)
+    :param callback: called with (filename, bytes, seconds, error) as each file completes
+    :return: OrderedDict summary with aggregate throughput and a list of (filename, error) failures
+    """
+    if operation not in __batch_operations__:
+        raise UserWarning("Unknown batch operation '{0}'".format(operation))
+    options = dict(options) if options is not None else {}
+    options.setdefault('json_backend', dtkJson.get_backend().name)
+    tasks = [(operation, filename, options) for filename in filenames]
+
+    start = time.time()
+    results = []
+    pool = _process_pool(jobs)
+    try:
+        for result in dtkInstrumentation.from_workers(pool.imap_unordered(dtkInstrumentation.in_workers(_batch_task), tasks)):
+            results.append(result)
+            if callback is not None:
+                callback(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    seconds = time.time() - start
+
+    total = sum(size for _, size, _, error in results if error is None)
+    summary = OrderedDict()
+    summary['operation'] = operation
+    summary['files'] = len(results)
+    summary['bytes'] = total
+    summary['seconds'] = seconds
+    summary['mb_per_second'] = (total / float(1 << 20)) / seconds if seconds > 0 else None
+    summary['files_per_second'] = len(results) / seconds if seconds > 0 else None
+    summary['failures'] = sorted((filename, error) for filename, _, _, error in results if error is not None)
+
+    return summary
+
+
+def _batch_task(task):
+    # Runs in a batch worker process, returns (filename, bytes, seconds, error).
+    operation, filename, options = task
+    start = time.time()
+    try:
+        size = __batch_operations__[operation](filename, options)
+        error = None
+    except Exception as err:    # any failure is reported for this file, the rest of the batch continues
+        size = 0
+        error = str(err) or err.__class__.__name__
+
+    return filename, size, time.time() - start, error
+
+
+def _batch_read(filename, options):
+    prefix = None
+    if options.get('output_dir') is not None:
+        prefix = os.path.join(options['output_dir'], os.path.splitext(os.path.basename(filename))[0])
+    dtkJson.set_default_backend(options['json_backend'])
+    read_dtk_file(filename, prefix, options.get('raw', False), options.get('unformatted', False), verbose=False)
+
+    return os.path.getsize(filename)
+
+
+def _batch_convert(filename, options):
+    destination = None
+    if options.get('output_dir') is not None:
+        destination = os.path.join(options['output_dir'], os.path.basename(filename))
+    convert_dtk_file(filename, destination, engine=options.get('engine', 'LZ4'), version=options.get('version', 2))
+
+    return os.path.getsize(filename if destination is None else destination)
+
+
+def _batch_write(filename, options):
+    # filename is the simulation JSON of a checkpoint laid out as read writes it, <prefix>.sim.json with its nodes in
+    # <prefix>.node-<n>.json, and is written to <prefix>.dtk (<prefix> itself if it already ends in .dtk)
+    if not filename.endswith('.sim.json'):
+        raise UserWarning("Expected a simulation JSON filename ending in '.sim.json'")
+    prefix = filename[:-len('.sim.json')]
+    node_pattern = re.compile(re.escape(prefix) + r'\.node-(\d+)\.json$')
+    nodes = sorted((int(match.group(1)), name) for match, name in ((node_pattern.match(name), name) for name in glob.glob(prefix + '.node-*.json')) if match)
+    if options.get('output_dir') is not None:
+        prefix = os.path.join(options['output_dir'], os.path.basename(prefix))
+    destination = prefix if prefix.endswith('.dtk') else prefix + '.dtk'
+    write_dtk_file(destination, filename, [name for _, name in nodes], engine=options.get('engine', 'LZ4'), version=options.get('version', 2))
+
+    return os.path.getsize(destination)
+
+
+def _batch_verify(filename, options):
+    with DtkFile(filename) as dtk_file:
+        problems = dtk_file.verify(options.get('jobs'))
+    if problems:
+        raise UserWarning('; '.join('chunk {0} {1}'.format(index, problem) for index, problem in problems))
+
+    return os.path.getsize(filename)
+
+
+__batch_operations__ = {'read': _batch_read, 'verify': _batch_verify, 'convert': _batch_convert, 'write': _batch_write}
+
+
+def __do_verify__(args):
+    failures = 0
+    for filename in args.filenames:
+        try:
+            with DtkFile(filename) as dtk_file:
+                problems = dtk_file.verify(args.jobs)
+                checked = dtk_file.checksum if dtk_file.checksum is not None else 'sizes only, no checksums'
+        except UserWarning as err:
+            problems = [(None, str(err))]
+            checked = 'header'
+        if problems:
+            failures += 1
+            for index, problem in problems:
+                print("{0}: {1}{2}".format(filename, '' if index is None else 'chunk {0} '.format(index), problem))
+        else:
+            print("{0}: OK ({1})".format(filename, checked))
+
+    if failures:
+        sys.exit(1)
+
+    return
+
 
-        with open(output_filename, 'wb') as handle:
-            handle.write(output)
+def __do_extract__(args):
+    with DtkFile(args.source, mapped=True) as dtk_file:
+        dtk_file.extract(args.destination, args.nodes, args.ids, args.version)
+    print("Extracted {0} node(s) from '{1}' to '{2}'".format(len(args.nodes or args.ids), args.source, args.destination), file=sys.stderr)
+
+    return
+
+
+def __do_merge__(args):
+    node_count = merge_dtk_files(args.destination, args.sources, args.version)
+    print("Merged {0} node(s) from {1} file(s) into '{2}'".format(node_count, len(args.sources), args.destination), file=sys.stderr)
+
+    return
+
+
+def __do_convert__(args):
+    destination = args.destination if args.destination is not None else args.source
+    print("Converting '{0}' to version {1} file '{2}' with compression engine '{3}'".format(
+        args.source, args.version, destination, args.engine if args.compress else 'NONE'), file=sys.stderr)
+    if args.base is not None:
+        print("Writing nodes as deltas against '{0}'".format(args.base), file=sys.stderr)
+    node_count = convert_dtk_file(args.source, args.destination, args.author, args.tool, args.engine, args.compress, args.version,
+                                  args.sim_engine, args.checksum, args.base)
+    print("Wrote {0} node chunk(s)".format(node_count), file=sys.stderr)
 
     return
 
@@ -221,66 +2086,478 @@ def __do_write__(args):
     print("{0} contents".format("Compressing" if args.compress else "Not compressing"), file=sys.stderr)
     print("{0} contents".format("Verifying" if args.verify else "Not verifying"), file=sys.stderr)
     print("Using compression engine '{0}'".format(args.engine), file=sys.stderr)
+    if args.sim_engine is not None:
+        print("Using compression engine '{0}' for simulation data".format(args.sim_engine), file=sys.stderr)
+    print("Using checksum '{0}'".format(args.checksum), file=sys.stderr)
+    if args.dictionary_size is not None:
+        print("Training a {0} byte compression dictionary".format(args.dictionary_size), file=sys.stderr)
+    print("Using {0} job(s) for compression".format(args.jobs), file=sys.stderr)
+    print("Writing file format version {0}".format(args.version), file=sys.stderr)
+    if args.base is not None:
+        print("Writing nodes as deltas against '{0}'".format(args.base), file=sys.stderr)
+
+    write_dtk_file(args.filename, args.simulation, args.nodes, args.author, args.tool, args.engine, args.compress, args.jobs, args.version,
+                   args.sim_engine, args.dictionary_size, args.frame_size, args.checksum, args.base)
+
+    return
 
-    scheme = args.engine.upper()
-    engine = __engines__[scheme]
 
-    chunks = []
-    # PrepareSimulationData(sim, writers, json_texts, json_sizes);
-    _prepare_simulation_data(args.simulation, args.compress, engine, chunks)
-    # PrepareNodeData(sim->nodes, writers, json_texts, json_sizes);
-    _prepare_node_data(args.nodes, args.compress, engine, chunks)
+def write_dtk_file(filename, simulation, nodes, author=None, tool=None, engine='LZ4', compress=True, jobs=1, version=2,
+                   simulation_engine=None, dictionary_size=None, frame_size=_FRAME_SIZE, checksum='CRC32', base=None):
+    """
+    :param filename: output .dtk filename
+    :param simulation: filename for simulation JSON
+    :param nodes: filename(s) for node JSON
+    :param author: author name for metadata
+    :param tool: tool name for metadata
+    :param engine: compression engine {NONE|LZ4|LZ4HC|SNAPPY|ZSTD}, optionally with a level, e.g. 'ZSTD:19'
+    :param compress: compress (or don't) chunks in resulting file
+    :param jobs: number of worker processes compressing chunks concurrently
+    :param version: file format version {2|3}
+    :param simulation_engine: compression engine for the simulation chunk, defaults to engine
+    :param dictionary_size: train a compression dictionary of this many bytes over (a sample of) the nodes, ZSTD only
+    :param frame_size: chunks larger than this are split into independently compressed frames of this size
+    :param checksum: per-chunk checksum algorithm {CRC32|XXH64}, None to omit checksums
+    :param base: .dtk filename of an earlier checkpoint, nodes are written as deltas against its nodes where smaller
+    :return: None
+    """
+
+    node_engine = engine if compress else 'NONE'
+    simulation_engine = simulation_engine if compress and simulation_engine is not None else node_engine
+    dictionary = None
+    if compress and dictionary_size is not None:
+        dictionary = train_dictionary(_sample_files(nodes), dictionary_size)
+    with DtkWriter(filename, author, tool, engine, compress, version, dictionary, frame_size, checksum, base) as writer:
+        base_chunks = _node_chunks(writer.base) if base is not None else None
+        # PrepareSimulationData(sim, writers, json_texts, json_sizes);
+        # PrepareNodeData(sim->nodes, writers, json_texts, json_sizes);
+        tasks = [(simulation, simulation_engine, dictionary, frame_size, None, None)]
+        tasks += [(node, node_engine, dictionary, frame_size, base, base_chunks) for node in nodes]
+        chunks = _prepare_chunks(tasks, jobs)
+        chunk, _, frames, _ = next(chunks)
+        writer.add_simulation(chunk, compressed=True, engine=simulation_engine, frames=frames)
+        for chunk, node_id, frames, base_chunk in chunks:
+            writer.add_node(chunk, compressed=True, node_id=node_id, frames=frames, base_chunk=base_chunk)
 
-    # ConstructHeader(scheme, scheme_name, total, chunk_sizes, header);
-    header = _construct_header(args.author, args.tool, args.engine, chunks)
-    header_string = json.dumps(header, indent=None, separators=(',', ':'))
+    return
 
-    with open(args.filename, 'wb') as handle:
-        _write_magic_number(handle)
-        _write_header_size(len(header_string), handle)
-        _write_header(header_string, handle)
-        _write_chunks(chunks, handle)
+
+def _sample_files(filenames):
+    # Evenly spaced selection of files, read up to the per-file sample limit
+    step = max(len(filenames) // _DICTIONARY_SAMPLE_FILES, 1)
+    for filename in list(filenames)[::step][:_DICTIONARY_SAMPLE_FILES]:
+        with open(filename, 'rb') as handle:
+            yield handle.read(_DICTIONARY_SAMPLE_BYTES)
 
     return
 
 
-def _prepare_simulation_data(filename, compress, engine, chunks):
+def _prepare_chunks(tasks, jobs):
+    # tasks are (filename, engine, dictionary, frame size, base filename, base chunks) tuples
+    if jobs > 1:
+        pool = _process_pool(jobs)
+        try:
+            chunks = pool.imap(dtkInstrumentation.in_workers(_prepare_chunk), tasks)   # imap() preserves order, so chunksizes line up
+            for chunk in dtkInstrumentation.from_workers(chunks):
+                yield chunk
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks:
+            yield _prepare_chunk(task)
+
+    return
+
+
+def _prepare_chunk(task):
+    filename, spec, dictionary, frame_size, base, base_chunks = task
     with open(filename, 'rb') as handle:
         data = handle.read()
-    _prepare_chunk(data, compress, engine, chunks)
+    node_id = _find_external_id(data)
+    base_chunk = None
+    if base is not None:
+        with DtkFile(base) as base_file:
+            data, base_chunk = _delta_contents(data, base_file, base_chunks)
+    _, engine = _resolve_engine(spec, dictionary)
+    frames = None
+    if engine is not None:
+        with dtkInstrumentation.span(COMPRESS, label='compress ' + os.path.basename(filename)) as span:
+            span.bytes = len(data)
+            data, frames = _compress_frames(engine, data, frame_size)
+
+    return data, node_id, frames, base_chunk
+
+
+def convert_dtk_file(source, destination=None, author=None, tool=None, engine='LZ4', compress=True, version=2, simulation_engine=None,
+                     checksum='CRC32', base=None):
+    """
+    Rewrite a .dtk file as version 2 (or 3) with one chunk per node. Nodes embedded in the simulation's 'nodes' array
+    (version 1 files) are split out into their own chunks, files which already have node chunks are recompressed.
+    Node JSON is copied verbatim, not re-serialized, and only one node is held (compressed) at a time beyond the
+    decompressed source chunk. Snappy payloads can't be decompressed incrementally, so a version 1 payload is
+    decompressed in one piece.
+    :param source: .dtk filename
+    :param destination: output .dtk filename, None to replace source
+    :param author: author name for metadata, defaults to the source's author
+    :param tool: tool name for metadata, defaults to the source's tool
+    :param engine: compression engine {NONE|LZ4|LZ4HC|SNAPPY|ZSTD}, optionally with a level, e.g. 'ZSTD:19'
+    :param compress: compress (or don't) chunks in resulting file
+    :param version: file format version {2|3}
+    :param simulation_engine: compression engine for the simulation chunk, defaults to engine
+    :param checksum: per-chunk checksum algorithm {CRC32|XXH64}, None to omit checksums
+    :param base: .dtk filename of an earlier checkpoint, nodes are written as deltas against its nodes where smaller,
+                 None writes a self-contained file (also rebuilding the nodes of a delta source)
+    :return: number of nodes written
+    """
+    if base is not None and os.path.abspath(base) in (os.path.abspath(source), os.path.abspath(destination or source)):
+        raise UserWarning("A file can't be converted to a delta against itself")
+    in_place = destination is None or os.path.abspath(destination) == os.path.abspath(source)
+    output = destination
+    if in_place:
+        handle, output = tempfile.mkstemp(suffix='.dtk', dir=os.path.dirname(os.path.abspath(source)))
+        os.close(handle)
 
-    return
+    try:
+        with DtkFile(source) as dtk_file:
+            metadata = dtk_file.header.metadata
+            author = author if author is not None else metadata.get('author')
+            tool = tool if tool is not None else metadata.get('tool')
+            with DtkWriter(output, author, tool, engine, compress, version, checksum=checksum, base=base) as writer:
+                node_count = _convert_chunks(dtk_file, writer, simulation_engine)
+    except BaseException:
+        if in_place:
+            os.remove(output)
+        raise
+
+    if in_place:
+        shutil.copymode(source, output)     # mkstemp() creates the file readable by its owner only
+        if os.name == 'nt':
+            os.remove(source)   # rename() doesn't replace existing files on Windows
+        os.rename(output, source)
+
+    return node_count
+
+
+def merge_dtk_files(filename, sources, version=None):
+    """
+    Write a new file with the simulation of the first source and the nodes of every source, in order. Chunks are
+    copied as stored (compressed), only the header is rebuilt. A node (externalId) can only be in one source.
+    :param filename: output .dtk filename
+    :param sources: .dtk filenames (version 2 or later)
+    :param version: file format version {2|3}, defaults to the first source's version
+    :return: number of nodes written
+    """
+    dtk_files = [DtkFile(source, mapped=True) for source in sources]
+    try:
+        node_count = 0
+        seen = set()
+        with _copy_writer(filename, dtk_files, version) as writer:
+            _copy_chunk(dtk_files[0], 0, writer)
+            for dtk_file in dtk_files:
+                chunk_ids = _chunk_ids(dtk_file)
+                for index in range(1, dtk_file.node_count + 1):
+                    _copy_chunk(dtk_file, index, writer, chunk_ids, seen)
+                    node_count += 1
+    finally:
+        for dtk_file in dtk_files:
+            dtk_file.close()
+
+    return node_count
+
+
+def _copy_writer(filename, dtk_files, version=None):
+    # Writer for copying chunks from dtk_files, using the first file's metadata and compression settings
+    first = dtk_files[0]
+    for dtk_file in dtk_files:
+        if dtk_file.header.metadata.version < 2:
+            raise UserWarning("'{0}' is a version 1 file, convert it first".format(dtk_file.filename))
+    dictionaries = set(dtk_file.dictionary for dtk_file in dtk_files if dtk_file.dictionary is not None)
+    if len(dictionaries) > 1:
+        raise UserWarning("Files were compressed with different dictionaries and can't be merged without recompression.")
+    metadata = first.header.metadata
+    version = version if version is not None else metadata.version
+
+    checksum = first.checksum if first.checksum in __checksums__ else 'CRC32'
+
+    return DtkWriter(filename, metadata.get('author'), metadata.get('tool'), first.scheme, True, version,
+                     dictionaries.pop() if dictionaries else None, checksum=checksum)
+
+
+def _chunk_ids(dtk_file):
+    # chunk index -> node externalId, from the version 3 index
+
+    return dict((chunk, external_id) for external_id, chunk in dtk_file.node_ids.items()) if dtk_file.node_ids is not None else None
+
+
+def _copy_chunk(dtk_file, index, writer, chunk_ids=None, seen=None):
+    # Copy a chunk as stored, returning the node's externalId if the writer needs it for the version 3 index (or seen).
+    # Delta chunks are rebuilt and recompressed, the output doesn't refer to a base file.
+    # seen collects the externalIds copied so far, a node already in it is refused.
+    if index in dtk_file.chunk_deltas:
+        contents = bytes(dtk_file.get_contents(index))
+        node_id = chunk_ids[index] if chunk_ids is not None else _find_external_id(contents)
+        _check_copied(node_id, dtk_file, seen)
+        writer.add_node(contents, node_id=node_id)
+        return node_id
+
+    chunk = dtk_file.get_chunk(index)
+    scheme = dtk_file.chunk_schemes[index]
+    frames = dtk_file.chunk_frames.get(index)
+    if index == 0:
+        writer.add_simulation(chunk, compressed=True, engine=scheme, frames=frames)
+        return None
+
+    node_id = None
+    if writer.version >= 3 or seen is not None:
+        if chunk_ids is not None:
+            node_id = chunk_ids[index]
+        else:
+            node_id = _find_external_id(dtk_file.get_contents(index))
+    _check_copied(node_id, dtk_file, seen)
+    writer.add_node(chunk, compressed=True, node_id=node_id, engine=scheme, frames=frames)
+
+    return node_id
 
 
-def _prepare_chunk(data, compress, engine, chunks):
-    if compress and engine is not None:
-        data = engine.compress(data)
-    chunks.append(data)
+def _check_copied(node_id, dtk_file, seen):
+    if seen is None or node_id is None:
+        return
+    if node_id in seen:
+        raise UserWarning("Node {0} in '{1}' is already in the merged file".format(node_id, dtk_file.filename))
+    seen.add(node_id)
 
     return
 
 
-def _prepare_node_data(filenames, compress, engine, chunks):
-    for filename in filenames:
-        with open(filename, 'rb') as handle:
-            data = handle.read()
-        _prepare_chunk(data, compress, engine, chunks)
+def _convert_chunks(dtk_file, writer, simulation_engine):
+    text = _text(dtk_file.get_contents(0))
+    node_count = 0
+    try:
+        position = _find_array(text, 'nodes')
+    except UserWarning:
+        position = None     # no embedded nodes
+    if position is not None:
+        # Only the extent of each node is needed, discard objects as they are decoded to keep memory use down
+        decoder = json.JSONDecoder(object_pairs_hook=_discard)
+        end = position
+        for _, start, end in _iter_elements(text, position, 'nodes', decoder):
+            writer.add_node(_encode(text[start:end]))
+            node_count += 1
+        close = _WHITESPACE.match(text, end).end()
+        text = text[:position] + text[close:]   # "nodes":[]
+    writer.add_simulation(_encode(text), engine=simulation_engine)
+    del text
+
+    for index in range(1, dtk_file.node_count + 1):
+        writer.add_node(bytes(dtk_file.get_contents(index)))
+        node_count += 1
+
+    return node_count
+
+
+_DELTA_BASE = '__base__'   # marks a base individual with changed members in a delta chunk
+_DELTA_UNCHANGED = b'{}'   # delta chunk of a node unchanged since the base, chunks can't be empty
+_ORDERED_DECODER = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+
+def _node_chunks(dtk_file):
+    # node externalId -> chunk index
+    if dtk_file.node_ids is not None:
+        return dict(dtk_file.node_ids)
+
+    return dict((_find_external_id(dtk_file.get_contents(index)), index) for index in range(1, dtk_file.node_count + 1))
+
+
+def _base_reference(base_file, filename):
+    # Where to find the base file (relative to the delta file if possible) and a digest to detect it changing
+    reference = OrderedDict()
+    base_filename = os.path.abspath(base_file.filename)
+    try:
+        reference['filename'] = os.path.relpath(base_filename, os.path.dirname(os.path.abspath(filename)))
+    except ValueError:
+        reference['filename'] = base_filename   # different drives on Windows
+    reference['header'] = hashlib.sha1(_encode(base_file.header_text)).hexdigest()
+
+    return reference
+
+
+def _delta_contents(data, base_file, base_chunks):
+    """
+    Encode node JSON against the node with the same externalId in base_file. An unchanged node is the delta {},
+    otherwise the delta is the node JSON with each run
+    of individualHumans unchanged since the base (matched by suid) replaced by [start, stop] base indices, and each
+    changed individual by {"__base__": base index, <changed members>} if that is shorter and rebuilds the individual
+    byte for byte. New individuals are kept.
+    :return: (delta, base chunk index), or (data, None) if there is no base node, the individualHumans array isn't
+             compact (formatted JSON) or the delta isn't smaller
+    """
+    base_index = base_chunks.get(_find_external_id(_encode(data)))
+    if base_index is None:
+        return data, None
+    text = _text(data)
+    base_text = _text(base_file.get_contents(base_index))
+    if text == base_text:
+        return _DELTA_UNCHANGED, base_index
+    try:
+        position = _find_array(text, 'individualHumans')
+        base_position = _find_array(base_text, 'individualHumans')
+    except UserWarning:
+        return data, None
+
+    base_individuals = {}   # suid -> (index, start, end)
+    for index, (element, start, end) in enumerate(_iter_elements(base_text, base_position, 'individualHumans', _PLAIN_DECODER)):
+        base_individuals[_suid(element)] = (index, start, end)
+    base_individuals.pop(None, None)
+
+    entries = []
+    run = None
+    end = previous = position
+    separator = ''
+    for element, start, end in _iter_elements(text, position, 'individualHumans', _PLAIN_DECODER):
+        # _apply_delta() joins individuals with bare commas, so only a compact array is rebuilt byte for byte
+        if text[previous:start] != separator:
+            return data, None
+        previous, separator = end, ','
+        base = base_individuals.get(_suid(element))
+        if base is not None and base_text[base[1]:base[2]] == text[start:end]:
+            if run is not None and run[1] == base[0]:
+                run[1] += 1
+            else:
+                run = [base[0], base[0] + 1]
+                entries.append(run)
+            continue
+        run = None
+        entry = text[start:end]
+        if base is not None:
+            individual = _ORDERED_DECODER.raw_decode(base_text, base[1])[0]
+            members = _changed_members(individual, _ORDERED_DECODER.raw_decode(text, start)[0])
+            if members is not None:
+                patch = json.dumps(OrderedDict([(_DELTA_BASE, base[0])] + list(members.items())), separators=(',', ':'))
+                if len(patch) < len(entry):
+                    # _apply_delta() re-serializes patched individuals, only patch those it rebuilds exactly
+                    _merge_members(individual, members)
+                    if json.dumps(individual, separators=(',', ':')) == entry:
+                        entry = patch
+        entries.append(entry)
+    if _WHITESPACE.match(text, end).end() != end:
+        return data, None
+
+    entries = [json.dumps(entry, separators=(',', ':')) if isinstance(entry, list) else entry for entry in entries]
+    delta = ''.join([text[:position], ','.join(entries), text[end:]])
+    if len(delta) >= len(text):
+        return data, None
+
+    return _encode(delta), base_index
+
+
+def _apply_delta(delta, base_contents):
+    # Rebuild node JSON from a delta chunk and the base chunk it refers to, see _delta_contents(). Patched individuals
+    # are re-serialized with their members in order, which _delta_contents() checked gives back the original bytes.
+    if not len(delta) or bytes(delta) == _DELTA_UNCHANGED:
+        return base_contents
+    text = _text(delta)
+    base_text = _text(base_contents)
+    position = _find_array(text, 'individualHumans')
+    base_spans = [(start, end) for _, start, end in _iter_elements(base_text, _find_array(base_text, 'individualHumans'),
+                                                                  'individualHumans', _PLAIN_DECODER)]
+    pieces = []
+    end = position
+    try:
+        for element, start, end in _iter_elements(text, position, 'individualHumans', _PLAIN_DECODER):
+            if isinstance(element, list):
+                pieces.extend(base_text[base_start:base_end] for base_start, base_end in base_spans[element[0]:element[1]])
+                if element[1] > len(base_spans):
+                    raise IndexError(element[1])
+            elif _DELTA_BASE in element:
+                element = _ORDERED_DECODER.raw_decode(text, start)[0]
+                individual = _ORDERED_DECODER.raw_decode(base_text, base_spans[element.pop(_DELTA_BASE)][0])[0]
+                _merge_members(individual, element)
+                pieces.append(json.dumps(individual, separators=(',', ':')))
+            else:
+                pieces.append(text[start:end])
+    except IndexError:
+        raise UserWarning("Delta chunk refers to individuals missing from its base chunk")
+    close = _WHITESPACE.match(text, end).end()
+
+    return _encode(''.join([text[:position], ','.join(pieces), text[close:]]))
+
+
+def _suid(individual):
+    try:
+        return individual['suid']['id']
+    except (KeyError, TypeError):
+        return None
+
+
+def _changed_members(old, new):
+    # Members of new which differ from old, recursing into objects, or None if new lacks any of old's members
+    if any(key not in new for key in old):
+        return None
+    members = OrderedDict()
+    for key, value in new.items():
+        if key not in old:
+            members[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changed = _changed_members(old[key], value)
+            if changed is None:
+                return None
+            if changed:
+                members[key] = changed
+        elif type(value) is not type(old[key]) or value != old[key]:
+            members[key] = value
+
+    return members
+
+
+def _merge_members(obj, members):
+    for key, value in members.items():
+        if isinstance(value, dict) and isinstance(obj.get(key), dict):
+            _merge_members(obj[key], value)
+        else:
+            obj[key] = value
 
     return
 
 
-def _construct_header(author, tool, engine, chunks):
+def _discard(pairs):
+
+    return None
+
+
+def _encode(text):
+
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+def _construct_header(author, tool, engine, chunk_sizes, version=2, chunk_engines=None, dictionary_chunk=None, chunk_frames=None,
+                      checksum=None, chunk_checksums=None, base=None, chunk_deltas=None):
+    chunk_engines = chunk_engines if chunk_engines is not None else [engine] * len(chunk_sizes)
     header = SerialObject({})
     metadata = header.metadata = SerialObject({})
-    metadata.version = 2
+    metadata.version = version
     metadata.date = time.strftime('%a %b %d %H:%M:%S %Y')
     metadata.author = author if author is not None else "unknown"
     metadata.tool = tool if tool is not None else "unknown"
-    metadata.compressed = True if engine in __engines__ and __engines__[engine] is not None else False
-    metadata.engine = engine if metadata.compressed else "NONE"
-    metadata.bytecount = reduce(lambda acc, chunk: acc + len(chunk), chunks, 0)
-    metadata.chunkcount = len(chunks)
-    metadata.chunksizes = [len(c) for c in chunks]
+    metadata.compressed = any(__engines__.get(scheme) is not None for scheme in chunk_engines)
+    metadata.engine = engine if __engines__.get(engine) is not None else "NONE"
+    metadata.bytecount = sum(chunk_sizes)
+    metadata.chunkcount = len(chunk_sizes)
+    if version < 3:
+        metadata.chunksizes = list(chunk_sizes)
+    if any(scheme != metadata.engine for scheme in chunk_engines):
+        metadata.chunkengines = list(chunk_engines)
+    if dictionary_chunk is not None:
+        metadata.dictionary = dictionary_chunk
+    if chunk_frames:
+        metadata.chunkframes = OrderedDict((str(index), chunk_frames[index]) for index in sorted(chunk_frames))
+    if checksum is not None:
+        metadata.checksum = checksum
+        metadata.chunkchecksums = list(chunk_checksums)
+    if base is not None:
+        metadata.base = base
+        metadata.chunkdeltas = OrderedDict((str(index), chunk_deltas[index]) for index in sorted(chunk_deltas or {}))
 
     return header
 
@@ -304,15 +2581,24 @@ def _write_header(string, handle):
     return
 
 
-def _write_chunks(chunks, handle):
-    for chunk in chunks:
-        handle.write(chunk)
+def _write_index(offset, chunk_sizes, node_ids, handle):
+    index_offset = offset + sum(chunk_sizes)
+    for size in chunk_sizes:
+        handle.write(_INDEX_CHUNK.pack(offset, size))
+        offset += size
+    for chunk, external_id in enumerate(node_ids, 1):
+        handle.write(_INDEX_NODE.pack(external_id, chunk))
+    handle.write(_INDEX_TRAILER.pack(index_offset, len(chunk_sizes), len(node_ids), _INDEX_MAGIC))
 
     return
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('--trace', default=None, help='Write stage timings in Chrome trace format', metavar='<filename>')
+    parser.add_argument('--stats', default=None, help='Write stage timings as JSON', metavar='<filename>')
+    parser.add_argument('--profile', default=None, help='Write cProfile statistics', metavar='<filename>')
+    parser.add_argument('--json', default=None, help='JSON backend {{{0}|AUTO}}'.format('|'.join(dtkJson.__json_backends__.keys())), metavar='<backend>')
     subparsers = parser.add_subparsers(help='add_subparsers help')
 
     read_parser = subparsers.add_parser('read', help='read help')
@@ -321,6 +2607,8 @@ if __name__ == '__main__':
     read_parser.add_argument('-r', '--raw', default=False, action='store_true', help='Write raw contents of chunks to disk')
     read_parser.add_argument('-u', '--unformatted', default=False, action='store_true', help='Write unformatted (compact) JSON to disk')
     read_parser.add_argument('-o', '--output', default=None, help='Output filename prefix, defaults to input filename with .json extension')
+    read_parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of processes writing chunks [1]')
+    read_parser.add_argument('--no-parse', default=False, action='store_true', dest='reindent', help='Format JSON by re-indenting its text without parsing it')
     read_parser.set_defaults(func=__do_read__)
 
     username = os.environ['USERNAME']
@@ -334,8 +2622,79 @@ if __name__ == '__main__':
     write_parser.add_argument('-t', '--tool', default=tool_name, help='Tool name for metadata [{0}]'.format(tool_name))
     write_parser.add_argument('-u', '--uncompressed', default=True, action='store_false', dest='compress', help='Do not compress contents of new .dtk file')
     write_parser.add_argument('-v', '--verify', default=False, action='store_true', help='Verify JSON in simulation and nodes.')
-    write_parser.add_argument('-e', '--engine', default='LZ4', help='Compression engine {NONE|LZ4|SNAPPY} [LZ4]')
+    write_parser.add_argument('-e', '--engine', default='LZ4', help='Compression engine {NONE|LZ4|LZ4HC|SNAPPY|ZSTD}[:level] [LZ4]')
+    write_parser.add_argument('--sim-engine', default=None, help='Compression engine for simulation data [same as --engine]', metavar='<engine>')
+    write_parser.add_argument('--frame-size', default=_FRAME_SIZE, type=int, help='Split chunks larger than this into independently compressed frames [{0}]'.format(_FRAME_SIZE), metavar='<bytes>')
+    write_parser.add_argument('--dictionary-size', default=None, type=int, help='Train a shared compression dictionary of this size over the nodes (ZSTD only)', metavar='<bytes>')
+    write_parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of processes compressing chunks [1]')
+    write_parser.add_argument('-f', '--file-version', default=2, type=int, choices=[2, 3], dest='version', help='File format version, 3 adds a chunk/node index [2]')
+    write_parser.add_argument('-c', '--checksum', default='CRC32', type=lambda name: None if name.upper() == 'NONE' else name.upper(),
+                              help='Per-chunk checksum {{{0}|NONE}} [CRC32]'.format('|'.join(sorted(__checksums__.keys()))), metavar='<algorithm>')
+    write_parser.add_argument('-b', '--base', default=None, help='Write nodes as deltas against this earlier .dtk file', metavar='<filename>')
     write_parser.set_defaults(func=__do_write__)
 
+    convert_parser = subparsers.add_parser('convert', help='convert help')
+    convert_parser.add_argument('source', help='.dtk filename, e.g. a version 1 file')
+    convert_parser.add_argument('destination', nargs='?', default=None, help='Output .dtk filename [replace source]')
+    convert_parser.add_argument('-a', '--author', default=None, help='Author name for metadata [from source]')
+    convert_parser.add_argument('-t', '--tool', default=None, help='Tool name for metadata [from source]')
+    convert_parser.add_argument('-u', '--uncompressed', default=True, action='store_false', dest='compress', help='Do not compress contents of new .dtk file')
+    convert_parser.add_argument('-e', '--engine', default='LZ4', help='Compression engine {NONE|LZ4|LZ4HC|SNAPPY|ZSTD}[:level] [LZ4]')
+    convert_parser.add_argument('--sim-engine', default=None, help='Compression engine for simulation data [same as --engine]', metavar='<engine>')
+    convert_parser.add_argument('-f', '--file-version', default=2, type=int, choices=[2, 3], dest='version', help='File format version [2]')
+    convert_parser.add_argument('-c', '--checksum', default='CRC32', type=lambda name: None if name.upper() == 'NONE' else name.upper(),
+                                help='Per-chunk checksum {{{0}|NONE}} [CRC32]'.format('|'.join(sorted(__checksums__.keys()))), metavar='<algorithm>')
+    convert_parser.add_argument('-b', '--base', default=None, help='Write nodes as deltas against this earlier .dtk file', metavar='<filename>')
+    convert_parser.set_defaults(func=__do_convert__)
+
+    extract_parser = subparsers.add_parser('extract', help='extract help')
+    extract_parser.add_argument('source', help='.dtk filename')
+    extract_parser.add_argument('destination', help='Output .dtk filename')
+    extract_group = extract_parser.add_mutually_exclusive_group(required=True)
+    extract_group.add_argument('-n', '--nodes', nargs='+', type=int, default=None, help='Node indices (0 based) to extract')
+    extract_group.add_argument('-i', '--ids', nargs='+', type=int, default=None, help='Node externalIds to extract')
+    extract_parser.add_argument('-f', '--file-version', default=None, type=int, choices=[2, 3], dest='version', help='File format version [same as source]')
+    extract_parser.set_defaults(func=__do_extract__)
+
+    merge_parser = subparsers.add_parser('merge', help='merge help')
+    merge_parser.add_argument('destination', help='Output .dtk filename')
+    merge_parser.add_argument('sources', nargs='+', help='.dtk filenames, the simulation is taken from the first')
+    merge_parser.add_argument('-f', '--file-version', default=None, type=int, choices=[2, 3], dest='version', help='File format version [same as first source]')
+    merge_parser.set_defaults(func=__do_merge__)
+
+    verify_parser = subparsers.add_parser('verify', help='verify help')
+    verify_parser.add_argument('filenames', nargs='+', help='.dtk filename(s)')
+    verify_parser.add_argument('-j', '--jobs', default=None, type=int, help='Number of processes verifying chunks [1]')
+    verify_parser.set_defaults(func=__do_verify__)
+
+    batch_parser = subparsers.add_parser('batch', help='batch help')
+    batch_parser.add_argument('operation', choices=sorted(__batch_operations__.keys()), help='Operation to run on each file')
+    batch_parser.add_argument('patterns', nargs='*', help='.dtk filename(s) or glob pattern(s), e.g. "output/state-*.dtk", '
+                                                          'for write <prefix>.sim.json filename(s) with nodes in <prefix>.node-<n>.json')
+    batch_parser.add_argument('-m', '--manifest', default=None, help='File listing one filename or pattern per line', metavar='<filename>')
+    batch_parser.add_argument('-j', '--jobs', default=None, type=int, help='Number of worker processes [CPU count]')
+    batch_parser.add_argument('-o', '--output-dir', default=None, help='Directory for read/convert/write output [next to each file/in place]', metavar='<directory>')
+    batch_parser.add_argument('-r', '--raw', default=False, action='store_true', help='read: write raw contents of chunks to disk')
+    batch_parser.add_argument('-u', '--unformatted', default=False, action='store_true', help='read: write unformatted (compact) JSON to disk')
+    batch_parser.add_argument('-e', '--engine', default='LZ4', help='convert/write: compression engine [LZ4]')
+    batch_parser.add_argument('-f', '--file-version', default=2, type=int, choices=[2, 3], dest='version', help='convert/write: file format version [2]')
+    batch_parser.add_argument('--report', default=None, help='Write summary and failures as JSON', metavar='<filename>')
+    batch_parser.set_defaults(func=__do_batch__)
+
     commandline_args = parser.parse_args()
-    commandline_args.func(commandline_args)
+    if commandline_args.json is not None:
+        dtkJson.set_default_backend(commandline_args.json)
+    instrumented = commandline_args.trace or commandline_args.stats or commandline_args.profile
+    if instrumented:
+        recorder = dtkInstrumentation.enable(dtkInstrumentation.Recorder(profile=commandline_args.profile is not None))
+    try:
+        commandline_args.func(commandline_args)
+    finally:
+        if instrumented:
+            dtkInstrumentation.disable()
+            if commandline_args.trace is not None:
+                recorder.write_chrome_trace(commandline_args.trace)
+            if commandline_args.stats is not None:
+                recorder.write_json(commandline_args.stats)
+            if commandline_args.profile is not None:
+                recorder.write_profile(commandline_args.profile)
@@ -0,0 +1,308 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer
+
+import dtkFileTools
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on Windows, peak RSS is reported as None
+
+
+def synthesize_simulation(node_count, population):
+    """
+    :param node_count: number of nodes in the simulation
+    :param population: number of individuals per node
+    :return: simulation JSON, modelled on test-data/two-node/state-00010.sim.json
+    """
+
+    next_id = node_count * population + 1
+    simulation = OrderedDict([
+        ('__class__', 'Simulation'),
+        ('serializationMask', 3),
+        ('infectionSuidGenerator', {'next_suid': {'id': next_id}, 'rank': 0, 'numtasks': 1}),
+        ('individualHumanSuidGenerator', {'next_suid': {'id': next_id}, 'rank': 0, 'numtasks': 1}),
+        ('nodes', []),
+        ('campaignFilename', 'campaign.json'),
+        ('Ind_Sample_Rate', 1),
+        ('sim_type', 0),
+        ('Run_Number', 1)])
+
+    return json.dumps({'simulation': simulation}, separators=(',', ':'))
+
+
+def synthesize_node(external_id, population, first_suid=1, rng=None):
+    """
+    :param external_id: node externalId (and suid)
+    :param population: number of individuals in the node
+    :param first_suid: suid of the first individual
+    :param rng: random.Random instance, for reproducible ages and infection states
+    :return: node JSON, modelled on test-data/two-node/state-00010.node-1.json
+    """
+
+    rng = rng if rng is not None else random.Random(external_id)
+    individuals = [_synthesize_individual(suid, external_id, rng) for suid in range(first_suid, first_suid + population)]
+    node = OrderedDict([
+        ('__class__', 'Node'),
+        ('serializationMask', 3),
+        ('suid', {'id': external_id}),
+        ('externalId', external_id),
+        ('home_individual_ids', [{'key': suid, 'value': {'id': suid}} for suid in range(first_suid, first_suid + population)]),
+        ('individualHumans', individuals),
+        ('ind_sampling_type', 0),
+        ('population_density_c50', 30),
+        ('population_scaling_factor', 1),
+        ('maternal_transmission', False),
+        ('vital_birth', False),
+        ('x_birth', 1)])
+
+    return json.dumps(OrderedDict([('suid', {'id': external_id}), ('node', node)]), separators=(',', ':'))
+
+
+def _synthesize_individual(suid, node_id, rng):
+    age = round(rng.uniform(0, 36500), 2)
+    infected = rng.random() < 0.1
+
+    return OrderedDict([
+        ('__class__', 'IndividualHuman'),
+        ('suid', {'id': suid}),
+        ('m_age', age),
+        ('m_gender', rng.randint(0, 1)),
+        ('m_mc_weight', 1),
+        ('m_daily_mortality_rate', 0),
+        ('above_poverty', 0),
+        ('is_pregnant', False),
+        ('pregnancy_timer', 0),
+        ('susceptibility', OrderedDict([('__class__', 'Susceptibility'), ('age', age), ('mod_acquire', 0 if infected else 1), ('mod_transmit', 0), ('mod_mortality', 0), ('acqdecayoffset', -1), ('trandecayoffset', -1), ('mortdecayoffset', -1)])),
+        ('infections', []),
+        ('interventions', OrderedDict([('__class__', 'InterventionsContainer'), ('drugVaccineReducedAcquire', 1), ('drugVaccineReducedTransmit', 1), ('drugVaccineReducedMortality', 1), ('interventions', [])])),
+        ('m_is_infected', infected),
+        ('infectiousness', 0),
+        ('Inf_Sample_Rate', 1),
+        ('cumulativeInfs', 1 if infected else 0),
+        ('m_new_infection_state', 0),
+        ('StateChange', 0),
+        ('migration_mod', 1),
+        ('migration_type', 0),
+        ('migration_destination', {'id': 0}),
+        ('migration_time_until_trip', 0),
+        ('migration_time_at_destination', 0),
+        ('migration_is_destination_new_home', False),
+        ('migration_will_return', True),
+        ('migration_outbound', True),
+        ('max_waypoints', 0),
+        ('waypoints', []),
+        ('waypoints_trip_type', []),
+        ('home_node_id', {'id': node_id}),
+        ('Properties', []),
+        ('waiting_for_family_trip', False),
+        ('leave_on_family_trip', False),
+        ('is_on_family_trip', False),
+        ('family_migration_type', 0),
+        ('family_migration_time_until_trip', 0),
+        ('family_migration_time_at_destination', 0),
+        ('family_migration_is_destination_new_home', False),
+        ('family_migration_destination', {'id': 0})])
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """
+    :param samples: sequence of durations (seconds)
+    :param points: percentiles to report
+    :return: OrderedDict of 'pNN' -> duration, nearest-rank method
+    """
+
+    ordered = sorted(samples)
+    result = OrderedDict()
+    for point in points:
+        if ordered:
+            rank = max(int(math.ceil(point / 100.0 * len(ordered))) - 1, 0)
+            result['p{0}'.format(point)] = ordered[rank]
+        else:
+            result['p{0}'.format(point)] = None
+
+    return result
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in bytes, None if unavailable. The peak never decreases, so
+             run_benchmarks() benchmarks each engine in a new process.
+    """
+
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return usage if sys.platform == 'darwin' else usage * 1024   # kilobytes on Linux
+
+
+def _summarize(durations, byte_count, node_count):
+    total = sum(durations)
+    summary = OrderedDict()
+    summary['seconds'] = total
+    summary['bytes'] = byte_count
+    summary['mb_per_second'] = (byte_count / float(1 << 20)) / total if total > 0 else None
+    summary['nodes_per_second'] = node_count / total if total > 0 else None
+    summary.update(percentiles(durations))
+
+    return summary
+
+
+def benchmark_engine(scheme, simulation, nodes, directory, repeat=3):
+    """
+    Time the stages of writing and reading a file with one compression engine:
+    - write: DtkWriter compress + write
+    - write_dtk_file: the write command's pipeline, from JSON files on disk
+    - read, decompress, parse: each step of decoding a chunk on its own
+    - get_contents, get_object: the public read + decompress (+ parse) paths
+    Read stages are timed per chunk, write stages per file.
+    :param scheme: engine name from dtkFileTools.__engines__
+    :param simulation: simulation JSON
+    :param nodes: list of node JSON
+    :param directory: directory for the temporary .dtk and JSON files
+    :param repeat: number of times to repeat each stage
+    :return: OrderedDict of results, stage -> summary
+    """
+
+    filename = os.path.join(directory, 'benchmark-{0}.dtk'.format(scheme.lower()))
+    sources = [os.path.join(directory, 'benchmark-{0}.json'.format(index)) for index in range(len(nodes) + 1)]
+    for source, text in zip(sources, [simulation] + nodes):
+        with open(source, 'wb') as handle:
+            handle.write(text.encode('utf-8') if not isinstance(text, bytes) else text)
+    raw_bytes = len(simulation) + sum(len(node) for node in nodes)
+    stages = OrderedDict((stage, []) for stage in ['write', 'write_dtk_file', 'read', 'decompress', 'parse', 'get_contents', 'get_object'])
+    chunk_count = len(nodes) + 1
+
+    try:
+        for _ in range(repeat):
+            start = default_timer()
+            dtkFileTools.write_dtk_file(filename, sources[0], sources[1:], 'benchmark', 'dtkFileToolsBenchmark.py', engine=scheme)
+            stages['write_dtk_file'].append(default_timer() - start)
+
+            start = default_timer()
+            with dtkFileTools.DtkWriter(filename, author='benchmark', tool='dtkFileToolsBenchmark.py', engine=scheme) as writer:
+                writer.add_simulation(simulation)
+                for node in nodes:
+                    writer.add_node(node)
+            stages['write'].append(default_timer() - start)
+
+            dtk_file = dtkFileTools.DtkFile(filename)
+            for index in range(chunk_count):
+                start = default_timer()
+                chunk = dtk_file.get_chunk(index)
+                stages['read'].append(default_timer() - start)
+
+                start = default_timer()
+                contents = dtkFileTools._decompress(dtk_file.get_engine(index), chunk)
+                stages['decompress'].append(default_timer() - start)
+
+                start = default_timer()
+                dtkFileTools._parse(contents)
+                stages['parse'].append(default_timer() - start)
+
+                start = default_timer()
+                dtk_file.get_contents(index)
+                stages['get_contents'].append(default_timer() - start)
+
+                start = default_timer()
+                dtk_file.get_object(index)
+                stages['get_object'].append(default_timer() - start)
+            dtk_file.close()
+
+        file_bytes = os.path.getsize(filename)
+    finally:
+        for source in sources + [filename]:
+            if os.path.exists(source):
+                os.remove(source)
+
+    results = OrderedDict()
+    results['engine'] = scheme
+    results['file_bytes'] = file_bytes
+    results['ratio'] = raw_bytes / float(file_bytes)
+    for stage, durations in stages.items():
+        results[stage] = _summarize(durations, (file_bytes if stage == 'read' else raw_bytes) * repeat, len(nodes) * repeat)
+    results['peak_rss'] = peak_rss()
+
+    return results
+
+
+def _benchmark_engine_process(task):
+    # Runs in a new worker process per engine, so peak_rss() is this engine's own peak rather than the running maximum
+    # over every engine so far.
+
+    return benchmark_engine(*task)
+
+
+def run_benchmarks(node_count=2, population=2500, engines=None, repeat=3, directory=None, seed=42):
+    """
+    :param node_count: number of synthesized nodes
+    :param population: number of individuals per synthesized node
+    :param engines: engine names to benchmark, defaults to every engine in dtkFileTools.__engines__
+    :param repeat: number of times to repeat each stage
+    :param directory: directory for temporary files, defaults to a new temporary directory
+    :param seed: random seed for synthesized data
+    :return: OrderedDict of parameters and per-engine results, suitable for json.dump()
+    """
+
+    engines = engines if engines is not None else sorted(dtkFileTools.__engines__.keys())
+    rng = random.Random(seed)
+    simulation = synthesize_simulation(node_count, population)
+    nodes = [synthesize_node(index + 1, population, index * population + 1, rng) for index in range(node_count)]
+
+    cleanup = directory is None
+    directory = directory if directory is not None else tempfile.mkdtemp()
+    try:
+        results = OrderedDict()
+        results['nodes'] = node_count
+        results['population'] = population
+        results['repeat'] = repeat
+        results['seed'] = seed
+        results['json_bytes'] = len(simulation) + sum(len(node) for node in nodes)
+        results['engines'] = []
+        for scheme in engines:
+            pool = multiprocessing.Pool(1)
+            try:
+                results['engines'].append(pool.apply(_benchmark_engine_process, [(scheme.upper(), simulation, nodes, directory, repeat)]))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        if cleanup:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reading and writing DTK serialized population files.')
+    parser.add_argument('-n', '--nodes', default=2, type=int, help='Number of nodes to synthesize [2]')
+    parser.add_argument('-p', '--population', default=2500, type=int, help='Individuals per node [2500]')
+    parser.add_argument('-e', '--engines', default=None, nargs='+', help='Compression engines to benchmark [all]')
+    parser.add_argument('-r', '--repeat', default=3, type=int, help='Repetitions of each stage [3]')
+    parser.add_argument('-s', '--seed', default=42, type=int, help='Random seed for synthesized data [42]')
+    parser.add_argument('-d', '--directory', default=None, help='Directory for temporary files [system temp]')
+    parser.add_argument('-o', '--output', default=None, help='Write JSON results to file [stdout]')
+    commandline_args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(commandline_args.nodes, commandline_args.population, commandline_args.engines,
+                                       commandline_args.repeat, commandline_args.directory, commandline_args.seed)
+
+    if commandline_args.output is not None:
+        with open(commandline_args.output, 'wb') as handle:
+            json.dump(benchmark_results, handle, indent=2, separators=(',', ': '))
+    else:
+        print(json.dumps(benchmark_results, indent=2, separators=(',', ': ')))
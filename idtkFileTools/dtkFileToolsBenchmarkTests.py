@@ -0,0 +1,46 @@
+#!/usr/bin/python
+
+import dtkFileTools
+import dtkFileToolsBenchmark
+import json
+import unittest
+
+
+class TestSynthesizing(unittest.TestCase):
+
+    def test_synthesized_node(self):
+        node = json.loads(dtkFileToolsBenchmark.synthesize_node(3, 10, first_suid=21), object_hook=dtkFileTools.SerialObject).node
+        self.assertEqual(3, node.externalId)
+        self.assertEqual(10, len(node.individualHumans))
+        self.assertEqual(21, node.individualHumans[0].suid.id)
+        self.assertEqual('IndividualHuman', node.individualHumans[-1]['__class__'])
+        return
+
+    def test_synthesized_data_is_reproducible(self):
+        first = dtkFileToolsBenchmark.synthesize_node(1, 10)
+        second = dtkFileToolsBenchmark.synthesize_node(1, 10)
+        self.assertEqual(first, second)
+        return
+
+
+class TestBenchmarking(unittest.TestCase):
+
+    def test_percentiles(self):
+        samples = [float(value) for value in range(1, 101)]
+        self.assertEqual({'p50': 50.0, 'p90': 90.0, 'p99': 99.0}, dict(dtkFileToolsBenchmark.percentiles(samples)))
+        self.assertEqual(3.0, dtkFileToolsBenchmark.percentiles([3.0])['p99'])
+        return
+
+    def test_run_benchmarks(self):
+        results = dtkFileToolsBenchmark.run_benchmarks(node_count=2, population=20, engines=['lz4', 'NONE'], repeat=1)
+        self.assertEqual(['LZ4', 'NONE'], [engine['engine'] for engine in results['engines']])
+        for engine in results['engines']:
+            for stage in ['write', 'write_dtk_file', 'read', 'decompress', 'parse', 'get_contents', 'get_object']:
+                self.assertTrue(engine[stage]['seconds'] >= 0)
+                self.assertTrue('p99' in engine[stage])
+        json.dumps(results)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,16 @@
 #!/usr/bin/python
 
 import dtkFileTools
+import dtkInstrumentation
+import io
 import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+from collections import OrderedDict
 
 
 # Reading Tests
@@ -236,6 +244,318 @@ class TestReadingHappyPath(unittest.TestCase):
         return
 
 
+class TestReadingMapped(unittest.TestCase):
+
+    def test_reading_mapped_uncompressed(self):
+        with dtkFileTools.DtkFile('test-data/one-node/state-00010.dtk.none', mapped=True) as dtk_file:
+            self.assertTrue(dtk_file.mapped)
+            with open('test-data/one-node/state-00010.sim.json', 'rb') as handle:
+                expected_sim_chunk = handle.read()
+            self.assertEqual(expected_sim_chunk, bytes(dtk_file.get_chunk(0)))
+            obj = json.loads(expected_sim_chunk, object_hook=dtkFileTools.SerialObject)
+            self.assertEqual(obj, dtk_file.get_object(0))
+            with open('test-data/one-node/state-00010.node.json', 'rb') as handle:
+                expected_node_chunk = handle.read()
+            self.assertEqual(expected_node_chunk, bytes(dtk_file.get_chunk(1)))
+        self.assertFalse(dtk_file.mapped)
+        return
+
+    def test_closing_with_chunks_referenced(self):
+        with open('test-data/one-node/state-00010.node.json', 'rb') as handle:
+            expected = handle.read()
+        dtk_file = dtkFileTools.DtkFile('test-data/one-node/state-00010.dtk.none', mapped=True)
+        chunk = dtk_file.get_chunk(1)
+        contents = dtk_file.get_contents(1)
+        dtk_file.close()    # raised BufferError on Python 3 while views of the mapping were referenced
+        self.assertFalse(dtk_file.mapped)
+        with dtkFileTools.DtkFile('test-data/one-node/state-00010.dtk.none', mapped=True) as dtk_file:
+            sim_chunk = dtk_file.get_contents(0)
+        if sys.version_info[0] >= 3:
+            # Python 2 buffers of a closed mapping can't be read
+            self.assertEqual(expected, bytes(chunk))
+            self.assertEqual(expected, bytes(contents))
+            with open('test-data/one-node/state-00010.sim.json', 'rb') as handle:
+                self.assertEqual(handle.read(), bytes(sim_chunk))
+        return
+
+    def test_reading_mapped_ellzeefour(self):
+        with dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', mapped=True) as dtk_file:
+            with open('test-data/two-node/state-00010.node-1.lz4', 'rb') as handle:
+                expected_node_chunk = handle.read()
+            self.assertEqual(expected_node_chunk, bytes(dtk_file.get_chunk(1)))
+            with open('test-data/two-node/state-00010.node-1.json', 'rb') as handle:
+                expected_node_content = handle.read()
+            self.assertEqual(expected_node_content, dtk_file.get_contents(1))
+            unmapped = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+            self.assertEqual(unmapped.get_object(2), dtk_file.get_object(2))
+            self.assertEqual(unmapped.sim, dtk_file.sim)
+        return
+
+    def test_reading_mapped_truncated_file(self):
+        with self.assertRaises(UserWarning):
+            with dtkFileTools.DtkFile('test-data/truncated.dtk', mapped=True) as dtk_file:
+                node_one = dtk_file.get_object(1)
+        return
+
+
+class TestCachingObjects(unittest.TestCase):
+
+    def test_cached_objects_are_reused(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_entries=2)
+        self.assertIs(dtk_file.sim, dtk_file.sim)
+        self.assertIs(dtk_file.nodes[0], dtk_file.nodes[0])
+        uncached = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        self.assertIsNot(uncached.nodes[0], uncached.nodes[0])
+        return
+
+    def test_cache_evicts_least_recently_used(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_entries=2)
+        sim = dtk_file.sim
+        node_one = dtk_file.nodes[0]
+        self.assertIs(sim, dtk_file.sim)        # sim is now most recently used
+        node_two = dtk_file.nodes[1]            # evicts node 1
+        self.assertIs(sim, dtk_file.sim)
+        self.assertIs(node_two, dtk_file.nodes[1])
+        self.assertIsNot(node_one, dtk_file.nodes[0])
+        return
+
+    def test_cache_byte_budget(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_bytes=1024)
+        self.assertIs(dtk_file.sim, dtk_file.sim)
+        self.assertIsNot(dtk_file.nodes[0], dtk_file.nodes[0])     # node chunks exceed the budget
+        dtk_file.clear_cache()
+        return
+
+    def test_disk_cache_skips_decoding(self):
+        directory = tempfile.mkdtemp()
+        try:
+            expected = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory).nodes[1]
+            pool = multiprocessing.Pool(1)
+            pool.map(_load_cached_nodes, [directory])     # another process finds the node cached and adds the rest
+            pool.close()
+            pool.join()
+            self.assertEqual(3, len(os.listdir(directory)))
+            recorder = dtkInstrumentation.enable()
+            try:
+                dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory)
+                nodes = list(dtk_file.nodes)
+            finally:
+                dtkInstrumentation.disable()
+            self.assertEqual(expected, nodes[1])
+            self.assertEqual(1, nodes[0].individualHumans[0].suid.id)
+            nodes[0].individualHumans[0].m_age = 1.5
+            self.assertEqual(1.5, nodes[0].individualHumans[0]['m_age'])    # unpickled objects keep attribute/item aliasing
+            self.assertEqual(['read cache', 'read cache'], [span.label for span in recorder.spans])
+            compact = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory, compact=True)
+            self.assertIsInstance(compact.nodes[0], dtkFileTools.CompactObject)
+            self.assertEqual(4, len(os.listdir(directory)))
+            compact.clear_cache(disk=True)
+            self.assertEqual([], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    def test_disk_cache_eviction(self):
+        directory = tempfile.mkdtemp()
+        try:
+            dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory, cache_dir_bytes=1 << 20)
+            sim = dtk_file.sim
+            self.assertEqual(1, len(os.listdir(directory)))
+            node = dtk_file.nodes[0]
+            self.assertEqual([], os.listdir(directory))         # the node entry alone exceeds the budget
+            dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory)
+            dtk_file.sim
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), 'wb') as handle:
+                    handle.write(b'not a pickle')
+            self.assertEqual(sim, dtk_file.sim)                 # unreadable entries are decoded again
+            self.assertEqual(node, dtk_file.nodes[0])
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    @unittest.skipIf(not hasattr(os, 'getuid'), 'POSIX permissions')
+    def test_disk_cache_directory_must_be_private(self):
+        directory = tempfile.mkdtemp()
+        try:
+            os.environ['DTK_CACHE_DIR'] = directory
+            dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4').sim
+            self.assertEqual([], os.listdir(directory))         # only an explicit cache_dir enables the cache
+            os.chmod(directory, 0o777)
+            with self.assertRaises(UserWarning):
+                dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory)
+            created = os.path.join(directory, 'created')
+            dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=created).sim
+            self.assertEqual(0, os.stat(created).st_mode & 0o077)
+        finally:
+            del os.environ['DTK_CACHE_DIR']
+            shutil.rmtree(directory)
+        return
+
+
+def _load_cached_nodes(directory):
+    # Runs in a pool worker, see test_disk_cache_skips_decoding()
+    dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', cache_dir=directory)
+    dtk_file.sim
+    list(dtk_file.nodes)
+
+    return
+
+
+class TestDtkNodes(unittest.TestCase):
+
+    def test_nodes_length_iteration_and_slicing(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        self.assertEqual(2, len(dtk_file.nodes))
+        nodes = list(dtk_file.nodes)
+        self.assertEqual(2, len(nodes))
+        self.assertEqual(nodes, dtk_file.nodes[:])
+        self.assertEqual([nodes[1]], dtk_file.nodes[1:])
+        self.assertEqual(nodes[1], dtk_file.nodes[-1])
+        with self.assertRaises(IndexError):
+            node = dtk_file.nodes[2]
+        return
+
+
+class TestIteratingIndividuals(unittest.TestCase):
+
+    def test_iterating_individuals(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy')
+        expected = dtk_file.nodes[1].individualHumans
+        actual = list(dtk_file.iter_individuals(1))
+        self.assertEqual(len(expected), len(actual))
+        self.assertEqual(expected, actual)
+        self.assertEqual(expected[0].m_age, actual[0].m_age)
+        return
+
+    def test_iterating_empty_and_missing_arrays(self):
+        self.assertEqual([], list(dtkFileTools._iter_array('{"node":{"individualHumans": [ ]}}', 'individualHumans')))
+        self.assertEqual([1, 2], list(dtkFileTools._iter_array('{"node":{"individualHumans":[ 1 , 2 ]}}', 'individualHumans')))
+        with self.assertRaises(UserWarning):
+            list(dtkFileTools._iter_array('{"node":{}}', 'individualHumans'))
+        with self.assertRaises(UserWarning):
+            list(dtkFileTools._iter_array('{"node":{"individualHumans":[1 2]}}', 'individualHumans'))
+        return
+
+    def test_iterating_across_frames(self):
+        text = u'{"node":{"name":"\u00e9t\u00e9", "individualHumans" :\n [ {"m_age":12.5,"name":"\u00e9"} , 345 ,[]] }}'.encode('utf-8')
+        expected = list(dtkFileTools._iter_array(text, 'individualHumans'))
+        self.assertEqual(3, len(expected))
+        for size in range(1, 9):
+            frames = [text[offset:offset + size] for offset in range(0, len(text), size)]
+            self.assertEqual(expected, list(dtkFileTools._iter_array_frames(frames, 'individualHumans')), size)
+            with self.assertRaises(UserWarning):
+                list(dtkFileTools._iter_array_frames(frames[:-4], 'individualHumans'))
+        return
+
+    def test_iterating_block_split_chunks(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        source = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy')
+        with dtkFileTools.DtkWriter(temp_filename, engine='SNAPPY', frame_size=1 << 14) as writer:
+            writer.add_simulation(source.get_contents(0))
+            writer.add_node(source.get_contents(2))
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertGreater(len(dtk_file.chunk_frames[1]), 100)
+        self.assertEqual(source.nodes[1].individualHumans, list(dtk_file.iter_individuals(0)))
+        os.remove(temp_filename)
+        return
+
+
+class TestIndividualArrays(unittest.TestCase):
+
+    def test_individuals_to_columns(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        fields = ['m_age', 'm_gender', 'm_is_infected', 'susceptibility.mod_acquire']
+        columns = dtk_file.individuals_to_arrays(fields)
+        self.assertEqual(fields, list(columns.keys()))
+        individuals = dtk_file.nodes[0].individualHumans + dtk_file.nodes[1].individualHumans
+        self.assertEqual([individual.m_age for individual in individuals], list(columns['m_age']))
+        self.assertEqual([individual.m_is_infected for individual in individuals], list(columns['m_is_infected']))
+        self.assertEqual([individual.susceptibility.mod_acquire for individual in individuals], list(columns['susceptibility.mod_acquire']))
+        return
+
+    def test_individuals_to_structured_array(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        array = dtk_file.individuals_to_arrays(['m_age', 'suid.id'], nodes=[1], structured=True)
+        individuals = dtk_file.nodes[1].individualHumans
+        self.assertEqual(len(individuals), len(array))
+        self.assertEqual(individuals[-1].suid.id, array['suid.id'][-1])
+        self.assertEqual(individuals[0].m_age, array[0]['m_age'])
+        return
+
+    def test_individuals_to_arrays_missing_field(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        with self.assertRaises(UserWarning):
+            dtk_file.individuals_to_arrays(['susceptibility.no_such_field'], nodes=[0])
+        return
+
+
+class TestCompactObjects(unittest.TestCase):
+
+    def test_compact_node_matches_serial_node(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        compact_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', compact=True)
+        node = compact_file.nodes[0]
+        self.assertIsInstance(node, dtkFileTools.CompactObject)
+        self.assertEqual(dtk_file.nodes[0], node)
+        self.assertEqual(dtk_file.sim, compact_file.sim)
+        first, second = node.individualHumans[0], node.individualHumans[1]
+        self.assertIs(first._schema, second._schema)
+        self.assertEqual(first['m_age'], first.m_age)
+        self.assertEqual(first.susceptibility.mod_acquire, first['susceptibility']['mod_acquire'])
+        return
+
+    def test_compact_object_access(self):
+        obj = dtkFileTools.CompactObject([('__class__', 'Thing'), ('a', 1)])
+        obj.a = 2
+        obj['b'] = 3
+        self.assertEqual({'__class__': 'Thing', 'a': 2, 'b': 3}, obj)
+        self.assertEqual(3, obj.b)
+        self.assertTrue('b' in obj)
+        self.assertEqual(['__class__', 'a', 'b'], list(obj))
+        with self.assertRaises(KeyError):
+            value = obj['c']
+        with self.assertRaises(AttributeError):
+            value = obj.c
+        return
+
+    def test_compact_nodes_in_worker_processes(self):
+        compact_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', compact=True)
+        loaded = list(compact_file.load_nodes(workers=2))
+        self.assertEqual(compact_file.nodes[1], loaded[1][1])
+        self.assertEqual(compact_file.nodes[1].externalId, loaded[1][1].externalId)
+        self.assertEqual(list(compact_file.iter_individuals(0)), compact_file.nodes[0].individualHumans)
+        return
+
+
+class TestLoadingNodes(unittest.TestCase):
+
+    def test_loading_nodes_processes(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        loaded = list(dtk_file.load_nodes(workers=2, executor='process'))
+        self.assertEqual([0, 1], [index for index, _ in loaded])
+        self.assertEqual(dtk_file.nodes[0], loaded[0][1])
+        self.assertEqual(dtk_file.nodes[1], loaded[1][1])
+        loaded[0][1].externalId = 42
+        self.assertEqual(42, loaded[0][1]['externalId'])
+        return
+
+    def test_loading_nodes_threads_unordered(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy', mapped=True)
+        loaded = dict(dtk_file.load_nodes(indices=[1, 0], workers=2, executor='thread', ordered=False))
+        self.assertEqual(dtk_file.nodes[0], loaded[0])
+        self.assertEqual(dtk_file.nodes[1], loaded[1])
+        dtk_file.close()
+        return
+
+    def test_loading_nodes_unknown_executor(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        with self.assertRaises(UserWarning):
+            list(dtk_file.load_nodes(executor='fibers'))
+        return
+
+
 class TestReadingSadPath(unittest.TestCase):
 
     def test_reading_wrong_magic_number(self):
@@ -420,5 +740,673 @@ class TestWritingSadPath(unittest.TestCase):
         self.assertTrue(False)
         return
 
+
+class TestWritingParallel(unittest.TestCase):
+
+    def test_multi_node_lz4_jobs(self):
+        sim = 'test-data/two-node/state-00010.sim.json'
+        nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, sim, nodes, author='clorton', tool='editor', engine='LZ4', jobs=2)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        chunks = [dtk_file.get_chunk(index) for index in range(dtk_file.chunk_count)]
+        os.remove(temp_filename)
+        self.assertEqual('LZ4', dtk_file.header.metadata.engine)
+        self.assertEqual([len(chunk) for chunk in chunks], dtk_file.header.metadata.chunksizes)
+        for filename, chunk in zip([sim] + nodes, chunks):
+            with open(filename, 'rb') as handle:
+                self.assertEqual(handle.read(), dtkFileTools.lz4.decompress(chunk))
+        return
+
+    def test_multi_node_uncompressed_jobs(self):
+        sim = 'test-data/two-node/state-00010.sim.json'
+        nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, sim, nodes, engine='LZ4', compress=False, jobs=2)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        contents = [dtk_file.get_contents(index) for index in range(dtk_file.chunk_count)]
+        os.remove(temp_filename)
+        self.assertEqual('NONE', dtk_file.header.metadata.engine)
+        for filename, content in zip([sim] + nodes, contents):
+            with open(filename, 'rb') as handle:
+                self.assertEqual(handle.read(), content)
+        return
+
+
+class TestDtkWriter(unittest.TestCase):
+
+    def test_streaming_writer_snappy(self):
+        with open('test-data/two-node/state-00010.sim.json', 'rb') as handle:
+            sim = handle.read()
+        nodes = []
+        for filename in ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']:
+            with open(filename, 'rb') as handle:
+                nodes.append(handle.read())
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, author='clorton', tool='editor', engine='snappy') as writer:
+            writer.add_node(nodes[0])           # simulation is always written as chunk 0, regardless of order added
+            writer.add_simulation(sim)
+            writer.add_node(nodes[1])
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        contents = [dtk_file.get_contents(index) for index in range(dtk_file.chunk_count)]
+        os.remove(temp_filename)
+        self.assertEqual('SNAPPY', dtk_file.header.metadata.engine)
+        self.assertEqual('clorton', dtk_file.header.metadata.author)
+        self.assertEqual(3, dtk_file.header.metadata.chunkcount)
+        self.assertEqual([sim] + nodes, contents)
+        return
+
+    def test_streaming_writer_without_simulation(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        writer = dtkFileTools.DtkWriter(temp_filename)
+        writer.add_node('{"node":{}}')
+        with self.assertRaises(UserWarning):
+            writer.close()
+        with self.assertRaises(UserWarning):
+            writer.add_node('{"node":{}}')
+        os.remove(temp_filename)
+        return
+
+
+class TestVersionThree(unittest.TestCase):
+
+    sim = 'test-data/two-node/state-00010.sim.json'
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def test_writing_and_reading_version_three(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, engine='LZ4', jobs=2, version=3)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        contents = [dtk_file.get_contents(index) for index in range(dtk_file.chunk_count)]
+        self.assertEqual(3, dtk_file.header.metadata.version)
+        self.assertFalse('chunksizes' in dtk_file.header.metadata)
+        self.assertEqual({1: 1, 2: 2}, dtk_file.node_ids)
+        self.assertEqual(2, dtk_file.get_node_by_id(2).externalId)
+        with self.assertRaises(KeyError):
+            dtk_file.get_node_by_id(3)
+        with dtkFileTools.DtkFile(temp_filename, mapped=True) as mapped_file:
+            self.assertEqual(dtk_file.nodes[0], mapped_file.get_node_by_id(1))
+        os.remove(temp_filename)
+        for filename, content in zip([self.sim] + self.nodes, contents):
+            with open(filename, 'rb') as handle:
+                self.assertEqual(handle.read(), content)
+        return
+
+    def test_writing_version_three_needs_node_ids(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, version=3) as writer:
+            writer.add_simulation('{"simulation":{}}')
+            writer.add_node(dtkFileTools.lz4.compress('{"node":{"externalId":7}}'), compressed=True, node_id=7)
+            with self.assertRaises(UserWarning):
+                writer.add_node(dtkFileTools.lz4.compress('{"node":{"externalId":8}}'), compressed=True)
+            with self.assertRaises(ValueError):
+                writer.add_node(dtkFileTools.lz4.compress('{"node":{"externalId":7}}'), compressed=True, node_id=7)
+            with self.assertRaises(ValueError):
+                writer.add_node('{"node":{"externalId":7}}')
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual(1, dtk_file.node_count)
+        self.assertEqual({7: 1}, dtk_file.node_ids)
+        self.assertEqual({'externalId': 7}, dtk_file.get_node_by_id(7))
+        os.remove(temp_filename)
+        return
+
+    def test_reading_version_three_bad_index(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, version=3)
+        with open(temp_filename, 'r+b') as handle:
+            handle.seek(-4, os.SEEK_END)
+            handle.write('XXXX')
+        with self.assertRaises(UserWarning):
+            dtk_file = dtkFileTools.DtkFile(temp_filename)
+        os.remove(temp_filename)
+        return
+
+    def test_node_by_id_without_index(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy')
+        self.assertIsNone(dtk_file.node_ids)
+        self.assertEqual(dtk_file.nodes[1], dtk_file.get_node_by_id(2))
+        with self.assertRaises(KeyError):
+            dtk_file.get_node_by_id(3)
+        return
+
+
+class TestEngines(unittest.TestCase):
+
+    sim = 'test-data/two-node/state-00010.sim.json'
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def _round_trip(self, **kwargs):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, **kwargs)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        contents = [dtk_file.get_contents(index) for index in range(dtk_file.chunk_count)]
+        os.remove(temp_filename)
+        for filename, content in zip([self.sim] + self.nodes, contents):
+            with open(filename, 'rb') as handle:
+                self.assertEqual(handle.read(), content)
+        return dtk_file
+
+    @unittest.skipIf(dtkFileTools.zstandard is None, 'zstandard not installed')
+    def test_zstd_with_level(self):
+        dtk_file = self._round_trip(engine='ZSTD:19')
+        self.assertEqual('ZSTD', dtk_file.header.metadata.engine)
+        self.assertFalse('chunkengines' in dtk_file.header.metadata)
+        return
+
+    @unittest.skipIf(dtkFileTools.zstandard is None, 'zstandard not installed')
+    def test_zstd_codecs_are_reused(self):
+        _, engine = dtkFileTools._resolve_engine('ZSTD:5', b'not a trained dictionary')
+        _, same = dtkFileTools._resolve_engine('ZSTD:5', b'not a trained dictionary')
+        _, other = dtkFileTools._resolve_engine('ZSTD:6')
+        self.assertIs(engine._codec(True), same._codec(True))
+        self.assertIs(engine._codec(False), same._codec(False))
+        self.assertIsNot(engine._codec(True), other._codec(True))
+        self.assertEqual(b'x' * 100, other.decompress(other.compress(b'x' * 100)))
+        return
+
+    def test_lz4_high_compression_is_recorded_as_lz4(self):
+        dtk_file = self._round_trip(engine='LZ4HC')
+        self.assertEqual('LZ4', dtk_file.header.metadata.engine)
+        self.assertEqual(dtkFileTools.lz4, dtk_file.engine)
+        return
+
+    def test_per_chunk_engines(self):
+        dtk_file = self._round_trip(engine='SNAPPY', simulation_engine='NONE', jobs=2)
+        self.assertEqual('SNAPPY', dtk_file.header.metadata.engine)
+        self.assertEqual(['NONE', 'SNAPPY', 'SNAPPY'], dtk_file.header.metadata.chunkengines)
+        self.assertIsNone(dtk_file.get_engine(0))
+        return
+
+    def test_per_chunk_engines_load_nodes(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, engine='NONE') as writer:
+            writer.add_simulation('{"simulation":{}}', engine='LZ4HC')
+            writer.add_node('{"node":{"externalId":1}}', engine='SNAPPY')
+            writer.add_node('{"node":{"externalId":2}}')
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertTrue(dtk_file.header.metadata.compressed)
+        self.assertEqual(['LZ4', 'SNAPPY', 'NONE'], dtk_file.header.metadata.chunkengines)
+        self.assertEqual([1, 2], [node.externalId for _, node in dtk_file.load_nodes(workers=2)])
+        self.assertEqual([1, 2], [node.externalId for node in dtk_file.nodes])
+        os.remove(temp_filename)
+        return
+
+    def test_unknown_engine_and_level(self):
+        with self.assertRaises(UserWarning):
+            dtkFileTools._resolve_engine('BROTLI')
+        with self.assertRaises(UserWarning):
+            dtkFileTools._resolve_engine('SNAPPY:3')
+        with self.assertRaises(UserWarning):
+            dtkFileTools._resolve_engine('LZ4HC:high')
+        return
+
+
+@unittest.skipIf(dtkFileTools.zstandard is None, 'zstandard not installed')
+class TestDictionary(unittest.TestCase):
+
+    sim = 'test-data/two-node/state-00010.sim.json'
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def test_writing_and_reading_with_dictionary(self):
+        for version in [2, 3]:
+            temp_handle, temp_filename = tempfile.mkstemp()
+            os.close(temp_handle)
+            dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, engine='ZSTD', jobs=2, version=version, dictionary_size=16384)
+            dtk_file = dtkFileTools.DtkFile(temp_filename)
+            self.assertEqual(3, dtk_file.header.metadata.dictionary)
+            self.assertEqual(['ZSTD', 'ZSTD', 'ZSTD', 'NONE'], dtk_file.header.metadata.chunkengines)
+            self.assertEqual(4, dtk_file.chunk_count)
+            self.assertEqual(2, dtk_file.node_count)
+            self.assertEqual(16384, len(dtk_file.dictionary))
+            contents = [dtk_file.get_contents(index) for index in range(dtk_file.node_count + 1)]
+            self.assertEqual([1, 2], [node.externalId for _, node in dtk_file.load_nodes(workers=2)])
+            os.remove(temp_filename)
+            for filename, content in zip([self.sim] + self.nodes, contents):
+                with open(filename, 'rb') as handle:
+                    self.assertEqual(handle.read(), content)
+        return
+
+    def test_dictionary_requires_zstd(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with self.assertRaises(UserWarning):
+            dtkFileTools.DtkWriter(temp_filename, engine='LZ4', dictionary='not a dictionary')
+        os.remove(temp_filename)
+        return
+
+    def test_training_too_few_samples(self):
+        with self.assertRaises(UserWarning):
+            dtkFileTools.train_dictionary(['{"node":{}}'])
+        return
+
+
+class TestFrames(unittest.TestCase):
+
+    sim = 'test-data/two-node/state-00010.sim.json'
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def test_writing_and_reading_frames(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, engine='SNAPPY', jobs=2, frame_size=1 << 20)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual(['1', '2'], sorted(dtk_file.header.metadata.chunkframes.keys()))
+        self.assertEqual(4, len(dtk_file.chunk_frames[1]))
+        self.assertEqual(dtk_file.chunk_info[1].size, sum(dtk_file.chunk_frames[1]))
+        with open(self.nodes[0], 'rb') as handle:
+            expected = handle.read()
+        self.assertEqual(expected, dtk_file.get_contents(1))
+        self.assertEqual(expected, dtk_file.get_contents(1, workers=3))
+        frames = list(dtk_file.iter_contents(1))
+        self.assertEqual(4, len(frames))
+        self.assertEqual(1 << 20, len(frames[0]))
+        self.assertEqual(expected, b''.join(frames))
+        with dtkFileTools.DtkFile(temp_filename, mapped=True) as mapped_file:
+            self.assertEqual(expected, bytes(b''.join(mapped_file.iter_contents(1))))
+            self.assertEqual(dtk_file.nodes[1], mapped_file.nodes[1])
+        self.assertEqual([1, 2], [node.externalId for _, node in dtk_file.load_nodes(workers=2)])
+        os.remove(temp_filename)
+        return
+
+    def test_writer_splits_frames(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, engine='LZ4', frame_size=8) as writer:
+            writer.add_simulation('{"simulation":{}}')
+            writer.add_node('{"node":{}}')
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual(3, len(dtk_file.chunk_frames[0]))
+        self.assertEqual(2, len(dtk_file.chunk_frames[1]))
+        self.assertEqual({}, dtk_file.nodes[0])
+        self.assertEqual(['{"simulation":{}}', '{"node":{}}'], [''.join(dtk_file.iter_contents(index)) for index in range(2)])
+        os.remove(temp_filename)
+        return
+
+    def test_reading_mismatched_frames(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, engine='NONE') as writer:
+            writer.add_simulation('{"simulation":{}}', compressed=True, frames=[4, 4])
+        with self.assertRaises(UserWarning):
+            dtkFileTools.DtkFile(temp_filename)
+        os.remove(temp_filename)
+        return
+
+
+class TestChecksums(unittest.TestCase):
+
+    sim = 'test-data/two-node/state-00010.sim.json'
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def test_writing_and_verifying_checksums(self):
+        algorithms = ['CRC32'] + (['XXH64'] if dtkFileTools.xxhash is not None else [])
+        for algorithm in algorithms:
+            temp_handle, temp_filename = tempfile.mkstemp()
+            os.close(temp_handle)
+            dtkFileTools.write_dtk_file(temp_filename, self.sim, self.nodes, jobs=2, checksum=algorithm)
+            dtk_file = dtkFileTools.DtkFile(temp_filename)
+            self.assertEqual(algorithm, dtk_file.header.metadata.checksum)
+            self.assertEqual(3, len(dtk_file.chunk_checksums))
+            self.assertEqual(dtkFileTools._checksum(algorithm, dtk_file.get_chunk(1)), dtk_file.chunk_checksums[1])
+            self.assertEqual([], dtk_file.verify())
+            self.assertEqual([], dtk_file.verify(workers=2))
+            with open(temp_filename, 'r+b') as handle:
+                handle.seek(dtk_file.chunk_info[2].offset + 100)
+                byte = handle.read(1)
+                handle.seek(-1, os.SEEK_CUR)
+                handle.write(chr(ord(byte) ^ 0xff))
+            problems = dtk_file.verify(workers=2)
+            os.remove(temp_filename)
+            self.assertEqual([2], [index for index, _ in problems])
+        return
+
+    def test_verifying_truncated_file(self):
+        dtk_file = dtkFileTools.DtkFile('test-data/truncated.dtk')
+        self.assertIsNone(dtk_file.checksum)
+        self.assertEqual([1], [index for index, _ in dtk_file.verify()])
+        return
+
+    def test_writing_without_checksums(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, checksum=None) as writer:
+            writer.add_simulation('{"simulation":{}}')
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertFalse('checksum' in dtk_file.header.metadata)
+        self.assertEqual([], dtk_file.verify())
+        os.remove(temp_filename)
+        with self.assertRaises(UserWarning):
+            dtkFileTools.DtkWriter(temp_filename, checksum='SHA3')
+        return
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_expanding_patterns_and_manifest(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        with os.fdopen(temp_handle, 'w') as handle:
+            handle.write('# checkpoints\ntest-data/one-node/state-00010.dtk.lz4\n\ntest-data/missing.dtk  # not there\n')
+        filenames = dtkFileTools.expand_filenames(['test-data/two-node/*.dtk.*', 'test-data/one-node/state-00010.dtk.lz4'], temp_filename)
+        os.remove(temp_filename)
+        self.assertEqual(['test-data/missing.dtk', 'test-data/one-node/state-00010.dtk.lz4',
+                          'test-data/two-node/state-00010.dtk.lz4', 'test-data/two-node/state-00010.dtk.snappy'], filenames)
+        return
+
+    def test_batch_verify_reports_failures(self):
+        filenames = ['test-data/two-node/state-00010.dtk.lz4', 'test-data/truncated.dtk', 'test-data/missing.dtk']
+        completed = []
+        summary = dtkFileTools.batch_process('verify', filenames, jobs=2, callback=completed.append)
+        self.assertEqual(3, summary['files'])
+        self.assertEqual(sorted(filenames), sorted(result[0] for result in completed))
+        self.assertEqual(['test-data/missing.dtk', 'test-data/truncated.dtk'], [filename for filename, _ in summary['failures']])
+        self.assertEqual(os.path.getsize(filenames[0]), summary['bytes'])
+        return
+
+    def test_batch_read(self):
+        directory = tempfile.mkdtemp()
+        filenames = ['test-data/two-node/state-00010.dtk.lz4', 'test-data/missing.dtk']
+        summary = dtkFileTools.batch_process('read', filenames, jobs=2, options={'output_dir': directory, 'unformatted': True})
+        outputs = sorted(os.listdir(directory))
+        with open(os.path.join(directory, 'state-00010.dtk.node-2.json'), 'rb') as handle:
+            contents = handle.read()
+        for filename in outputs:
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+        self.assertEqual(['test-data/missing.dtk'], [filename for filename, _ in summary['failures']])
+        self.assertEqual(['state-00010.dtk.node-1.json', 'state-00010.dtk.node-2.json', 'state-00010.dtk.sim.json'], outputs)
+        with open('test-data/two-node/state-00010.node-2.json', 'rb') as handle:
+            self.assertEqual(handle.read(), contents)
+        with self.assertRaises(UserWarning):
+            dtkFileTools.batch_process('explode', filenames)
+        return
+
+    def test_batch_write(self):
+        directory = tempfile.mkdtemp()
+        filenames = ['test-data/two-node/state-00010.sim.json', 'test-data/two-node/state-00010.node-1.json']
+        summary = dtkFileTools.batch_process('write', filenames, jobs=2, options={'output_dir': directory, 'version': 3})
+        expected = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        with dtkFileTools.DtkFile(os.path.join(directory, 'state-00010.dtk')) as dtk_file:
+            self.assertEqual({1: 1, 2: 2}, dtk_file.node_ids)
+            self.assertEqual(list(expected.nodes), list(dtk_file.nodes))
+        shutil.rmtree(directory)
+        self.assertEqual(['test-data/two-node/state-00010.node-1.json'], [filename for filename, _ in summary['failures']])
+        return
+
+
+class TestConverting(unittest.TestCase):
+
+    def test_converting_version_one(self):
+        original = dtkFileTools.DtkFile('test-data/version1.dtk')
+        expected = original.sim
+        for version in [2, 3]:
+            temp_handle, temp_filename = tempfile.mkstemp()
+            os.close(temp_handle)
+            self.assertEqual(len(expected.nodes), dtkFileTools.convert_dtk_file('test-data/version1.dtk', temp_filename, version=version))
+            dtk_file = dtkFileTools.DtkFile(temp_filename)
+            self.assertEqual(version, dtk_file.header.metadata.version)
+            self.assertEqual('LZ4', dtk_file.header.metadata.engine)
+            self.assertEqual([], dtk_file.verify())
+            self.assertEqual(len(expected.nodes), dtk_file.node_count)
+            self.assertEqual([], dtk_file.sim.nodes)
+            self.assertEqual(dict((key, value) for key, value in expected.items() if key != 'nodes'),
+                             dict((key, value) for key, value in dtk_file.sim.items() if key != 'nodes'))
+            self.assertEqual([entry.node for entry in expected.nodes], list(dtk_file.nodes))
+            if version == 3:
+                self.assertEqual(dict((entry.node.externalId, index) for index, entry in enumerate(expected.nodes, 1)), dtk_file.node_ids)
+            os.remove(temp_filename)
+        return
+
+    def test_converting_in_place(self):
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with open('test-data/two-node/state-00010.dtk.snappy', 'rb') as source, open(temp_filename, 'wb') as handle:
+            handle.write(source.read())
+        self.assertEqual(2, dtkFileTools.convert_dtk_file(temp_filename, engine='LZ4HC', version=3))
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        original = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy')
+        self.assertEqual('LZ4', dtk_file.header.metadata.engine)
+        self.assertEqual({1: 1, 2: 2}, dtk_file.node_ids)
+        self.assertEqual([original.get_contents(index) for index in range(3)], [dtk_file.get_contents(index) for index in range(3)])
+        os.remove(temp_filename)
+        return
+
+
+class TestExtractAndMerge(unittest.TestCase):
+
+    def test_extracting_nodes(self):
+        source = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy')
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        source.extract(temp_filename, [1])
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual(1, dtk_file.node_count)
+        self.assertEqual('SNAPPY', dtk_file.header.metadata.engine)
+        self.assertEqual(source.get_chunk(0), dtk_file.get_chunk(0))
+        self.assertEqual(source.get_chunk(2), dtk_file.get_chunk(1))
+        self.assertEqual([], dtk_file.verify())
+        source.extract(temp_filename, external_ids=[1], version=3)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual({1: 1}, dtk_file.node_ids)
+        self.assertEqual(source.nodes[0], dtk_file.nodes[0])
+        with self.assertRaises(KeyError):
+            source.extract(temp_filename, external_ids=[3])
+        with self.assertRaises(IndexError):
+            source.extract(temp_filename, [2])
+        for indices in [[0, 0], [1, -1]]:
+            with self.assertRaises(UserWarning):
+                source.extract(temp_filename, indices, version=3)
+            with self.assertRaises(UserWarning):
+                source.extract(temp_filename, indices, version=2)
+        with self.assertRaises(UserWarning):
+            source.extract(temp_filename, external_ids=[2, 2])
+        os.remove(temp_filename)
+        return
+
+    def test_merging_files(self):
+        first_handle, first_filename = tempfile.mkstemp()
+        second_handle, second_filename = tempfile.mkstemp()
+        temp_handle, temp_filename = tempfile.mkstemp()
+        for handle in [first_handle, second_handle, temp_handle]:
+            os.close(handle)
+        source = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        source.extract(first_filename, [1], version=3)
+        dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.snappy').extract(second_filename, [0])
+        self.assertEqual(2, dtkFileTools.merge_dtk_files(temp_filename, [first_filename, second_filename]))
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        self.assertEqual(3, dtk_file.header.metadata.version)
+        self.assertEqual(['LZ4', 'LZ4', 'SNAPPY'], dtk_file.header.metadata.chunkengines)
+        self.assertEqual({2: 1, 1: 2}, dtk_file.node_ids)
+        self.assertEqual([source.nodes[1], source.nodes[0]], list(dtk_file.nodes))
+        with self.assertRaises(UserWarning):
+            dtkFileTools.merge_dtk_files(temp_filename, [first_filename, first_filename])
+        with self.assertRaises(UserWarning):
+            dtkFileTools.merge_dtk_files(temp_filename, [second_filename, second_filename], version=2)
+        with self.assertRaises(UserWarning):
+            dtkFileTools.merge_dtk_files(temp_filename, [first_filename, 'test-data/version1.dtk'])
+        for filename in [first_filename, second_filename]:
+            os.remove(filename)
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        return
+
+
+class TestReadingOutput(unittest.TestCase):
+
+    filename = 'test-data/two-node/state-00010.dtk.snappy'
+
+    def _read(self, **kwargs):
+        directory = tempfile.mkdtemp()
+        prefix = os.path.join(directory, 'state')
+        filenames = dtkFileTools.read_dtk_file(self.filename, prefix, verbose=False, **kwargs)
+        contents = []
+        for filename in filenames:
+            with open(filename, 'rb') as handle:
+                contents.append(handle.read())
+            os.remove(filename)
+        os.rmdir(directory)
+        return [os.path.basename(filename) for filename in filenames], contents
+
+    def test_parallel_read_matches_serial(self):
+        for options in [{}, {'unformatted': True}, {'raw': True}, {'reindent': True}]:
+            serial = self._read(**options)
+            parallel = self._read(jobs=2, **options)
+            self.assertEqual(serial, parallel)
+        self.assertEqual(['state.sim.json', 'state.node-1.json', 'state.node-2.json'], serial[0])
+        return
+
+    def test_reindented_output(self):
+        _, formatted = self._read()
+        _, reindented = self._read(reindent=True)
+        for expected, actual in zip(formatted, reindented):
+            self.assertEqual(json.loads(expected.decode('utf-8')), json.loads(actual.decode('utf-8')))
+        buffer = io.BytesIO()
+        dtkFileTools._write_indented('{"a":[],"b":{"c":"x,\\"[y]", "d":[1, -2.5e3]},"e":{}}', buffer)
+        self.assertEqual(b'{\n  "a":[],\n  "b":{\n    "c":"x,\\"[y]",\n    "d":[\n      1,\n      -2.5e3\n    ]\n  },\n  "e":{}\n}',
+                         buffer.getvalue())
+        return
+
+
+class TestProjection(unittest.TestCase):
+
+    filename = 'test-data/two-node/state-00010.dtk.lz4'
+
+    def test_projected_nodes(self):
+        dtk_file = dtkFileTools.DtkFile(self.filename)
+        nodes = dtk_file.nodes.project(['externalId', 'individualHumans.m_age', 'individualHumans.susceptibility.age'])
+        self.assertEqual(2, len(nodes))
+        for expected, actual in zip(dtk_file.nodes, nodes):
+            self.assertEqual(['externalId', 'individualHumans'], sorted(actual.keys()))
+            self.assertEqual(expected.externalId, actual.externalId)
+            self.assertEqual([{'m_age': individual.m_age, 'susceptibility': {'age': individual.susceptibility.age}}
+                              for individual in expected.individualHumans], actual.individualHumans)
+            self.assertIsInstance(actual.individualHumans[0].susceptibility, dtkFileTools.SerialObject)
+        return
+
+    def test_projected_object(self):
+        dtk_file = dtkFileTools.DtkFile(self.filename, compact=True)
+        sim = dtk_file.get_object(0, fields=['simulation.__class__', 'simulation.no_such_field'])
+        self.assertEqual({'simulation': {'__class__': 'Simulation'}}, sim)
+        node = dtk_file.get_object(2, fields=['node.suid', 'node.individualHumans', 'node.individualHumans.m_age']).node
+        self.assertIsInstance(node, dtkFileTools.CompactObject)
+        self.assertEqual(dtk_file.nodes[1].suid, node.suid)
+        self.assertEqual(dtk_file.nodes[1].individualHumans, node.individualHumans)  # the whole of an ancestor wins
+        return
+
+    def test_projection_of_formatted_json(self):
+        contents = b'{ "a" : [ { "b" : 1 , "c" : { "d" : [ 2 ] } } , { "c" : [ ] } , 3 ] ,\n "e" : { } , "f" : "x" }'
+        self.assertEqual({'a': [{'c': {'d': [2]}}, {'c': []}, 3], 'e': {}}, dtkFileTools._parse_fields(contents, ['a.c', 'e']))
+        with self.assertRaises(UserWarning):
+            dtkFileTools._parse_fields(b'{"a":1 "b":2}', ['b'])
+        return
+
+
+class TestDeltaFiles(unittest.TestCase):
+
+    nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.base = os.path.join(self.directory, 'state-00000.dtk')
+        shutil.copyfile('test-data/two-node/state-00000.dtk', self.base)
+        self.filename = os.path.join(self.directory, 'state-00010.dtk')
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        return
+
+    def _write(self, filename, base=None, jobs=1):
+        dtkFileTools.write_dtk_file(filename, 'test-data/two-node/state-00010.sim.json', self.nodes, jobs=jobs, base=base)
+        return dtkFileTools.DtkFile(filename)
+
+    def test_delta_matches_full_file(self):
+        full = self._write(os.path.join(self.directory, 'full.dtk'))
+        for jobs in [1, 2]:
+            dtk_file = self._write(self.filename, self.base, jobs)
+            self.assertEqual({1: 1, 2: 2}, dtk_file.chunk_deltas)
+            self.assertEqual('state-00000.dtk', dtk_file.header.metadata.base.filename)
+            for index in range(full.chunk_count):
+                self.assertEqual(full.get_contents(index), dtk_file.get_contents(index))
+            self.assertEqual(full.sim, dtk_file.sim)
+            self.assertEqual([], dtk_file.verify())
+            self.assertLess(os.path.getsize(self.filename), os.path.getsize(full.filename))
+            dtk_file.close()
+        return
+
+    def test_delta_of_formatted_json(self):
+        with open(self.nodes[0]) as handle:
+            node = json.load(handle, object_pairs_hook=OrderedDict)
+        base_node = os.path.join(self.directory, 'base.node.json')
+        with open(base_node, 'w') as handle:
+            json.dump(node, handle, indent=2)
+        node['node']['individualHumans'][0]['m_age'] += 1.0
+        changed_node = os.path.join(self.directory, 'changed.node.json')
+        with open(changed_node, 'w') as handle:
+            json.dump(node, handle, indent=2)
+        sim = 'test-data/two-node/state-00010.sim.json'
+        dtkFileTools.write_dtk_file(self.base, sim, [base_node])
+        dtkFileTools.write_dtk_file(self.filename, sim, [changed_node], base=self.base)
+        with open(changed_node, 'rb') as handle:
+            expected = handle.read()
+        with dtkFileTools.DtkFile(self.filename) as dtk_file:
+            self.assertEqual(expected, bytes(dtk_file.get_contents(1)))
+        return
+
+    def test_delta_against_unchanged_base(self):
+        base = dtkFileTools.DtkFile(self.base)
+        for version, engine in [(3, 'LZ4'), (2, 'NONE'), (3, 'NONE')]:
+            with dtkFileTools.DtkWriter(self.filename, engine=engine, base=self.base, version=version) as writer:
+                writer.add_simulation(base.get_contents(0))
+                for index in range(1, base.chunk_count):
+                    writer.add_node(base.get_contents(index))
+            dtk_file = dtkFileTools.DtkFile(self.filename)
+            self.assertEqual({1: 1, 2: 2}, dtk_file.chunk_deltas)
+            if version == 3:
+                self.assertEqual(base.node_ids if base.node_ids is not None else {1: 1, 2: 2}, dtk_file.node_ids)
+            for index in range(1, base.chunk_count):
+                self.assertLess(dtk_file.chunk_info[index].size, 64)
+                self.assertEqual(base.get_contents(index), dtk_file.get_contents(index))
+            self.assertEqual([], dtk_file.verify())
+            dtk_file.close()
+        return
+
+    def test_extracting_and_loading_delta_nodes(self):
+        expected = list(self._write(self.filename, self.base).nodes)
+        dtk_file = dtkFileTools.DtkFile(self.filename, mapped=True)
+        self.assertEqual(expected, [node for _, node in dtk_file.load_nodes(workers=2)])
+        self.assertEqual(expected, [node for _, node in dtk_file.load_nodes(workers=2, executor='thread')])
+        extracted = os.path.join(self.directory, 'extracted.dtk')
+        dtk_file.extract(extracted, [1, 0])
+        dtk_file.close()
+        os.remove(self.base)
+        dtk_file = dtkFileTools.DtkFile(extracted)
+        self.assertEqual({}, dtk_file.chunk_deltas)
+        self.assertEqual([expected[1], expected[0]], list(dtk_file.nodes))
+        return
+
+    def test_missing_or_changed_base(self):
+        self._write(self.filename, self.base).close()
+        dtkFileTools.convert_dtk_file(self.base, engine='SNAPPY')
+        dtk_file = dtkFileTools.DtkFile(self.filename)
+        dtk_file.get_contents(0)    # the simulation isn't a delta
+        with self.assertRaises(UserWarning):
+            dtk_file.nodes[0]
+        os.remove(self.base)
+        with self.assertRaises(UserWarning):
+            dtkFileTools.DtkFile(self.filename).nodes[0]
+        with self.assertRaises(UserWarning):
+            dtkFileTools.DtkWriter(self.filename, base=self.filename)
+        return
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+import cProfile
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 3.4+ only
+
+# Stage names used by dtkFileTools and idtkFileTools
+READ = 'read'
+DECOMPRESS = 'decompress'
+PARSE = 'parse'
+SERIALIZE = 'serialize'
+COMPRESS = 'compress'
+WRITE = 'write'
+
+
+class Span:
+
+    def __init__(self, stage, chunk=None, label=None):
+        self.stage = stage
+        self.chunk = chunk
+        self.label = label if label is not None else stage
+        self.bytes = None
+        self.start = None
+        self.duration = None
+        self.thread = threading.current_thread().ident
+        self.process = os.getpid()
+        self.memory = None
+
+        return
+
+    def to_dict(self):
+        span = OrderedDict()
+        span['stage'] = self.stage
+        span['label'] = self.label
+        span['chunk'] = self.chunk
+        span['bytes'] = self.bytes
+        span['start'] = self.start
+        span['duration'] = self.duration
+        if self.memory is not None:
+            span['memory'] = self.memory
+
+        return span
+
+
+class _NullSpan:
+    # Returned when instrumentation is disabled, so callers can always set .bytes
+
+    def __init__(self):
+        self.bytes = None
+
+        return
+
+
+class Recorder:
+
+    def __init__(self, listeners=None, profile=False, trace_memory=False):
+        """
+        :param listeners: callables invoked with each Span as it finishes
+        :param profile: run cProfile while this recorder is enabled, see write_profile()
+        :param trace_memory: record current and peak traced memory (tracemalloc) at the end of each span
+        """
+        self.spans = []
+        self.listeners = list(listeners) if listeners is not None else []
+        self.origin = default_timer()
+        self.profiler = cProfile.Profile() if profile else None
+        if trace_memory and tracemalloc is None:
+            raise UserWarning("Memory tracing requires tracemalloc (Python 3.4+).")
+        self.trace_memory = trace_memory
+
+        return
+
+    def start(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        return
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        return
+
+    def record(self, span):
+        if self.trace_memory and tracemalloc.is_tracing():
+            span.memory = dict(zip(('current', 'peak'), tracemalloc.get_traced_memory()))
+        self.spans.append(span)
+        for listener in self.listeners:
+            listener(span)
+
+        return
+
+    def summary(self):
+        """
+        :return: OrderedDict with per-stage totals (count, seconds, bytes) and per-chunk seconds by stage
+        """
+        stages = OrderedDict()
+        chunks = OrderedDict()
+        for span in self.spans:
+            totals = stages.setdefault(span.stage, OrderedDict([('count', 0), ('seconds', 0.0), ('bytes', 0)]))
+            totals['count'] += 1
+            totals['seconds'] += span.duration
+            totals['bytes'] += span.bytes or 0
+            if span.chunk is not None:
+                breakdown = chunks.setdefault(span.chunk, OrderedDict())
+                breakdown[span.stage] = breakdown.get(span.stage, 0.0) + span.duration
+
+        result = OrderedDict()
+        result['stages'] = stages
+        result['chunks'] = chunks
+
+        return result
+
+    def to_json(self):
+        result = self.summary()
+        result['spans'] = [span.to_dict() for span in self.spans]
+
+        return result
+
+    def to_chrome_trace(self):
+        """
+        :return: dictionary in Chrome trace event format (load in chrome://tracing or Perfetto)
+        """
+        events = []
+        for span in self.spans:
+            arguments = OrderedDict([('bytes', span.bytes), ('chunk', span.chunk)])
+            if span.memory is not None:
+                arguments['memory'] = span.memory
+            events.append(OrderedDict([
+                ('name', span.label),
+                ('cat', span.stage),
+                ('ph', 'X'),
+                ('ts', span.start * 1e6),
+                ('dur', span.duration * 1e6),
+                ('pid', span.process),
+                ('tid', span.thread),
+                ('args', arguments)]))
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as handle:
+            json.dump(self.to_json(), handle, indent=2, separators=(',', ': '))
+
+        return
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as handle:
+            json.dump(self.to_chrome_trace(), handle, separators=(',', ':'))
+
+        return
+
+    def write_profile(self, filename):
+        if self.profiler is None:
+            raise UserWarning("Recorder was created without profile=True.")
+        self.profiler.dump_stats(filename)
+
+        return
+
+
+_recorder = None
+
+
+def enable(recorder=None):
+    """
+    Start recording spans from dtkFileTools and idtkFileTools.
+    :param recorder: Recorder to use, a new one is created if not given
+    :return: the active Recorder
+    """
+    global _recorder
+    disable()
+    _recorder = recorder if recorder is not None else Recorder()
+    _recorder.start()
+
+    return _recorder
+
+
+def disable():
+    """
+    :return: the Recorder that was active (or None)
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.stop()
+
+    return recorder
+
+
+def get_recorder():
+
+    return _recorder
+
+
+@contextmanager
+def span(stage, chunk=None, label=None):
+    """
+    Time the enclosed block as one span of the given stage, set .bytes on the yielded span to record throughput.
+    Does nothing (beyond yielding a placeholder) when instrumentation is disabled.
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield _NullSpan()
+        return
+
+    current = Span(stage, chunk, label)
+    start = default_timer()
+    try:
+        yield current
+    finally:
+        end = default_timer()
+        current.start = start - recorder.origin
+        current.duration = end - start
+        recorder.record(current)
+
+
+def in_workers(function):
+    """
+    Wrap a task function for a multiprocessing pool so spans recorded in the worker process come back to this one.
+    Unwrap each result with from_workers(), which adds the worker's spans to the active recorder. cProfile and memory
+    tracing cover this process only.
+    :param function: picklable (module level) function taking one task
+    :return: function, wrapped if instrumentation is enabled
+    """
+    recorder = _recorder
+    if recorder is None:
+        return function
+
+    return _WorkerTask(function, recorder.origin)
+
+
+def from_workers(results):
+    """
+    :param results: results of an in_workers() function, e.g. from Pool.imap()
+    :return: generator of the function's results
+    """
+    for result in results:
+        if isinstance(result, _WorkerResult):
+            recorder = _recorder
+            if recorder is not None:
+                for finished in result.spans:
+                    recorder.record(finished)
+            result = result.result
+        yield result
+
+    return
+
+
+class _WorkerTask:
+
+    def __init__(self, function, origin):
+        self.function = function
+        self.origin = origin
+
+        return
+
+    def __call__(self, task):
+        # A forked worker inherits the parent's recorder, record into a new one sharing its origin instead
+        global _recorder
+        inherited = _recorder
+        _recorder = Recorder()
+        _recorder.origin = self.origin
+        try:
+            result = self.function(task)
+            spans = _recorder.spans
+        finally:
+            _recorder = inherited
+
+        return _WorkerResult(result, spans)
+
+
+class _WorkerResult:
+
+    def __init__(self, result, spans):
+        self.result = result
+        self.spans = spans
+
+        return
+
+
+def print_span(span, handle=None):
+    """
+    Listener printing each span to stderr in the style of the original idtkFileTools timing output.
+    """
+    handle = handle if handle is not None else sys.stderr
+    label = '{0}:'.format(span.label)
+    print('{0:<25}{1:>10f}'.format(label, span.duration), file=handle)
+
+    return
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import dtkFileTools
+import dtkInstrumentation
+import idtkFileTools
+import json
+import os
+import tempfile
+import unittest
+
+
+class TestRecording(unittest.TestCase):
+
+    def tearDown(self):
+        dtkInstrumentation.disable()
+        return
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(dtkInstrumentation.get_recorder())
+        with dtkInstrumentation.span(dtkInstrumentation.READ) as span:
+            span.bytes = 42
+        return
+
+    def test_reading_records_stages_per_chunk(self):
+        recorder = dtkInstrumentation.enable()
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        dtk_file.get_object(1)
+        dtk_file.get_object(2)
+        dtkInstrumentation.disable()
+        summary = recorder.summary()
+        self.assertEqual(['read', 'decompress', 'parse'], list(summary['stages'].keys()))
+        self.assertEqual(2, summary['stages']['read']['count'])
+        self.assertEqual(141105 + 142914, summary['stages']['read']['bytes'])
+        self.assertEqual([1, 2], list(summary['chunks'].keys()))
+        self.assertEqual(['read', 'decompress', 'parse'], list(summary['chunks'][1].keys()))
+        return
+
+    def test_writing_records_compress_and_write(self):
+        recorder = dtkInstrumentation.enable()
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        with dtkFileTools.DtkWriter(temp_filename, engine='SNAPPY') as writer:
+            writer.add_simulation('{"simulation":{}}')
+            writer.add_node('{"node":{"externalId":1}}')
+        os.remove(temp_filename)
+        stages = recorder.summary()['stages']
+        self.assertEqual(2, stages['compress']['count'])
+        self.assertEqual(len('{"simulation":{}}') + len('{"node":{"externalId":1}}'), stages['compress']['bytes'])
+        self.assertEqual(2, stages['write']['count'])
+        return
+
+    def test_idtk_timing_records_spans(self):
+        recorder = dtkInstrumentation.enable()
+        idtkFileTools.read_idtk_file('test-data/compressed.dtk')
+        labels = [span.label for span in recorder.spans]
+        self.assertEqual(['Read file payload', 'Decompress payload', 'Parse JSON'], labels)
+        self.assertEqual(['read', 'decompress', 'parse'], [span.stage for span in recorder.spans])
+        return
+
+    def test_exporting(self):
+        recorder = dtkInstrumentation.enable(dtkInstrumentation.Recorder(profile=True))
+        dtkFileTools.DtkFile('test-data/one-node/state-00010.dtk').get_object(1)
+        dtkInstrumentation.disable()
+        trace = json.loads(json.dumps(recorder.to_chrome_trace()))
+        self.assertEqual(3, len(trace['traceEvents']))
+        self.assertEqual('X', trace['traceEvents'][0]['ph'])
+        self.assertEqual(92451, trace['traceEvents'][0]['args']['bytes'])
+        exported = json.loads(json.dumps(recorder.to_json()))
+        self.assertEqual(3, len(exported['spans']))
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        recorder.write_profile(temp_filename)
+        self.assertTrue(os.path.getsize(temp_filename) > 0)
+        os.remove(temp_filename)
+        return
+
+    def test_listeners(self):
+        finished = []
+        dtkInstrumentation.enable(dtkInstrumentation.Recorder(listeners=[finished.append]))
+        with dtkInstrumentation.span(dtkInstrumentation.COMPRESS, chunk=3, label='squash') as span:
+            span.bytes = 10
+        self.assertEqual(1, len(finished))
+        self.assertEqual('squash', finished[0].label)
+        self.assertEqual(3, finished[0].chunk)
+        return
+
+    def test_spans_from_worker_processes(self):
+        recorder = dtkInstrumentation.enable()
+        dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        self.assertEqual([1, 2], [node.externalId for _, node in dtk_file.load_nodes(workers=2)])
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        nodes = ['test-data/two-node/state-00010.node-1.json', 'test-data/two-node/state-00010.node-2.json']
+        dtkFileTools.write_dtk_file(temp_filename, 'test-data/two-node/state-00010.sim.json', nodes, jobs=2)
+        os.remove(temp_filename)
+        dtkInstrumentation.disable()
+        parsed = [span for span in recorder.spans if span.stage == 'parse']
+        self.assertEqual([1, 2], sorted(span.chunk for span in parsed))
+        self.assertNotIn(os.getpid(), [span.process for span in parsed])
+        self.assertEqual(3, len([span for span in recorder.spans if span.stage == 'compress']))
+        self.assertTrue(all(span.start >= 0 for span in recorder.spans))
+        self.assertEqual(len(recorder.spans), len(recorder.to_chrome_trace()['traceEvents']))
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+import importlib
+import json
+import os
+import sys
+from collections import OrderedDict
+
+# Pieces of encoded JSON gathered before each write in dump()
+_WRITE_PIECES = 1 << 16
+
+
+class JsonBackend:
+
+    def __init__(self, name, module, hooks, ordered=True):
+        """
+        :param name: registry name, e.g. 'UJSON'
+        :param module: parser module, or its name to import it on first use
+        :param hooks: parser supports object_hook/object_pairs_hook directly, otherwise results are converted
+        :param ordered: decoded objects keep document key order, required to honour object_pairs_hook
+        """
+        self.name = name
+        self._module = module
+        self.hooks = hooks
+        self.ordered = ordered
+
+        return
+
+    @property
+    def module(self):
+        if isinstance(self._module, str):
+            self._module = importlib.import_module(self._module)
+
+        return self._module
+
+    def loads(self, text, object_hook=None, object_pairs_hook=None):
+        """
+        :param text: JSON text
+        :param object_hook: called with each decoded dict, e.g. SerialObject
+        :param object_pairs_hook: called with each decoded object's (key, value) list, e.g. OrderedDict,
+                                  parsed with the stdlib if this backend loses key order
+        :return: decoded data
+        """
+        if object_pairs_hook is not None and not self.ordered:
+            return json.loads(text, object_pairs_hook=object_pairs_hook)
+        if self.hooks:
+            return self.module.loads(text, object_hook=object_hook, object_pairs_hook=object_pairs_hook)
+
+        data = self.module.loads(text)
+        if object_pairs_hook is not None:
+            return _convert(data, lambda obj: object_pairs_hook(list(obj.items())))
+        if object_hook is not None:
+            return _convert(data, object_hook)
+
+        return data
+
+    def dumps(self, obj, indent=None, separators=(',', ':')):
+        """
+        :param obj: data to serialize, dict subclasses (SerialObject, OrderedDict) are serialized as objects
+        :param indent: pretty-print with this indent, None for the most compact representation
+        :param separators: (item, key) separators
+        :return: JSON text, formatted the same by every backend
+        """
+        if self.hooks:
+            return self.module.dumps(obj, indent=indent, separators=separators, default=_default)
+        if indent or tuple(separators) != (',', ':'):
+            # ujson and orjson format indented output their own way and ignore separators
+            return json.dumps(obj, indent=indent, separators=separators, default=_default)
+
+        return self._dumps(obj)
+
+    def dump(self, obj, handle, indent=None, separators=(',', ':')):
+        """
+        Serialize obj to a file, formatted as by dumps(). Formatted output is encoded piece by piece and written in
+        batches rather than building the whole text in memory first. Compact output is encoded whole, in C where the
+        backend can, and written at once.
+        :param obj: data to serialize, as for dumps()
+        :param handle: file opened for writing
+        :param indent: pretty-print with this indent, None for the most compact representation
+        :param separators: (item, key) separators
+        :return: None
+        """
+        if not indent and tuple(separators) == (',', ':'):
+            handle.write(self.dumps(obj))
+            return
+
+        # ujson and orjson format indented output their own way and ignore separators
+        module = self.module if self.hooks else json
+        pieces = []
+        for piece in module.JSONEncoder(indent=indent, separators=separators, default=_default).iterencode(obj):
+            pieces.append(piece)
+            if len(pieces) >= _WRITE_PIECES:
+                handle.write(''.join(pieces))
+                del pieces[:]
+        handle.write(''.join(pieces))
+
+        return
+
+    def _dumps(self, obj):
+        # Most compact representation
+        if self.name == 'ORJSON':
+            return self.module.dumps(obj, default=_default).decode('utf-8')
+
+        try:
+            return self.module.dumps(obj, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            # ujson can't serialize non-dict mappings (CompactObject) or very large integers, use the stdlib
+            return json.dumps(obj, separators=(',', ':'), default=_default)
+
+
+def _default(obj):
+    # Non-dict mappings (e.g. CompactObject) serialize as their items
+    if hasattr(obj, 'items'):
+        return OrderedDict(obj.items())
+
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+def _convert(data, factory):
+    # Rebuild every dict in data (bottom up) with factory, matching what object_hook would have produced
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, (dict, list)):
+                data[key] = _convert(value, factory)
+        return factory(data)
+    if isinstance(data, list):
+        for index, value in enumerate(data):
+            if isinstance(value, (dict, list)):
+                data[index] = _convert(value, factory)
+
+    return data
+
+
+# ujson and orjson decode into plain dicts, which only keep document key order on Python 3.7+
+_ordered_dicts_ = sys.version_info >= (3, 7)
+
+
+def _installed(name):
+    # Find a module without importing it, the optional backends are only imported when they're used
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import pkgutil
+        return pkgutil.find_loader(name) is not None
+
+    return find_spec(name) is not None
+
+
+__json_backends__ = OrderedDict()
+__json_backends__['JSON'] = JsonBackend('JSON', json, hooks=True)
+if _installed('simplejson'):
+    __json_backends__['SIMPLEJSON'] = JsonBackend('SIMPLEJSON', 'simplejson', hooks=True)
+if _installed('ujson'):
+    __json_backends__['UJSON'] = JsonBackend('UJSON', 'ujson', hooks=False, ordered=_ordered_dicts_)
+if _installed('orjson'):
+    __json_backends__['ORJSON'] = JsonBackend('ORJSON', 'orjson', hooks=False, ordered=_ordered_dicts_)
+
+# Fastest first, used to resolve 'AUTO' (to the fastest backend which keeps key order)
+_preference_ = ['ORJSON', 'UJSON', 'SIMPLEJSON', 'JSON']
+
+# Default backend name, may be overridden with the DTK_JSON_BACKEND environment variable or set_default_backend()
+_default_backend_ = os.environ.get('DTK_JSON_BACKEND', 'JSON')
+
+
+def get_backend(name=None):
+    """
+    :param name: backend name {JSON|SIMPLEJSON|UJSON|ORJSON|AUTO}, None for the configured default
+    :return: JsonBackend
+    """
+    name = (name if name is not None else _default_backend_).upper()
+    if name == 'AUTO':
+        name = next(candidate for candidate in _preference_ if candidate in __json_backends__ and __json_backends__[candidate].ordered)
+    if name not in __json_backends__:
+        raise UserWarning("JSON backend '{0}' is unknown or not installed (available: {1}).".format(name, ', '.join(__json_backends__.keys())))
+
+    return __json_backends__[name]
+
+
+def set_default_backend(name):
+    """
+    :param name: backend name {JSON|SIMPLEJSON|UJSON|ORJSON|AUTO}
+    :return: None
+    """
+    global _default_backend_
+    get_backend(name)   # validate
+    _default_backend_ = name.upper()
+
+    return
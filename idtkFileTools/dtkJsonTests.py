@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+import collections
+import dtkFileTools
+import dtkJson
+import idtkFileTools
+import io
+import json
+import sys
+import unittest
+
+
+class TestBackends(unittest.TestCase):
+
+    text = '{"node":{"__class__":"Node","externalId":1,"individualHumans":[{"m_age":9598.48,"suid":{"id":1}},{"m_age":14576.1,"suid":{"id":2}}]}}'
+
+    def test_stdlib_always_available(self):
+        self.assertEqual('JSON', dtkJson.get_backend('json').name)
+        self.assertEqual('JSON', dtkJson.get_backend().name)
+        return
+
+    def test_unknown_backend(self):
+        with self.assertRaises(UserWarning):
+            dtkJson.get_backend('yaml')
+        with self.assertRaises(UserWarning):
+            dtkJson.set_default_backend('yaml')
+        return
+
+    def test_auto_backend(self):
+        self.assertIn(dtkJson.get_backend('AUTO').name, dtkJson.__json_backends__)
+        self.assertTrue(dtkJson.get_backend('AUTO').ordered)
+        return
+
+    def test_backends_keep_key_order(self):
+        text = '{"zeta":1,"alpha":[{"b":1,"a":2,"c":3}],"mid":{"b":1,"a":2,"c":{}}}'
+        for name in dtkJson.__json_backends__:
+            backend = dtkJson.get_backend(name)
+            ordered = backend.loads(text, object_pairs_hook=collections.OrderedDict)
+            self.assertEqual(['zeta', 'alpha', 'mid'], list(ordered.keys()), name)
+            self.assertEqual(['b', 'a', 'c'], list(ordered['mid'].keys()), name)
+            self.assertEqual(['b', 'a', 'c'], list(ordered['alpha'][0].keys()), name)
+            self.assertEqual(text, backend.dumps(ordered), name)
+            compact = backend.loads(text, object_pairs_hook=dtkFileTools.CompactObject)
+            self.assertEqual(['zeta', 'alpha', 'mid'], list(compact.keys()), name)
+        return
+
+    def test_backends_format_alike(self):
+        data = json.loads('{"zeta":1,"alpha":[1,2],"mid":{"b":1,"c":{}}}', object_pairs_hook=collections.OrderedDict)
+        expected = json.dumps(data, indent=2, separators=(',', ': '))
+        for name in dtkJson.__json_backends__:
+            backend = dtkJson.get_backend(name)
+            self.assertEqual(expected, backend.dumps(data, indent=2, separators=(',', ': ')), name)
+            self.assertEqual(json.dumps(data, separators=(', ', ': ')), backend.dumps(data, separators=(', ', ': ')), name)
+        return
+
+    def test_backends_match_stdlib(self):
+        expected = json.loads(self.text, object_hook=dtkFileTools.SerialObject)
+        for name in dtkJson.__json_backends__:
+            backend = dtkJson.get_backend(name)
+            actual = backend.loads(self.text, object_hook=dtkFileTools.SerialObject)
+            self.assertEqual(expected, actual, name)
+            self.assertIsInstance(actual.node.individualHumans[1].suid, dtkFileTools.SerialObject, name)
+            self.assertEqual(2, actual.node.individualHumans[1].suid.id, name)
+            ordered = backend.loads(self.text, object_pairs_hook=collections.OrderedDict)
+            self.assertIsInstance(ordered['node'], collections.OrderedDict, name)
+            self.assertEqual(expected, json.loads(backend.dumps(actual)), name)
+            self.assertEqual(expected, json.loads(backend.dumps(actual, indent=2)), name)
+            compact = backend.loads(self.text, object_pairs_hook=dtkFileTools.CompactObject)
+            self.assertEqual(expected, json.loads(backend.dumps(compact)), name)
+        return
+
+    def test_dump_matches_dumps(self):
+        data = json.loads(self.text, object_hook=dtkFileTools.SerialObject)
+        write_pieces = dtkJson._WRITE_PIECES
+        try:
+            for pieces in [write_pieces, 3]:
+                dtkJson._WRITE_PIECES = pieces   # small batches write in several pieces
+                for name in dtkJson.__json_backends__:
+                    backend = dtkJson.get_backend(name)
+                    for kwargs in [{'indent': 2}, {'separators': (', ', ': ')}, {}]:
+                        handle = io.BytesIO() if sys.version_info[0] < 3 else io.StringIO()
+                        backend.dump(data, handle, **kwargs)
+                        self.assertEqual(backend.dumps(data, **kwargs), handle.getvalue(), name)
+        finally:
+            dtkJson._WRITE_PIECES = write_pieces
+        return
+
+
+class TestBackendSelection(unittest.TestCase):
+
+    def tearDown(self):
+        dtkJson.set_default_backend('JSON')
+        return
+
+    def test_dtk_file_backend(self):
+        default = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4')
+        for name in dtkJson.__json_backends__:
+            dtk_file = dtkFileTools.DtkFile('test-data/two-node/state-00010.dtk.lz4', json_backend=name)
+            self.assertEqual(name, dtk_file.json_backend.name)
+            self.assertEqual(default.nodes[1], dtk_file.nodes[1], name)
+            self.assertEqual(default.nodes[0], list(dtk_file.load_nodes(indices=[0], workers=1))[0][1], name)
+        return
+
+    def test_default_backend(self):
+        name = list(dtkJson.__json_backends__.keys())[-1]
+        dtkJson.set_default_backend(name)
+        self.assertEqual(name, dtkFileTools.DtkFile('test-data/simple.dtk').json_backend.name)
+        header, payload, contents, data = idtkFileTools.read_idtk_file('test-data/compressed.dtk')
+        self.assertEqual({"simulation": {"__class__": "SimulationPython", "serializationMask": 0}}, data)
+        return
+
+
+if __name__ == '__main__':
+    unittest.main()
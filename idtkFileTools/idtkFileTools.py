@@ -6,12 +6,14 @@ import argparse
 import hashlib
 import json
 import os
-import sys
 import time
 from collections import OrderedDict
 
 import snappy
 
+import dtkInstrumentation
+import dtkJson
+
 # clorton cdo
 READ_PAYLOAD = 0
 DECOMPRESS_PAYLOAD = 1
@@ -23,6 +25,13 @@ WRITE_JSON = 6
 WRITE_DATA = 7
 READ_DATA = 8
 
+# python-snappy can't compress 2 GB or more in one call, larger payloads are written uncompressed unless they are split
+# into independently compressed frames (see write_idtk_file())
+_SNAPPY_LIMIT = 0x80000000  # Change this to 0x100000000 when python-snappy is fixed
+
+# set_metadata() hashes the payload in blocks of this size, updating sha1 and md5 together in one pass
+_HASH_BLOCK_SIZE = 1 << 20
+
 # This puts all the messages in one place so the output is aligned
 _messages_ = {READ_PAYLOAD:       'Read file payload:       ',
               DECOMPRESS_PAYLOAD: 'Decompress payload:      ',
@@ -34,13 +43,29 @@ _messages_ = {READ_PAYLOAD:       'Read file payload:       ',
               WRITE_DATA:         'Write contents to file:  ',
               READ_DATA:          'Read contents from file: '}
 
+_stages_ = {READ_PAYLOAD:       dtkInstrumentation.READ,
+            DECOMPRESS_PAYLOAD: dtkInstrumentation.DECOMPRESS,
+            PARSE_JSON:         dtkInstrumentation.PARSE,
+            WRITE_PAYLOAD:      dtkInstrumentation.WRITE,
+            CONVERT_TO_JSON:    dtkInstrumentation.SERIALIZE,
+            COMPRESS_JSON:      dtkInstrumentation.COMPRESS,
+            WRITE_JSON:         dtkInstrumentation.WRITE,
+            WRITE_DATA:         dtkInstrumentation.WRITE,
+            READ_DATA:          dtkInstrumentation.READ}
 
-def timing(f, message_index):
-    print('\r' + _messages_[message_index], file=sys.stderr, end='')
-    t_start = time.clock()
-    result = f()
-    t_end = time.clock()
-    print('{0:>10f}'.format(t_end-t_start), file=sys.stderr)
+
+def timing(f, message_index, size=None):
+    """
+    Record f() as a dtkInstrumentation span (when instrumentation is enabled).
+    :param f: callable to time
+    :param message_index: one of the stage constants above, e.g. READ_PAYLOAD
+    :param size: bytes processed, defaults to the length of f()'s result if it is a string
+    :return: result of f()
+    """
+    label = _messages_[message_index].strip().rstrip(':')
+    with dtkInstrumentation.span(_stages_[message_index], label=label) as span:
+        result = f()
+        span.bytes = size if size is not None else (len(result) if isinstance(result, (bytes, str)) else None)
 
     return result
 
@@ -69,9 +94,10 @@ def read_idtk_file_components(filename):
     return header, payload
 
 
-def read_idtk_file(filename):
+def read_idtk_file(filename, json_backend=None):
     """
     :param filename: source data filename (DTK serialized data format)
+    :param json_backend: name of the dtkJson backend used to parse the payload, defaults to dtkJson's configured default
     :return: header, payload, contents, data - parsed JSON header, raw payload data, decompressed (if appropriate) payload data, and parsed JSON data
     """
 
@@ -80,15 +106,29 @@ def read_idtk_file(filename):
     contents = None
 
     if 'compressed' in header['metadata'] and header['metadata']['compressed']:
-        contents = timing(lambda: snappy.uncompress(payload), message_index=DECOMPRESS_PAYLOAD)
+        frames = header['metadata'].get('framesizes', [len(payload)])
+        if sum(frames) != len(payload):
+            raise UserWarning("Frame sizes ({0} bytes) don't match the payload ({1} bytes)".format(sum(frames), len(payload)))
+        contents = timing(lambda: _uncompress_frames(payload, frames), message_index=DECOMPRESS_PAYLOAD)
     else:
         contents = payload
 
-    data = timing(lambda: json.loads(contents, object_pairs_hook=OrderedDict), message_index=PARSE_JSON)
+    backend = dtkJson.get_backend(json_backend)
+    data = timing(lambda: backend.loads(contents, object_pairs_hook=OrderedDict), message_index=PARSE_JSON)
 
     return header, payload, contents, data
 
 
+def _uncompress_frames(payload, frames):
+    offset = 0
+    parts = []
+    for size in frames:
+        parts.append(snappy.uncompress(buffer(payload, offset, size)))
+        offset += size
+
+    return parts[0] if len(parts) == 1 else ''.join(parts)
+
+
 def write_idtk_file_components(header, payload, filename):
     """
     :param header:  dictionary of header data, should include metadata
@@ -105,44 +145,51 @@ def write_idtk_file_components(header, payload, filename):
         output_handle.write('IDTK')
         output_handle.write(size_string)
         output_handle.write(header_string)
-        timing(lambda: output_handle.write(payload), message_index=WRITE_PAYLOAD)
+        timing(lambda: output_handle.write(payload), message_index=WRITE_PAYLOAD, size=len(payload))
 
     pass
 
 
-def write_idtk_file(header, data, filename, compress=True):
+def write_idtk_file(header, data, filename, compress=True, json_backend=None, frame_size=None):
     """
     :param header: dictionary of header data
     :param data: dictionary of serialized data
     :param filename: filename for writing
     :param compress: compress (or don't) payload in resulting file
+    :param json_backend: name of the dtkJson backend used to serialize data, defaults to dtkJson's configured default
+    :param frame_size: compress payloads larger than this as independent frames, listed in metadata.framesizes.
+                       Only read_idtk_file() and dtkFileTools read framed payloads, other readers (including DTK) fail
+                       to decompress them. None writes payloads too large to compress in one piece uncompressed.
     :return: None
     """
 
     # indent=None means no newlines
-    contents = timing(lambda: json.dumps(data, indent=None, separators=(',', ':')), message_index=CONVERT_TO_JSON)
-    is_compressed = False
+    backend = dtkJson.get_backend(json_backend)
+    contents = timing(lambda: backend.dumps(data, indent=None, separators=(',', ':')), message_index=CONVERT_TO_JSON)
+    if frame_size is None:
+        compress = compress and len(contents) < _SNAPPY_LIMIT
+        frame_size = _SNAPPY_LIMIT
+    frames = None
     if compress:
-        if len(contents) < 0x80000000:  # Change this to 0x100000000 when python-snappy is fixed
-            payload = timing(lambda: snappy.compress(contents), message_index=COMPRESS_JSON)
-            is_compressed = True
-        else:
-            payload = contents
+        frames = [timing(lambda: snappy.compress(contents[offset:offset + frame_size]), message_index=COMPRESS_JSON)
+                  for offset in range(0, len(contents), frame_size)] or [snappy.compress(contents)]
+        payload = frames[0] if len(frames) == 1 else ''.join(frames)
     else:
         payload = contents
 
-    set_metadata(header, payload, is_compressed)
+    set_metadata(header, payload, compress, [len(frame) for frame in frames] if frames and len(frames) > 1 else None)
 
     write_idtk_file_components(header, payload, filename)
 
     pass
 
 
-def set_metadata(header, payload, compressed):
+def set_metadata(header, payload, compressed, frame_sizes=None):
     """
     :param header: dictionary with header information
     :param payload: file payload (used to calculate bytecount, sha1 hash, and md5 hash)
     :param compressed: is the payload compressed or not
+    :param frame_sizes: sizes of independently compressed frames, if the payload was split
     :return: metadata dictionary
     """
 
@@ -154,13 +201,18 @@ def set_metadata(header, payload, compressed):
     metadata['date'] = time.strftime('%a %b %d %H:%M:%S %Y')    # e.g. Wed Mar 16 16:10:42 2016
     metadata['compressed'] = compressed
     metadata['bytecount'] = len(payload)
+    if frame_sizes is not None:
+        metadata['framesizes'] = frame_sizes
+    else:
+        metadata.pop('framesizes', None)
 
     sha1 = hashlib.sha1()
-    sha1.update(payload)
-    metadata['sha1'] = sha1.hexdigest()
-
     md5 = hashlib.md5()
-    md5.update(payload)
+    for offset in range(0, len(payload), _HASH_BLOCK_SIZE):
+        block = buffer(payload, offset, _HASH_BLOCK_SIZE)
+        sha1.update(block)
+        md5.update(block)
+    metadata['sha1'] = sha1.hexdigest()
     metadata['md5'] = md5.hexdigest()
 
     return metadata
@@ -176,7 +228,7 @@ def _do_read(args):
 
     if args.payload is not None:
         with open(args.payload, 'wb') as handle:
-            timing(lambda: handle.write(payload), message_index=WRITE_PAYLOAD)
+            timing(lambda: handle.write(payload), message_index=WRITE_PAYLOAD, size=len(payload))
 
     if args.output is not None:
         output_filename = args.output
@@ -186,9 +238,9 @@ def _do_read(args):
 
     with open(output_filename, 'wb') as handle:
         if args.format:
-            timing(lambda: json.dump(data, handle, indent=2, separators=(',', ': ')), message_index=WRITE_JSON)
+            timing(lambda: dtkJson.get_backend().dump(data, handle, indent=2, separators=(',', ': ')), message_index=WRITE_JSON)
         else:
-            timing(lambda: handle.write(contents), message_index=WRITE_DATA)
+            timing(lambda: handle.write(contents), message_index=WRITE_DATA, size=len(contents))
 
     pass
 
@@ -216,8 +268,8 @@ def _do_write(args):
         source_data = timing(lambda: handle.read(), message_index=READ_DATA)
 
     if args.verify:
-        data = timing(lambda: json.loads(source_data, object_pairs_hook=OrderedDict), message_index=PARSE_JSON)
-        write_idtk_file(header, data, args.filename, compress=args.compress)
+        data = timing(lambda: dtkJson.get_backend().loads(source_data, object_pairs_hook=OrderedDict), message_index=PARSE_JSON)
+        write_idtk_file(header, data, args.filename, compress=args.compress, frame_size=args.frame_size)
     else:
         set_metadata(header, source_data, args.compress)
         write_idtk_file_components(header, source_data, args.filename)
@@ -228,6 +280,10 @@ def _do_write(args):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Tools for reading/writing DTK serialized population files.")
+    parser.add_argument('-q', '--quiet', default=False, action='store_true', help="Don't print stage timings to stderr")
+    parser.add_argument('--trace', default=None, help='Write stage timings in Chrome trace format', metavar='<filename>')
+    parser.add_argument('--stats', default=None, help='Write stage timings as JSON', metavar='<filename>')
+    parser.add_argument('--json', default=None, help='JSON backend {{{0}|AUTO}}'.format('|'.join(dtkJson.__json_backends__.keys())), metavar='<backend>')
     subparsers = parser.add_subparsers(help='add_subparsers help')
     read_parser = subparsers.add_parser('read', help='read help')
     read_parser.add_argument('filename')
@@ -245,9 +301,22 @@ if __name__ == '__main__':
     write_parser.add_argument('-t', '--tool', default=os.path.basename(__file__), help='Tool name for metadata [{0}]'.format(os.path.basename(__file__)))
     write_parser.add_argument('-u', '--uncompressed', default=True, action='store_false', dest='compress', help='Do not compress contents of new .idtk file [False]')
     write_parser.add_argument('-s', '--skip-verify', default=True, action='store_false', dest='verify', help='Do not verify contents are valid JSON [False]')
+    write_parser.add_argument('--frame-size', default=None, type=int, metavar='<bytes>',
+                              help='Compress payloads larger than this as independent frames, readable only by these tools (not by DTK) '
+                                   '[off, payloads over 2 GB are written uncompressed]')
     write_parser.set_defaults(func=_do_write)
 
     command_line_args = parser.parse_args()
-    command_line_args.func(command_line_args)
+    if command_line_args.json is not None:
+        dtkJson.set_default_backend(command_line_args.json)
+    recorder = dtkInstrumentation.enable(dtkInstrumentation.Recorder(listeners=[] if command_line_args.quiet else [dtkInstrumentation.print_span]))
+    try:
+        command_line_args.func(command_line_args)
+    finally:
+        dtkInstrumentation.disable()
+        if command_line_args.trace is not None:
+            recorder.write_chrome_trace(command_line_args.trace)
+        if command_line_args.stats is not None:
+            recorder.write_json(command_line_args.stats)
 
     pass
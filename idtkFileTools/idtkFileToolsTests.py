@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import collections
+import dtkFileTools
 import idtkFileTools
 import json
 import os
@@ -91,6 +92,40 @@ class TestWritingFile(unittest.TestCase):
         self.assertEqual(source_data, actual_data)
         pass
 
+    def test_writing_compressed_file_in_frames(self):
+        source_header = json.loads('{"metadata":{"author":"clorton","tool":"editor","compressed":false}}', object_pairs_hook=collections.OrderedDict)
+        source_data = json.loads('{"simulation":{"__class__":"SimulationPython","serializationMask":0}}', object_pairs_hook=collections.OrderedDict)
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        idtkFileTools.write_idtk_file(source_header, source_data, temp_filename, compress=True, frame_size=16)
+        header, payload, contents, data = idtkFileTools.read_idtk_file(temp_filename)
+        dtk_file = dtkFileTools.DtkFile(temp_filename)
+        dtk_contents = dtk_file.get_contents(0)
+        os.remove(temp_filename)
+        self.assertEqual(5, len(header['metadata']['framesizes']))
+        self.assertEqual(len(payload), sum(header['metadata']['framesizes']))
+        self.assertEqual(source_data, data)
+        self.assertEqual(contents, dtk_contents)
+        pass
+
+    def test_writing_oversized_payload_uncompressed(self):
+        source_header = json.loads('{"metadata":{"author":"clorton","tool":"editor","compressed":true}}', object_pairs_hook=collections.OrderedDict)
+        source_data = json.loads('{"simulation":{"__class__":"SimulationPython","serializationMask":0}}', object_pairs_hook=collections.OrderedDict)
+        temp_handle, temp_filename = tempfile.mkstemp()
+        os.close(temp_handle)
+        limit = idtkFileTools._SNAPPY_LIMIT
+        idtkFileTools._SNAPPY_LIMIT = 16    # stand-in for python-snappy's 2 GB limit
+        try:
+            idtkFileTools.write_idtk_file(source_header, source_data, temp_filename, compress=True)
+        finally:
+            idtkFileTools._SNAPPY_LIMIT = limit
+        header, payload, contents, data = idtkFileTools.read_idtk_file(temp_filename)
+        os.remove(temp_filename)
+        self.assertFalse(header['metadata']['compressed'])
+        self.assertNotIn('framesizes', header['metadata'])
+        self.assertEqual(source_data, data)
+        pass
+
 
 if __name__ == '__main__':
     unittest.main()